@@ -1,6 +1,9 @@
 """
 This script creates a vocabulary based on the input folder.
 
+To train without building the train/dev/test .pt files (eg. with full_data_fraction = 1.0), the shards in input_folder
+can be read directly with models/util/loaders/streaming.py (streaming_loader).
+
 Set input parameters below:
 """
 import os
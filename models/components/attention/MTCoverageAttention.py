@@ -6,7 +6,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
-class Attention(nn.Module):
+from models.components.attention.ProjectionCache import ProjectionCache
+
+class Attention(ProjectionCache, nn.Module):
     def __init__(self, encoder_size, decoder_size, device, vocab_size = None):        
         super().__init__()
         self.encoder_size = encoder_size
@@ -26,9 +28,21 @@ class Attention(nn.Module):
         self.W3 = nn.Linear(self.vocab_size, self.encoder_size, bias=False)
         self.b = nn.Parameter(torch.zeros(self.encoder_size))
                         
+        self._cache = None # projections of the current batch's encoder output, see precompute
+        
         self.device = device
         self.to(self.device)
 
+    def project(self, enc_output):
+        """
+        The projections of the encoder output [batch_size, seq_len, encoder_size] that do not depend on the decoder: 
+        keys K, values V and energy_keys, the keys as used by the energy. All are [batch_size, seq_len, encoder_size].
+        """
+        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        energy_keys = self.W1(K) # the part of the energy that does not depend on the query
+        return K, V, energy_keys
+    
     def _reshape_state_h(self, state_h):    
         """
         Reshapes the hidden state to desired shape
@@ -75,13 +89,14 @@ class Attention(nn.Module):
         seq_len = enc_output.shape[1]
         state_h = self._reshape_state_h(state_h) # [batch_size, 1, decoder_size]
         
-        # get K, V, Q
-        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
-        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        # get K, V (projected once per batch, see precompute) and Q
+        V, energy_keys, cached_mask = self._cached(enc_output, state_h.size(0)) # [batch_size, seq_len, encoder_size] x2
         Q = self.query_annotation_function(state_h) # [batch_size, 1, encoder_size]
+        if mask is None:
+            mask = cached_mask
         
         # calculate energy        
-        energy = self.V(torch.tanh(self.W1(K) + self.W2(Q) + self.W3(coverage.unsqueeze(1)) + self.b)) # [batch_size, seq_len, 1]        
+        energy = self.V(torch.tanh(energy_keys + self.W2(Q) + self.W3(coverage.unsqueeze(1)) + self.b)) # [batch_size, seq_len, 1]        
         
         # mask with -inf paddings
         if mask is not None:            
@@ -0,0 +1,51 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+class ProjectionCache():
+    """
+        Mixin of the attention modules that caches the projections of the encoder output once per batch: the decoder
+        calls precompute before its first step, then each step only projects the query. The class defines
+        project(enc_output) -> (K, V, energy_keys), all [batch_size, seq_len, encoder_size], and sets self._cache = None
+        in its __init__.
+    """
+
+    def precompute(self, enc_output, mask=None):
+        """
+        Projects the encoder output once per batch. Calling forward with another enc_output recomputes the cache.
+
+        Args:
+            enc_output (tensor): The output of the last LSTM encoder layer.
+                Shape: [batch_size, seq_len, encoder_size].
+            mask (tensor): 1 and 0 as for encoder input, used when forward is called without a mask.
+                Shape: [batch_size, seq_len].
+        """
+        K, V, energy_keys = self.project(enc_output)
+        self._cache = {"enc_output": enc_output, "mask": mask, "K": K, "V": V, "energy_keys": energy_keys}
+
+    def clear(self): # releases the cached batch
+        self._cache = None
+
+    def select(self, index, cache=True):
+        """
+            Keeps the rows index (int64, repeats allowed) of the cached projections of the encoder output, if cache.
+            Beam search reorders its hypotheses with cache=False, the rows of the same input have the same projections.
+
+            Returns the cached encoder output, the enc_output to call forward with from now on.
+        """
+        if cache:
+            self._cache = {key: value.index_select(0, index) if value is not None else None for key, value in self._cache.items()}
+        return self._cache["enc_output"]
+
+    def _cached(self, enc_output, batch_size):
+        """
+            Returns the cached (V, energy_keys, mask) for enc_output, computing them if enc_output is not the cached
+            tensor. If the decoder works on the first batch_size rows only (a prefix slice of the same tensor, eg. when
+            finished sequences are dropped), the cache is sliced too.
+        """
+        cache = self._cache
+        if cache is None or not (enc_output is cache["enc_output"] or (enc_output.data_ptr() == cache["enc_output"].data_ptr()
+                and enc_output.shape[1:] == cache["enc_output"].shape[1:] and enc_output.shape[0] <= cache["enc_output"].shape[0])):
+            self.precompute(enc_output)
+            cache = self._cache
+        mask = cache["mask"][:batch_size] if cache["mask"] is not None else None
+        return cache["V"][:batch_size], cache["energy_keys"][:batch_size], mask
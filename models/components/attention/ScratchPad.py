@@ -3,6 +3,7 @@ sys.path.insert(0, '../../..')
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class ScratchPad(nn.Module):
     def __init__(self, enc_size, dec_size, device):
@@ -61,38 +62,32 @@ class ScratchPad(nn.Module):
             Rewritten encoder outputs:
                 Shape:      [batch_size, seq_len_enc, enc_size]
         """
-        batch_size = encoder_output.size()[0]
-        seq_len = encoder_output.size()[1]
-        
         # reshape state_h
         reshaped_decoder_state = self._reshape_state_h(decoder_state[0])
         
-        # first calculate u as the tanh(mlp(state, context))
-        input = torch.zeros(batch_size, self.dec_size+self.enc_size, device = self.device)
-        input[:,:self.dec_size] = reshaped_decoder_state[:,0,:]
-        input[:,self.dec_size:] = context[:,:]
-        u = self.mlp_u(input).tanh()
+        # the (state, context) input is shared by u and by alpha for every position
+        state_context = torch.cat([reshaped_decoder_state[:,0,:], context], dim=1) # [batch_size, dec_size+enc_size]
         
+        # first calculate u as the tanh(mlp(state, context))
+        u = self.mlp_u(state_context).tanh().unsqueeze(1) # [batch_size, 1, enc_size]
         
         if self.forwards%self.plot_every == 0:
             plot = True
         if plot:
             self.log_object.plot_heatmaps(encoder_output, "encoder_output", epoch = self.forwards+decoder_step*2)
             
-        # for each encoder output step i, compute alpha as sigmoid(mlp(state, context, encoder_output))
-        input = torch.zeros(batch_size, self.dec_size+self.enc_size+self.enc_size, device = self.device)
-        for i in range(seq_len):            
-            input[:,:self.dec_size] = reshaped_decoder_state[:,0,:]
-            input[:,self.dec_size:self.dec_size+self.enc_size] = context[:,:]
-            input[:,self.dec_size+self.enc_size:] = context[:,:]
-            alpha = self.mlp_alpha(input).sigmoid()
-            
-            # update encoder state i
-            encoder_output[:,i:i+1,:] = alpha * encoder_output[:,i:i+1,:] + (1. - alpha) * u
+        # for all encoder output steps at once, compute alpha as sigmoid(mlp(state, context, encoder_output)); 
+        # mlp_alpha's weight is split by input so the (state, context) part is computed once, not per position
+        split = self.dec_size+self.enc_size
+        alpha_state_context = F.linear(state_context, self.mlp_alpha.weight[:,:split], self.mlp_alpha.bias) # [batch_size, 1]
+        alpha_encoder = F.linear(encoder_output, self.mlp_alpha.weight[:,split:]) # [batch_size, seq_len_enc, 1]
+        alpha = (alpha_encoder + alpha_state_context.unsqueeze(1)).sigmoid() # [batch_size, seq_len_enc, 1]
         
+        # update all encoder states, out of place so autograd can still see the original encoder_output
+        encoder_output = alpha * encoder_output + (1. - alpha) * u # [batch_size, seq_len_enc, enc_size]
         
         if plot:
             self.log_object.plot_heatmaps(encoder_output, "encoder_output", epoch = self.forwards+decoder_step*2+1)
         
         self.forwards+=1
-        return encoder_output
\ No newline at end of file
+        return encoder_output
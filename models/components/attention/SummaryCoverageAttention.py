@@ -6,8 +6,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
-class Attention(nn.Module):
-    def __init__(self, encoder_size, decoder_size, device, type="additive", vocab_size = None):
+from models.components.attention.ProjectionCache import ProjectionCache
+
+class Attention(ProjectionCache, nn.Module):
+    def __init__(self, encoder_size, decoder_size, device, type="additive", vocab_size = None, coverage = "vocab"):
         """ Attention module.         
                 TODO description for each type
                 
@@ -20,6 +22,9 @@ class Attention(nn.Module):
                 decoder_size (int): Size of the decoder's output.
                 device (torch.device): Device (eg. torch.device("cpu"))
                 type (string): One of several types of attention
+                coverage (string): "vocab" keeps the coverage as the attention summed per vocab entry [batch_size, vocab_size],
+                    "source" per source position [batch_size, seq_len] as in See et al. (2017), with a single feature 
+                    per position, so its cost grows with the source length instead of the vocab size.
         
             See: https://arxiv.org/pdf/1902.02181.pdf
             
@@ -33,6 +38,7 @@ class Attention(nn.Module):
         self.decoder_size = decoder_size
         self.type = type
         self.vocab_size = vocab_size # needed for summarization_coverage, otherwise None
+        self.coverage = coverage
         
         # transforms encoder states into keys
         self.key_annotation_function = nn.Linear(self.encoder_size, self.encoder_size, bias=False)
@@ -44,12 +50,27 @@ class Attention(nn.Module):
         self.V = nn.Linear(self.encoder_size, 1, bias=False) 
         self.W1 = nn.Linear(self.encoder_size, self.encoder_size, bias=False)
         self.W2 = nn.Linear(self.encoder_size, self.encoder_size, bias=False) # encoder size because q is now K's size, otherwise dec_size to enc_size
-        self.W3 = nn.Linear(self.vocab_size, self.encoder_size, bias=False)
+        if coverage == "source": # w_c, the coverage of each position is a feature of its energy
+            self.W3 = nn.Linear(1, self.encoder_size, bias=False)
+        else:
+            self.W3 = nn.Linear(self.vocab_size, self.encoder_size, bias=False)
         self.b = nn.Parameter(torch.zeros(self.encoder_size))
                         
+        self._cache = None # projections of the current batch's encoder output, see precompute
+        
         self.device = device
         self.to(self.device)
 
+    def project(self, enc_output):
+        """
+        The projections of the encoder output [batch_size, seq_len, encoder_size] that do not depend on the decoder: 
+        keys K, values V and energy_keys, the keys as used by the energy. All are [batch_size, seq_len, encoder_size].
+        """
+        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        energy_keys = self.W1(K) # the part of the energy that does not depend on the query
+        return K, V, energy_keys
+    
     def _reshape_state_h(self, state_h):    
         """
         Reshapes the hidden state to desired shape
@@ -83,26 +104,34 @@ class Attention(nn.Module):
             enc_output (tensor): The output of the last LSTM encoder layer. 
                 Shape: [batch_size, seq_len, encoder_size].
             coverage(tensor): Coverage tensor
-                Shape: [batch_size, vocab_size]
+                Shape: [batch_size, vocab_size], or [batch_size, seq_len] for coverage="source"
             mask (tensor): 1 and 0 as for encoder input
                 Shape: [batch_size, seq_len].
 
         Returns:
             context (tensor): The context vector. Shape: [batch_size, encoder_size]
             attention_weights (tensor): Attention weights. Shape: [batch_size, seq_len, 1]
-            coverage (tensor): The next coverage vector. Shape: [batch_size, vocab_size]
         """
-        batch_size = enc_output.shape[0]
-        seq_len = enc_output.shape[1]        
+        # get K, V (projected once per batch, see precompute)
+        V, energy_keys, cached_mask = self._cached(enc_output, state_h.size(1)) # [batch_size, seq_len, encoder_size] x2
+        if mask is None:
+            mask = cached_mask
+        return self.attend(V, energy_keys, state_h, coverage, mask)
+    
+    def attend(self, V, energy_keys, state_h, coverage, mask=None):
+        """
+        forward on the projections of the encoder output (see project), without the cache: the context vector and the 
+        attention weights, [batch_size, encoder_size] and [batch_size, seq_len, 1].
+        """
         state_h = self._reshape_state_h(state_h) # [batch_size, 1, decoder_size]
-        
-        # get K, V, Q
-        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
-        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
         Q = self.query_annotation_function(state_h) # [batch_size, 1, encoder_size]
         
         # calculate energy        
-        energy = self.V(torch.tanh(self.W1(K) + self.W2(Q) + self.W3(coverage.unsqueeze(1)) + self.b)) # [batch_size, seq_len, 1]        
+        if self.coverage == "source": # [batch_size, seq_len] -> [batch_size, seq_len, encoder_size]
+            coverage_features = self.W3(coverage.unsqueeze(2))
+        else: # [batch_size, vocab_size] -> [batch_size, 1, encoder_size], the same for all positions
+            coverage_features = self.W3(coverage.unsqueeze(1))
+        energy = self.V(torch.tanh(energy_keys + self.W2(Q) + coverage_features + self.b)) # [batch_size, seq_len, 1]        
         
         # mask with -inf paddings
         if mask is not None:            
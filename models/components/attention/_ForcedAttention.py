@@ -7,7 +7,9 @@ import torch.nn.functional as F
 import numpy as np
 import scipy.stats
 
-class Attention(nn.Module):
+from models.components.attention.ProjectionCache import ProjectionCache
+
+class Attention(ProjectionCache, nn.Module):
     def __init__(self, encoder_size, decoder_size, device, type="additive"):
         """ Attention module.         
                 TODO description for each type
@@ -55,9 +57,10 @@ class Attention(nn.Module):
             self.W2 = nn.Linear(self.encoder_size, self.encoder_size, bias=False) # encoder size because q is now K's size, otherwise dec_size to enc_size
             self.b = nn.Parameter(torch.zeros(self.encoder_size))
             
+            # C_j = GRU([a_j ; h_j ; s], C_j) for every source position j, the previous coverage is the hidden state
             self.coverage_dim = 10
-            self.coverage_input_size = self.coverage_dim + 1 + self.encoder_size + self.encoder_size
-            self.cov_gru = nn.GRU(self.coverage_input_size, self.coverage_dim, batch_first=True)
+            self.coverage_input_size = 1 + self.encoder_size + self.decoder_size
+            self.cov_gru = nn.GRUCell(self.coverage_input_size, self.coverage_dim)
             self.W3 = nn.Linear(self.coverage_dim, self.encoder_size)
                                
         elif (type == "multiplicative" or type == "dot"):
@@ -87,9 +90,33 @@ class Attention(nn.Module):
             pass
         else:
             raise Exception("Attention type not properly defined! (got type={})".format(self.type))
+        self._cache = None # projections of the current batch's encoder output, see precompute
+        
         self.device = device
         self.to(self.device)
 
+    def precompute(self, enc_output, mask=None):
+        """ See ProjectionCache.precompute. """
+        super().precompute(enc_output, mask)
+        if self.type == "coverage": # a new batch starts with empty coverage
+            self.C = enc_output.new_zeros((enc_output.size(0), enc_output.size(1), self.coverage_dim))
+    
+    def project(self, enc_output):
+        """
+        The projections of the encoder output [batch_size, seq_len, encoder_size] that do not depend on the decoder: 
+        keys K, values V and energy_keys, the keys as used by the energy. All are [batch_size, seq_len, encoder_size].
+        """
+        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        # keys as used by _energy, the part of the compatibility function that does not depend on the query
+        if self.type == "additive" or self.type == "coverage":
+            energy_keys = self.W1(K)
+        elif self.type == "general" or self.type == "bilinear":
+            energy_keys = self.W(K)
+        else:
+            energy_keys = K
+        return K, V, energy_keys
+    
     def _reshape_state_h(self, state_h):    
         """
         Reshapes the hidden state to desired shape
@@ -117,37 +144,37 @@ class Attention(nn.Module):
         
         if self.type == "coverage":
             self.C = torch.zeros(batch_size, enc_seq_len, self.coverage_dim, device=self.device)
-            self.gru_input = torch.zeros(batch_size, 1, self.coverage_input_size, device=self.device)
                     
     def _coverage_compute_next_C(self, attention_weights, enc_output, state_h):
         # attention_weights:        [batch_size, seq_len, 1]
         # enc_output :              [batch_size, seq_len, encoder_size]
-        # state_h (after reshape):  [batch_size, 1, encoder_size]       
+        # state_h (after reshape):  [batch_size, 1, decoder_size]       
         # self.C at prev timestep:  [batch_size, seq_len, coverage_dim]
-        seq_len = enc_output.size[1]
-        for i in range(seq_len):
-            self.gru_input[:,:,0:self.coverage_dim] = self.C[:,i:i+1,:] # cat self.C at prev timestep for position i of source word
-            self.gru_input[:,:,self.coverage_dim:self.coverage_dim+1] = attention_weights[:,i:i+1,:] # cat attention weight
-            self.gru_input[:,:,self.coverage_dim+1:self.coverage_dim+1+self.encoder_size] = enc_output[:,i:i+1,:] # cat encoder output
-            self.gru_input[:,:,self.coverage_dim+1+self.encoder_size:] = state_h[:,0:1,:] # cat state_h
-            self.C[:,i:i+1,:] = self.cov_gru(self.gru_input)
+        # all source positions are updated by one GRUCell call over [batch_size*seq_len, ...]
+        batch_size, seq_len = enc_output.size(0), enc_output.size(1)
+        gru_input = torch.cat((attention_weights, enc_output, state_h.expand(-1, seq_len, -1)), dim=2) # [batch_size, seq_len, coverage_input_size]
+        C = self.cov_gru(gru_input.reshape(batch_size*seq_len, -1), self.C.reshape(batch_size*seq_len, -1))
+        self.C = C.reshape(batch_size, seq_len, self.coverage_dim)
         
     def _energy (self, K, Q):
         """ 
             Calculates the compatibility function f(query, keys)
             
             Args:
-                K (tensor): Keys tensor of size [batch_size, seq_len, encoder_size]
+                K (tensor): Keys tensor of size [batch_size, seq_len, encoder_size], already transformed by W1 (additive,
+                    coverage) or W (general), see precompute
                 Q (tensor): Query tensor of size [batch_size, 1, decoder_size], but now dec_size is enc_size due to Q annotation
                 
             Returns: 
                 energy tensor of size [batch_size, seq_len, 1]
         """
         if self.type == "additive":                        
-            return self.V(torch.tanh(self.W1(K) + self.W2(Q) + self.b))
+            return self.V(torch.tanh(K + self.W2(Q) + self.b))
         
         elif self.type == "coverage":
-            return self.V(torch.tanh(self.W1(K) + self.W2(Q) + self.W3(self.C) + self.b))
+            # finished sequences may have been dropped from the end of the batch, see _cached
+            self.C = self.C[:K.size(0)]
+            return self.V(torch.tanh(K + self.W2(Q) + self.W3(self.C) + self.b))
             
         elif self.type == "multiplicative" or self.type == "dot":    
             # q^t K means batch matrix multiplying K with q transposed:
@@ -160,7 +187,7 @@ class Attention(nn.Module):
     
         elif self.type == "general" or self.type == "bilinear":
             # f(q, K) = q^t WK , Luong et al., 2015
-            return torch.bmm(self.W(K), Q.transpose(1,2))
+            return torch.bmm(K, Q.transpose(1,2))
 
     def forward(self, enc_output, state_h, decoder_step, dec_seq_len, mask=None):
         """
@@ -183,13 +210,14 @@ class Attention(nn.Module):
         seq_len = enc_output.shape[1]        
         state_h = self._reshape_state_h(state_h) # [batch_size, 1, decoder_size]
         
-        # get K, V, Q
-        K = self.key_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
-        V = self.value_annotation_function(enc_output) # [batch_size, seq_len, encoder_size]
+        # get K, V (projected once per batch, see precompute) and Q
+        V, energy_keys, cached_mask = self._cached(enc_output, state_h.size(0)) # [batch_size, seq_len, encoder_size] x2
         Q = self.query_annotation_function(state_h) # [batch_size, 1, encoder_size]
+        if mask is None:
+            mask = cached_mask
         
         # calculate energy
-        energy = self._energy(K,Q) # [batch_size, seq_len, 1]        
+        energy = self._energy(energy_keys,Q) # [batch_size, seq_len, 1]        
         
         # mask with -inf paddings
         if mask is not None:            
@@ -216,8 +244,8 @@ class Attention(nn.Module):
         """
         
         # for coverage only, calculate the next C
-        if type=="coverage":
-            self._coverage_compute_next_C(attention_weights, enc_output, state_h)            
+        if self.type == "coverage":
+            self._coverage_compute_next_C(attention_weights, enc_output[:state_h.size(0)], state_h)            
         
         # calculate weighted values z (element wise multiplication of energy * values)        
         # attention_weights is [batch_size, seq_len, 1], V is [batch_size, seq_len, encoder_size], z is same as V
@@ -0,0 +1,80 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+import time
+import torch
+
+from models.components.attention.ScratchPad import ScratchPad
+
+"""
+    Micro-benchmark of ScratchPad.forward: per-decoder-step cost of the previous per-position loop versus the current
+    batched rewrite, forward and forward+backward.
+
+    python benchmark_scratchpad.py [batch_size] [seq_len_enc] [enc_size] [dec_size]
+"""
+
+def loop_forward(scratchpad, encoder_output, decoder_state, context):
+    # the previous implementation, kept here as the reference (alpha fed encoder state i, as the batched version does)
+    sp = scratchpad
+    batch_size = encoder_output.size()[0]
+    seq_len = encoder_output.size()[1]
+    encoder_output = encoder_output.clone() # the loop writes in place
+
+    reshaped_decoder_state = sp._reshape_state_h(decoder_state[0])
+
+    input = torch.zeros(batch_size, sp.dec_size+sp.enc_size, device = sp.device)
+    input[:,:sp.dec_size] = reshaped_decoder_state[:,0,:]
+    input[:,sp.dec_size:] = context[:,:]
+    u = sp.mlp_u(input).tanh()
+
+    input = torch.zeros(batch_size, sp.dec_size+sp.enc_size+sp.enc_size, device = sp.device)
+    for i in range(seq_len):
+        input = input.clone() # each step's input is saved for backward
+        input[:,:sp.dec_size] = reshaped_decoder_state[:,0,:]
+        input[:,sp.dec_size:sp.dec_size+sp.enc_size] = context[:,:]
+        encoder_i = encoder_output[:,i,:].clone() # a view would be overwritten before backward
+        input[:,sp.dec_size+sp.enc_size:] = encoder_i
+        alpha = sp.mlp_alpha(input).sigmoid()
+        encoder_output[:,i,:] = alpha * encoder_i + (1. - alpha) * u
+    return encoder_output
+
+def time_per_call(fn, args, backward = False, repeats = 5, calls = 10):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            output = fn(*args)
+            if backward:
+                output.sum().backward()
+        if args[0].is_cuda:
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seq_len_enc = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    enc_size = int(sys.argv[3]) if len(sys.argv) > 3 else 512
+    dec_size = int(sys.argv[4]) if len(sys.argv) > 4 else 256
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    torch.manual_seed(0)
+    scratchpad = ScratchPad(enc_size, dec_size, device)
+    scratchpad.plot_every = 10**12 # no heatmaps while timing
+    scratchpad.forwards = 1
+    encoder_output = torch.randn(batch_size, seq_len_enc, enc_size, device=device, requires_grad=True)
+    decoder_state = (torch.randn(2, batch_size, dec_size, device=device), torch.randn(2, batch_size, dec_size, device=device))
+    context = torch.randn(batch_size, enc_size, device=device)
+    args = (encoder_output, decoder_state, context)
+
+    # check both implementations rewrite the encoder states the same way
+    with torch.no_grad():
+        assert torch.allclose(loop_forward(scratchpad, *args), scratchpad(*args), atol=1e-5)
+
+    print("batch_size={}, seq_len_enc={}, enc_size={}, dec_size={}, {}".format(batch_size, seq_len_enc, enc_size, dec_size, device))
+    with torch.no_grad():
+        print("\tloop, forward             : {:8.3f} ms/step".format(1000*time_per_call(lambda *a: loop_forward(scratchpad, *a), args)))
+        print("\tbatched, forward          : {:8.3f} ms/step".format(1000*time_per_call(scratchpad, args)))
+    print("\tloop, forward+backward    : {:8.3f} ms/step".format(1000*time_per_call(lambda *a: loop_forward(scratchpad, *a), args, backward=True, repeats=2, calls=2)))
+    print("\tbatched, forward+backward : {:8.3f} ms/step".format(1000*time_per_call(scratchpad, args, backward=True)))
@@ -0,0 +1,70 @@
+import math
+from collections import OrderedDict
+import torch
+
+class GaussianAttentionTargets():
+    """
+    Diagonal Gaussian target distributions for the forced-attention loss: decoder step i should attend around encoder
+    position i. The [dec_seq_len, enc_seq_len] table is built once per (dec_seq_len, enc_seq_len, sigma) on the device
+    it is asked for and kept in a small LRU cache, so a batch costs a cache lookup and a broadcast over the batch instead
+    of a pdf call and a host-to-device copy per decoder step.
+
+    Init:
+        sigma: std dev of the Gaussian, in encoder positions
+        maxsize: number of tables kept, least recently used ones are evicted first
+    Call:
+        batch_size, dec_seq_len, enc_seq_len: shape of the attention weights
+        dtype, device: of the attention weights
+        log: if True, return the log of the targets (what the KLDivLoss input needs)
+    Output:
+        targets: [batch_size, dec_seq_len, enc_seq_len], an expanded view (no copy over the batch), rows sum to 1,
+            values are at least 1e-31
+    """
+    def __init__(self, sigma=2., maxsize=32):
+        self.sigma = sigma
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+
+    def table(self, dec_seq_len, enc_seq_len, dtype=torch.float, device=torch.device("cpu"), log=False):
+        key = (dec_seq_len, enc_seq_len, self.sigma, dtype, str(device), log)
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+
+        # same positions as np.linspace(0, enc_seq_len, enc_seq_len), mean of row i is i
+        x = torch.linspace(0, enc_seq_len, enc_seq_len, dtype=torch.float64, device=device) # [enc_seq_len]
+        mean = torch.arange(dec_seq_len, dtype=torch.float64, device=device).unsqueeze(1) # [dec_seq_len, 1]
+        # normalizing in log space is the same as pdf/sum(pdf), and stays finite for rows far past the encoder's end
+        log_table = torch.log_softmax(-(x - mean)**2 / (2 * self.sigma**2), dim=1) # [dec_seq_len, enc_seq_len]
+        log_table = log_table.clamp(min=math.log(1e-31))
+        table = (log_table if log else log_table.exp()).to(dtype)
+
+        self._tables[key] = table
+        if len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return table
+
+    def __call__(self, batch_size, dec_seq_len, enc_seq_len, dtype=torch.float, device=torch.device("cpu"), log=False):
+        return self.table(dec_seq_len, enc_seq_len, dtype, device, log).unsqueeze(0).expand(batch_size, dec_seq_len, enc_seq_len)
+
+    def clear(self):
+        self._tables.clear()
+
+if __name__ == "__main__":
+    import numpy as np
+    import scipy.stats
+
+    # check against the per-step scipy loop it replaces
+    targets = GaussianAttentionTargets(sigma=2.)
+    dec_seq_len, enc_seq_len = 30, 50
+    x = np.linspace(0, enc_seq_len, enc_seq_len)
+    reference = torch.full((dec_seq_len, enc_seq_len), 1e-31)
+    for decoder_index in range(0, dec_seq_len):
+        y = scipy.stats.norm.pdf(x, decoder_index, 2)
+        reference[decoder_index, :] = torch.tensor(y / np.sum(y))
+    reference[reference<1e-31] = 1e-31
+
+    output = targets(4, dec_seq_len, enc_seq_len)
+    print(output.shape, (output[0] - reference).abs().max().item())
+    assert torch.allclose(output[0], reference, atol=1e-7)
+    assert torch.allclose(targets(4, dec_seq_len, enc_seq_len, log=True)[1].exp(), reference, atol=1e-7)
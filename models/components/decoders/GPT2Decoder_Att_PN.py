@@ -64,6 +64,9 @@ class Decoder(nn.Module):
         context = context.unsqueeze(0).repeat(num_samples, 1)
         generated = context
         
+        # project the encoder output once for the whole batch, the steps below only project the query
+        self.attention.precompute(enc_output, src_masks)
+
         # Loop over the rest of tokens in the tgt seq_len_dec.
         for i in range(0, seq_len_dec-1):
             # Calculate the context vector at step i.
@@ -131,6 +134,7 @@ class Decoder(nn.Module):
             # calculate the next coverage by adding step_attention_weights where appropriate                        
             coverage = coverage.scatter_add(1, src, step_attention_weights.squeeze(2))
             
+        self.attention.clear()
         # output is a tensor [batch_size, seq_len_dec, vocab_size], log-ged to be prepared for NLLLoss 
         # attention_weights is a list of [batch_size, seq_len] elements, where each element is the softmax distribution for a timestep
         # coverage_loss is a scalar tensor
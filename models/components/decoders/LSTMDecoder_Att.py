@@ -5,6 +5,7 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from models.components.attention.Attention import Attention
 
@@ -33,7 +34,18 @@ class Decoder(nn.Module):
         self.device = device
         self.to(device)
 
-    def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio):
+    def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=None, output_type="dense"):
+        """
+            Args:
+                ignore_index (int): If not None, the summed cross-entropy of the logits with input[:, 1:] is computed step 
+                    by step (skipping targets equal to ignore_index) and returned as 'nll'.
+                output_type (string): "dense" returns the logits [batch_size, seq_len_dec-1, vocab_size], "ids" only their 
+                    argmax [batch_size, seq_len_dec-1] (int64), None nothing.
+            
+            Rows stop being decoded once their target (input_lengths, BOS and EOS included) is over: each step runs on 
+            the rows still active only, like packed sequences. Past the end of its target a row's output is 0 ("dense"), 
+            the target's padding ("ids"), and its attention weights are 0.
+        """
         input, input_lengths = y_tuple[0], y_tuple[1]
         encoder_mask = x_tuple[2]
         
@@ -42,33 +54,63 @@ class Decoder(nn.Module):
         seq_len_dec = input.shape[1]        
             
         dec_states = (dec_states[0].contiguous(), dec_states[1].contiguous())
-        output = enc_output.new_zeros((batch_size,seq_len_dec-1,self.vocab_size), requires_grad = False)
+        nll = None if ignore_index is None else 0
                 
+        # sort the rows by target length, longest first, so the rows still active at step i are the first n_active[i]
+        length_order = None
+        if input_lengths is not None:
+            sorted_lengths, length_order = torch.sort(input_lengths.to(input.device), descending=True)
+            if bool((length_order == torch.arange(batch_size, device=length_order.device)).all()): # already sorted
+                length_order = None
+            else:
+                input, encoder_mask, enc_output = input[length_order], encoder_mask[length_order], enc_output[length_order]
+                dec_states = (dec_states[0][:, length_order].contiguous(), dec_states[1][:, length_order].contiguous())
+            n_active = (sorted_lengths.unsqueeze(0) - 1 > torch.arange(seq_len_dec-1, device=input.device).unsqueeze(1)).sum(1).tolist()
+        else:
+            n_active = [batch_size] * (seq_len_dec-1)
+        
+        if output_type == "dense":
+            output = enc_output.new_zeros((batch_size,seq_len_dec-1,self.vocab_size), requires_grad = False)
+        elif output_type == "ids": # positions past the end of a target keep its padding
+            output = input[:, 1:].clone()
+        else:
+            output = None
+        
         attention_weights = enc_output.new_zeros((batch_size, seq_len_dec-1, seq_len_enc), requires_grad = False)
         
+        # project the encoder output once for the whole batch, the steps below only project the query
+        self.attention.precompute(enc_output, encoder_mask)
+        n = batch_size
+
         # Loop over the rest of tokens in the input seq_len_dec.
         for i in range(0, seq_len_dec-1):
+            if n_active[i] == 0:
+                break
+            if n_active[i] < n: # drop the rows whose target is over, they are last
+                n = n_active[i]
+                dec_states = (dec_states[0][:, :n].contiguous(), dec_states[1][:, :n].contiguous())
+            
             # Calculate the context vector at step i.
-            # context_vector is [batch_size, encoder_size], attention_weights is [batch_size, seq_len, 1]
-            context_vector, step_attention_weights = self.attention(state_h=dec_states[0], enc_output=enc_output, mask=encoder_mask)
+            # context_vector is [n, encoder_size], attention_weights is [n, seq_len, 1]
+            context_vector, step_attention_weights = self.attention(state_h=dec_states[0], enc_output=enc_output[:n], mask=encoder_mask[:n])
                         
             # save the tensor format [batch_size, dec_seq_len, enc_seq_len]
-            attention_weights[:, i, :] = step_attention_weights.squeeze(2)
+            attention_weights[:n, i, :] = step_attention_weights.squeeze(2)
             
             if np.random.uniform(0, 1) < teacher_forcing_ratio or i is 0:
                 # Concatenates the i-th embedding of the input with the corresponding  context vector over the second
                 # dimensions. Transforms the 2-D tensor to 3-D sequence tensor with length 1. [batch_size, emb_dim] +
                 # [batch_size, hidden_dim * num_layers] -> [batch_size, 1, emb_dim + hidden_dim * num_layers].                        
-                prev_output_embeddings = self.dropout(self.embedding(input[:, i]))               
+                prev_output_embeddings = self.dropout(self.embedding(input[:n, i]))               
             else:
                 # Calculates the embeddings of the previous output. Counts the argmax over the last third dimension and
                 # then squeezes the second dimension, the sequence length. [batch_size, emb_dim].
-                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(softmax_output, dim=2), dim=1)))
+                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(softmax_output[:n], dim=2), dim=1)))
                 
             # Concatenates the (i-1)-th embedding of the previous output with the corresponding  context vector over the second
             # dimensions. Transforms the 2-D tensor to 3-D sequence tensor with length 1. [batch_size, emb_dim] +
             # [batch_size, hidden_dim * num_layers] -> [batch_size, 1, emb_dim + hidden_dim * num_layers].
-            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).reshape(batch_size, 1, -1)
+            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).reshape(n, 1, -1)
 
             # Calculates the i-th decoder output and state. We initialize the decoder state with (i-1)-th state.
             # [batch_size, 1, hidden_dim], [num_layers, batch_size, hidden_dim].
@@ -82,8 +124,72 @@ class Decoder(nn.Module):
             
             # Adds the current output to the final output. [batch_size, i-1, vocab_size] -> [batch_size, i, vocab_size].
             #output = torch.cat((output, lin_output), dim=1)            
-            output[:,i,:] = softmax_output.squeeze(1)
+            if output_type == "dense":
+                output[:n,i,:] = softmax_output.squeeze(1)
+            elif output_type == "ids":
+                output[:n,i] = torch.argmax(softmax_output.squeeze(1), dim=1)
+            
+            if ignore_index is not None:
+                nll = nll + F.cross_entropy(softmax_output.squeeze(1), input[:n, i+1], ignore_index=ignore_index, reduction='sum')
             
-        # output is a tensor [batch_size, seq_len_dec, vocab_size]
+        self.attention.clear()
+        if length_order is not None: # back to the order of the batch
+            inverse = torch.argsort(length_order)
+            attention_weights = attention_weights[inverse]
+            if output is not None:
+                output = output[inverse]
+        # output is a tensor [batch_size, seq_len_dec, vocab_size] (or the argmax ids, or None)
         # attention_weights is a list of [batch_size, seq_len] elements, where each element is the softmax distribution for a timestep
-        return {'output':output, 'attention_weights':attention_weights}
+        # nll is the summed cross-entropy of input[:, 1:] (a scalar tensor), or None
+        return {'output':output, 'attention_weights':attention_weights, 'nll':nll}
+
+    def init_state(self, x_tuple, enc_output, dec_states):
+        """
+            The state of step by step decoding (see step and EncoderDecoder.generate) of the batch x_tuple, whose encoder 
+            output is enc_output, starting from dec_states. Its tensors have one row per decoded sequence.
+        """
+        self.attention.precompute(enc_output, x_tuple[2])
+        return {"dec_states": (dec_states[0].contiguous(), dec_states[1].contiguous()), "enc_output": enc_output, "mask": x_tuple[2]}
+
+    def step(self, prev_tokens, state):
+        """
+            One decoding step, the same computation as a step of forward.
+
+            Args:
+                prev_tokens (tensor): The previous output of each row (BOS at the first step). Shape: [n].
+                state (dict): See init_state.
+
+            Returns:
+                The log-probabilities of the next token [n, vocab_size] and the next state.
+        """
+        V, energy_keys, _ = self.attention._cached(state["enc_output"], prev_tokens.size(0))
+        log_probs, dec_states, attention_weights = self._step(prev_tokens, state["dec_states"], V, energy_keys, state["mask"])
+        if self.attention.type == "coverage": # its C is kept by the attention, see Attention.forward
+            state_h = self.attention._reshape_state_h(state["dec_states"][0])
+            self.attention._coverage_compute_next_C(attention_weights, state["enc_output"][:state_h.size(0)], state_h)
+        return log_probs, dict(state, dec_states=dec_states)
+
+    def _step(self, prev_tokens, dec_states, V, energy_keys, mask):
+        """
+            step on plain tensors, with the projections of the encoder output (see Attention.project) instead of the 
+            cache, so it can be traced (see models/util/export.py). Returns the log-probabilities [n, vocab_size], 
+            the next LSTM states and the attention weights [n, enc_seq_len, 1].
+        """
+        context_vector, attention_weights = self.attention.attend(V, energy_keys, dec_states[0], mask)
+        prev_output_embeddings = self.dropout(self.embedding(prev_tokens)) # [n, emb_dim]
+        lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).unsqueeze(1)
+        dec_output, dec_states = self.lstm(lstm_input, dec_states)
+        lin_input = torch.cat( (dec_output.squeeze(1), context_vector, prev_output_embeddings) , dim = 1)
+        logits = self.softmax_linear(torch.tanh(self.output_linear(lin_input))) # [n, vocab_size]
+        return torch.log_softmax(logits, dim=1), dec_states, attention_weights
+
+    def reorder_state(self, state, index, same_inputs=False):
+        """
+            Keeps the rows index (int64, repeats allowed) of state. If same_inputs, index only moves rows between 
+            decodings of the same input (beam search), so the rows of the encoder output and its projections stay.
+        """
+        state = dict(state, dec_states=(state["dec_states"][0].index_select(1, index), state["dec_states"][1].index_select(1, index)))
+        state["enc_output"] = self.attention.select(index, cache=not same_inputs)
+        if not same_inputs:
+            state["mask"] = state["mask"].index_select(0, index)
+        return state
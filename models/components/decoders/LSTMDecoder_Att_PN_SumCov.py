@@ -10,9 +10,12 @@ import torch.nn.functional as F
 from models.components.attention.SummaryCoverageAttention import Attention
 
 class Decoder(nn.Module):
-    def __init__(self, emb_dim, input_size, hidden_dim, num_layers, vocab_size, lstm_dropout, dropout, device):
+    def __init__(self, emb_dim, input_size, hidden_dim, num_layers, vocab_size, lstm_dropout, dropout, device, coverage="vocab"):
         """ 
             Creates a Decoder with attention and Pointer network see https://nlp.stanford.edu/pubs/see2017get.pdf 
+            
+            coverage is "vocab" (attention summed per vocab entry) or "source" (per source position, as in the paper), see 
+            SummaryCoverageAttention. The coverage loss is computed over the same entries.
         """        
         super().__init__()
         
@@ -29,7 +32,7 @@ class Decoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.lstm = nn.LSTM(emb_dim + input_size, hidden_dim, num_layers, dropout=lstm_dropout, batch_first=True)
         self.output_linear = nn.Linear(hidden_dim, vocab_size)
-        self.attention = Attention(encoder_size=input_size, decoder_size=hidden_dim, vocab_size=vocab_size, device=device)
+        self.attention = Attention(encoder_size=input_size, decoder_size=hidden_dim, vocab_size=vocab_size, device=device, coverage=coverage)
 
         # overwrite output to allow context from the attention to be added to the output layer
         self.output_linear = nn.Linear(hidden_dim+input_size+emb_dim, int((hidden_dim+input_size+emb_dim)/2))
@@ -45,9 +48,32 @@ class Decoder(nn.Module):
         """
         self.p_gen_linear = nn.Linear(self.encoder_size + self.decoder_size*2 + self.emb_dim, 1)
         
+        self.output_log_probs = True # the dense output is log(final_dist), not logits
+        
         self.to(device)
+    
+    def _embed_target(self, tgt):
+        """
+            Embeddings of the teacher forced decoder inputs tgt[:, :-1], for all steps at once.
+                [batch_size, dec_seq_len-1, emb_dim]
+        """
+        return self.dropout(self.embedding(tgt[:, :-1]))
 
-    def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio):
+    def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=None, output_type="dense"):
+        """
+            Args:
+                ignore_index (int): If not None, the summed negative log-likelihood of tgt[:, 1:] is computed step by 
+                    step (skipping targets equal to ignore_index) and returned as 'nll'. The log-probability of the gold 
+                    token mixes the generator's log-softmax of that token with the attention mass on the source positions 
+                    holding it (src is the source position -> id map), so the final distribution is not needed for it.
+                output_type (string): "dense" returns the final log-distribution [batch_size, dec_seq_len-1, vocab_size],
+                    "ids" only its argmax [batch_size, dec_seq_len-1] (int64), None nothing. The vocab-sized final 
+                    distribution is only built for "dense" and "ids" (inference).
+            
+            Rows stop being decoded once their target (tgt_lengths, BOS and EOS included) is over: each step runs on the 
+            rows still active only, like packed sequences, and the coverage loss only counts their steps. Past the end of 
+            its target a row's output is log(1e-31) ("dense"), the target's padding ("ids"), and its attention weights are 0.
+        """
         
         src, src_lengths, src_masks = x_tuple[0], x_tuple[1], x_tuple[2]
         tgt, tgt_lengths, tgt_masks = y_tuple[0], y_tuple[1], y_tuple[2]
@@ -58,36 +84,87 @@ class Decoder(nn.Module):
        
         
         dec_states = (dec_states[0].contiguous(), dec_states[1].contiguous())
-        output = torch.zeros(batch_size,dec_seq_len-1,self.vocab_size).to(self.device)
+        nll = None if ignore_index is None else 0
+        
+        # sort the rows by target length, longest first, so the rows still active at step i are the first n_active[i];
+        # the per-row tensors below are cut to that prefix as rows finish, output and attention_weights keep all rows
+        length_order = None
+        if tgt_lengths is not None:
+            sorted_lengths, length_order = torch.sort(tgt_lengths.to(tgt.device), descending=True)
+            if bool((length_order == torch.arange(batch_size, device=length_order.device)).all()): # already sorted
+                length_order = None
+            else:
+                src, src_masks, tgt, enc_output = src[length_order], src_masks[length_order], tgt[length_order], enc_output[length_order]
+                dec_states = (dec_states[0][:, length_order].contiguous(), dec_states[1][:, length_order].contiguous())
+            n_active = (sorted_lengths.unsqueeze(0) - 1 > torch.arange(dec_seq_len-1, device=tgt.device).unsqueeze(1)).sum(1).tolist()
+        else:
+            n_active = [batch_size] * (dec_seq_len-1)
+        sparse = output_type != "dense"
+        vocab_coverage = self.attention.coverage == "vocab"
+        if sparse and vocab_coverage:
+            # first_occurrence[b, j] is 1 for a single position j of each distinct src[b, j] (the first one of its run in 
+            # sorted order), so that summing over source positions counts each vocab entry once (as in the dense coverage 
+            # loss); the terms summed are the same for all positions of an entry, so which one is kept does not matter
+            sorted_src, order = torch.sort(src, dim=1)
+            first_sorted = torch.ones_like(sorted_src, dtype=enc_output.dtype)
+            first_sorted[:, 1:] = (sorted_src[:, 1:] != sorted_src[:, :-1]).to(enc_output.dtype)
+            first_occurrence = torch.zeros_like(first_sorted).scatter_(1, order, first_sorted) # [batch_size, enc_seq_len]
+        if output_type == "dense":
+            output = enc_output.new_zeros((batch_size,dec_seq_len-1,self.vocab_size))
+        elif output_type == "ids": # positions past the end of a target keep its padding
+            output = tgt[:, 1:].clone()
+        else:
+            output = None
         #output.requires_grad=False
-        coverage = torch.zeros(batch_size, self.vocab_size).to(self.device)
+        if output_type is not None: # scattering the attention into the vocab starts from these zeros at every step
+            vocab_zeros = enc_output.new_zeros((batch_size, self.vocab_size))
+        if vocab_coverage:
+            coverage = enc_output.new_zeros((batch_size, self.vocab_size))
+        else:
+            coverage = enc_output.new_zeros((batch_size, enc_seq_len))
         coverage_loss = 0
         
         attention_weights = enc_output.new_zeros((batch_size, dec_seq_len-1, enc_seq_len), requires_grad = False) 
         
+        # project the encoder output once for the whole batch, the steps below only project the query
+        self.attention.precompute(enc_output, src_masks)
+        # the same for the embeddings of the teacher forced inputs
+        tgt_embeddings = self._embed_target(tgt)
+        n = batch_size
+
         # Loop over the rest of tokens in the tgt dec_seq_len.
         for i in range(0, dec_seq_len-1):
+            if n_active[i] == 0:
+                break
+            if n_active[i] < n: # drop the rows whose target is over, they are last
+                n = n_active[i]
+                src, src_masks, tgt, enc_output, coverage = src[:n], src_masks[:n], tgt[:n], enc_output[:n], coverage[:n]
+                dec_states = (dec_states[0][:, :n].contiguous(), dec_states[1][:, :n].contiguous())
+                if sparse and vocab_coverage:
+                    first_occurrence = first_occurrence[:n]
             # Calculate the context vector at step i.
-            # context_vector is [batch_size, encoder_size], attention_weights is [batch_size, enc_seq_len, 1], coverage is [batch_size, vocab_size]
+            # context_vector is [batch_size, encoder_size], attention_weights is [batch_size, enc_seq_len, 1], coverage is [batch_size, vocab_size] (or [batch_size, enc_seq_len])
             context_vector, step_attention_weights  = self.attention(state_h=dec_states[0], enc_output=enc_output, coverage=coverage, mask=src_masks)
             
+            if not vocab_coverage: # coverage loss and next coverage per source position, both are [batch_size, enc_seq_len]
+                coverage_loss = coverage_loss + torch.sum(torch.min(step_attention_weights.squeeze(2), coverage))/batch_size
+                coverage = coverage + step_attention_weights.squeeze(2)
+            
             # save the tensor format [batch_size, dec_seq_len, enc_seq_len]
-            attention_weights[:, i, :] = step_attention_weights.squeeze(2)
+            attention_weights[:n, i, :] = step_attention_weights.squeeze(2)
             
             if np.random.uniform(0, 1) < teacher_forcing_ratio or i is 0:
-                # Concatenates the i-th embedding of the tgt with the corresponding  context vector over the second
-                # dimensions. Transforms the 2-D tensor to 3-D sequence tensor with length 1. [batch_size, emb_dim] +
-                # [batch_size, hidden_dim * num_layers] -> [batch_size, 1, emb_dim + hidden_dim * num_layers].                        
-                prev_output_embeddings = self.dropout(self.embedding(tgt[:, i]))               
+                # The i-th embedding of the tgt, already computed. [batch_size, emb_dim]
+                prev_output_embeddings = tgt_embeddings[:n, i]
             else:
                 # Calculates the embeddings of the previous output. Counts the argmax over the last third dimension and
                 # then squeezes the second dimension, the sequence length. [batch_size, emb_dim].
-                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(vocab_logits, dim=2), dim=1)))
+                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(vocab_logits[:n], dim=2), dim=1)))
                 
             # Concatenates the (i-1)-th embedding of the previous output with the corresponding  context vector over the second
             # dimensions. Transforms the 2-D tensor to 3-D sequence tensor with length 1. [batch_size, emb_dim] +
             # [batch_size, hidden_dim * num_layers] -> [batch_size, 1, emb_dim + hidden_dim * num_layers].
-            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).reshape(batch_size, 1, -1)
+            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).unsqueeze(1)
 
             # Calculates the i-th decoder output and state. We initialize the decoder state with (i-1)-th state.
             # [batch_size, 1, hidden_dim], [num_layers, batch_size, hidden_dim].
@@ -98,9 +175,8 @@ class Decoder(nn.Module):
             lin_input = torch.cat( (dec_output, context_vector.unsqueeze(1), prev_output_embeddings.unsqueeze(1)) , dim = 2)
             lin_output = self.output_linear(lin_input) #lin_output = self.output_linear(dec_output)    
             
-            # vocab_dist is the softmaxed dist of the output of the generator, and is [batch_size, vocab_size]
+            # vocab_logits are the logits of the generator, and are [batch_size, 1, vocab_size]
             vocab_logits = self.vocab_linear(torch.tanh(lin_output))
-            vocab_dist = torch.softmax(vocab_logits.squeeze(1), dim=1)
             
             # Calculate p_gen -> [batch_size, 1]
             """p_gen = self.context_linear(context_vector) + \
@@ -113,24 +189,54 @@ class Decoder(nn.Module):
             # dec_states[-1][1] is [batch_size, decoder_size]
             # prev_output_embeddings is [batch_size, emb_dim]            
             p_gen_input = torch.cat( (context_vector, dec_states[-1][0], dec_states[-1][1], prev_output_embeddings) , dim = 1)
-            p_gen = torch.sigmoid(self.p_gen_linear(p_gen_input)) 
+            p_gen_logits = self.p_gen_linear(p_gen_input) # [batch_size, 1]
+            
+            if sparse:
+                if ignore_index is not None:
+                    # log p(y) = log( p_gen * vocab_dist[y] + (1-p_gen) * sum of attention on the source positions holding y )
+                    next_tgt = tgt[:, i+1] # [batch_size]
+                    step_vocab_logits = vocab_logits.squeeze(1)
+                    gen_log_prob = step_vocab_logits.gather(1, next_tgt.unsqueeze(1)).squeeze(1) - torch.logsumexp(step_vocab_logits, dim=1)
+                    copy_prob = (step_attention_weights.squeeze(2) * (src == next_tgt.unsqueeze(1)).to(enc_output.dtype)).sum(dim=1)
+                    gold_log_prob = torch.logaddexp(F.logsigmoid(p_gen_logits).squeeze(1) + gen_log_prob, 
+                        F.logsigmoid(-p_gen_logits).squeeze(1) + torch.log(copy_prob + 1e-31))
+                    nll = nll - (gold_log_prob * (next_tgt != ignore_index).to(gold_log_prob.dtype)).sum()
+                
+                if output_type == "ids": # the prediction needs the whole final distribution of this step, but not its history
+                    attention_dist = vocab_zeros[:n].scatter_add(1, src, step_attention_weights.squeeze(2))
+                    p_gen = torch.sigmoid(p_gen_logits)
+                    output[:n, i] = torch.argmax(p_gen * torch.softmax(vocab_logits.squeeze(1), dim=1) + (1-p_gen) * attention_dist, dim=1)
+                
+                if vocab_coverage: # the attention given to each vocab entry is read back at the source positions from the next coverage
+                    next_coverage = coverage.scatter_add(1, src, step_attention_weights.squeeze(2))
+                    coverage_at_src = coverage.gather(1, src)
+                    attention_at_src = next_coverage.gather(1, src) - coverage_at_src
+                    coverage_loss = coverage_loss + torch.sum(first_occurrence * torch.min(attention_at_src, coverage_at_src))/batch_size
+                    coverage = next_coverage
+                continue
+            
+            p_gen = torch.sigmoid(p_gen_logits) 
+            vocab_dist = torch.softmax(vocab_logits.squeeze(1), dim=1) # [batch_size, vocab_size]
             
             # Calculate final distribution, final_dist will be [batch_size, vocab_size]
             # vocab_dist is [batch_size, vocab_size], step_attention_weights is [batch_size, enc_seq_len, 1], src is [batch_size, enc_seq_len] and contains indices
             # first, we must use step_attention_weights to get attention_dist to be [batch_size, vocab_size]
-            attention_dist = torch.zeros(batch_size, self.vocab_size).to(self.device)
-            attention_dist = attention_dist.scatter_add(1, src, step_attention_weights.squeeze(2))
+            attention_dist = vocab_zeros[:n].scatter_add(1, src, step_attention_weights.squeeze(2))
             
             #print("Step {}, \tp_gen is {:.4f}\t, y is {}, generated: {}".format(i, p_gen[0].item(), tgt[0, i].item(), torch.argmax(vocab_logits, dim=2)[0].item()))
             final_dist = p_gen * vocab_dist + (1-p_gen) * attention_dist
             
             # Adds the current output to the final output. 
             #output = torch.cat((output, lin_output), dim=1)            
-            output[:,i,:] = final_dist #softmax_output.squeeze(1)
+            output[:n,i,:] = final_dist #softmax_output.squeeze(1)
+            if ignore_index is not None:
+                next_tgt = tgt[:, i+1] # [batch_size]
+                nll = nll - (torch.log(final_dist.gather(1, next_tgt.unsqueeze(1)).squeeze(1) + 1e-31) * (next_tgt != ignore_index).to(final_dist.dtype)).sum()
             
                        
             # update coverage loss, both are [batch_size, vocab_size]
-            coverage_loss = coverage_loss + torch.sum(torch.min(attention_dist, coverage))/batch_size
+            if vocab_coverage:
+                coverage_loss = coverage_loss + torch.sum(torch.min(attention_dist, coverage))/batch_size
                       
             
             #print("Step {}, coverage:  {}, cov_loss {}".format(i, torch.sum(coverage), coverage_loss))
@@ -139,9 +245,88 @@ class Decoder(nn.Module):
             #    print("{} - {}\t min={}".format(coverage[0][q], attention_dist[0][q], torch.min(coverage[0][q], attention_dist[0][q])))
             
             # calculate the next coverage by adding step_attention_weights where appropriate                        
-            coverage = coverage.scatter_add(1, src, step_attention_weights.squeeze(2))
+            if vocab_coverage:
+                coverage = coverage.scatter_add(1, src, step_attention_weights.squeeze(2))
             
-        # output is a tensor [batch_size, dec_seq_len, vocab_size], log-ged to be prepared for NLLLoss 
+        self.attention.clear()
+        if length_order is not None: # back to the order of the batch
+            inverse = torch.argsort(length_order)
+            attention_weights = attention_weights[inverse]
+            if output is not None:
+                output = output[inverse]
+        # output is a tensor [batch_size, dec_seq_len, vocab_size], log-ged to be prepared for NLLLoss (or the argmax ids, or None)
         # attention_weights is a tensor [batch_size, dec_seq_len, enc_seq_len] elements 
         # coverage_loss is a scalar tensor        
-        return {'output':torch.log(output + 1e-31), 'attention_weights':attention_weights, 'coverage_loss':coverage_loss}
+        # nll is the summed negative log-likelihood of tgt[:, 1:] (a scalar tensor), or None
+        if output_type == "dense":
+            output = torch.log(output + 1e-31)
+        return {'output':output, 'attention_weights':attention_weights, 'coverage_loss':coverage_loss, 'nll':nll}
+
+    def init_state(self, x_tuple, enc_output, dec_states):
+        """
+            The state of step by step decoding (see step and EncoderDecoder.generate) of the batch x_tuple, whose encoder 
+            output is enc_output, starting from dec_states: besides the LSTM states, the source ids the pointer copies 
+            from and the coverage. Its tensors have one row per decoded sequence.
+        """
+        src, src_masks = x_tuple[0], x_tuple[2]
+        self.attention.precompute(enc_output, src_masks)
+        if self.attention.coverage == "vocab":
+            coverage = enc_output.new_zeros((src.size(0), self.vocab_size))
+        else:
+            coverage = enc_output.new_zeros((src.size(0), src.size(1)))
+        return {"dec_states": (dec_states[0].contiguous(), dec_states[1].contiguous()), "enc_output": enc_output, 
+            "mask": src_masks, "src": src, "coverage": coverage}
+
+    def step(self, prev_tokens, state):
+        """
+            One decoding step, the same computation as a step of forward.
+
+            Args:
+                prev_tokens (tensor): The previous output of each row (BOS at the first step). Shape: [n].
+                state (dict): See init_state.
+
+            Returns:
+                The log of the final distribution of the next token [n, vocab_size] and the next state.
+        """
+        V, energy_keys, _ = self.attention._cached(state["enc_output"], prev_tokens.size(0))
+        log_probs, dec_states, coverage = self._step(prev_tokens, state["dec_states"], state["coverage"], V, energy_keys, state["mask"], state["src"])
+        return log_probs, dict(state, dec_states=dec_states, coverage=coverage)
+
+    def _step(self, prev_tokens, dec_states, coverage, V, energy_keys, mask, src):
+        """
+            step on plain tensors, with the projections of the encoder output (see SummaryCoverageAttention.project) 
+            instead of the cache, so it can be traced (see models/util/export.py). Returns the log of the final 
+            distribution [n, vocab_size], the next LSTM states and the next coverage.
+        """
+        context_vector, step_attention_weights = self.attention.attend(V, energy_keys, dec_states[0], coverage, mask)
+        step_attention_weights = step_attention_weights.squeeze(2) # [n, enc_seq_len]
+        
+        prev_output_embeddings = self.dropout(self.embedding(prev_tokens)) # [n, emb_dim]
+        lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).unsqueeze(1)
+        dec_output, dec_states = self.lstm(lstm_input, dec_states)
+        lin_input = torch.cat( (dec_output.squeeze(1), context_vector, prev_output_embeddings) , dim = 1)
+        vocab_logits = self.vocab_linear(torch.tanh(self.output_linear(lin_input))) # [n, vocab_size]
+        p_gen_input = torch.cat( (context_vector, dec_states[-1][0], dec_states[-1][1], prev_output_embeddings) , dim = 1)
+        p_gen = torch.sigmoid(self.p_gen_linear(p_gen_input)) # [n, 1]
+        
+        # log( p_gen * vocab_dist + (1-p_gen) * attention_dist ), as the dense output of forward
+        attention_dist = coverage.new_zeros((src.size(0), self.vocab_size)).scatter_add(1, src, step_attention_weights)
+        log_probs = torch.log(p_gen * torch.softmax(vocab_logits, dim=1) + (1 - p_gen) * attention_dist + 1e-31)
+        
+        if self.attention.coverage == "vocab":
+            coverage = coverage.scatter_add(1, src, step_attention_weights)
+        else:
+            coverage = coverage + step_attention_weights
+        return log_probs, dec_states, coverage
+
+    def reorder_state(self, state, index, same_inputs=False):
+        """
+            Keeps the rows index (int64, repeats allowed) of state. If same_inputs, index only moves rows between 
+            decodings of the same input (beam search), so only the LSTM states and the coverage are reordered.
+        """
+        state = dict(state, dec_states=(state["dec_states"][0].index_select(1, index), state["dec_states"][1].index_select(1, index)),
+            coverage=state["coverage"].index_select(0, index))
+        state["enc_output"] = self.attention.select(index, cache=not same_inputs)
+        if not same_inputs:
+            state["mask"], state["src"] = state["mask"].index_select(0, index), state["src"].index_select(0, index)
+        return state
@@ -0,0 +1,218 @@
+import sys
+sys.path.insert(0, '../../..')
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.components.attention.Attention import Attention
+
+class Decoder(nn.Module):
+    def __init__(self, emb_dim, input_size, hidden_dim, num_layers, vocab_size, lstm_dropout, dropout, attention_type, device):
+        """
+            Creates a Decoder with Luong-style attention, see https://arxiv.org/pdf/1508.04025.pdf: the attention is
+            applied on the LSTM's output (no input feeding, the context does not go back into the LSTM). The LSTM input
+            at a step then only depends on the previous token, so with teacher forcing on every step the whole target
+            runs through one nn.LSTM call and one batched attention matmul. Scheduled sampling and inference decode
+            step by step.
+
+            attention_type must be one of the types whose compatibility function is a matmul of the queries with the
+            keys ("dot", "multiplicative", "scaled dot", "scaled multiplicative", "general", "bilinear").
+        """
+        super().__init__()
+        assert attention_type in ["dot", "multiplicative", "scaled dot", "scaled multiplicative", "general", "bilinear"], \
+            "Luong attention needs a matmul compatibility function (got type={})".format(attention_type)
+
+        self.emb_dim = emb_dim
+        self.num_layers = num_layers
+        self.hidden_dim = hidden_dim
+        self.vocab_size = vocab_size
+        self.encoder_size = input_size
+        self.decoder_size = hidden_dim
+
+        self.embedding = nn.Embedding(vocab_size, emb_dim)
+        self.dropout = nn.Dropout(dropout)
+        self.lstm = nn.LSTM(emb_dim, hidden_dim, num_layers, dropout=lstm_dropout, batch_first=True)
+        self.attention = Attention(encoder_size=input_size, decoder_size=hidden_dim, device=device, type=attention_type)
+
+        # the context from the attention is added to the output layer, as in LSTMDecoder_Att
+        intermediate_size = int( ((hidden_dim+input_size+emb_dim) + vocab_size) * 2 )
+        self.output_linear = nn.Linear(hidden_dim+input_size+emb_dim, intermediate_size)
+        self.softmax_linear = nn.Linear(intermediate_size, vocab_size)
+
+        self.device = device
+        self.to(device)
+
+    def _attend(self, dec_output, enc_output, mask):
+        """
+            Attention of every decoder output on the encoder output, for any number of steps at once.
+
+            Args:
+                dec_output (tensor): The output of the LSTM's last layer. Shape: [batch_size, steps, decoder_size].
+                enc_output (tensor): Shape: [batch_size, seq_len_enc, encoder_size], a prefix of the precomputed one.
+                mask (tensor): 1 and 0 as for encoder input. Shape: [batch_size, seq_len_enc].
+
+            Returns:
+                context (tensor): Shape: [batch_size, steps, encoder_size]
+                attention_weights (tensor): Shape: [batch_size, steps, seq_len_enc]
+        """
+        V, energy_keys, _ = self.attention._cached(enc_output, dec_output.size(0)) # [batch_size, seq_len_enc, encoder_size] x2
+        Q = self.attention.query_annotation_function(dec_output) # [batch_size, steps, encoder_size]
+        energy = self.attention._energy(energy_keys, Q).transpose(1, 2) # [batch_size, steps, seq_len_enc]
+        energy = energy.masked_fill(mask.unsqueeze(1) == 0, -np.inf)
+        attention_weights = torch.softmax(energy, dim=2)
+        context = torch.bmm(attention_weights, V) # [batch_size, steps, encoder_size]
+        return context, attention_weights
+
+    def _logits(self, dec_output, context, prev_output_embeddings): # [batch_size, steps, ...] -> [batch_size, steps, vocab_size]
+        lin_input = torch.cat( (dec_output, context, prev_output_embeddings) , dim = 2)
+        return self.softmax_linear(torch.tanh(self.output_linear(lin_input)))
+
+    def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=None, output_type="dense"):
+        """
+            Same interface and outputs as LSTMDecoder_Att.
+
+            Args:
+                ignore_index (int): If not None, the summed cross-entropy of the logits with input[:, 1:] is computed
+                    (skipping targets equal to ignore_index) and returned as 'nll'.
+                output_type (string): "dense" returns the logits [batch_size, seq_len_dec-1, vocab_size], "ids" only their
+                    argmax [batch_size, seq_len_dec-1] (int64), None nothing.
+
+            Past the end of its target (input_lengths, BOS and EOS included) a row's output is 0 ("dense"), the target's
+            padding ("ids"), and its attention weights are 0. Stepwise, those rows are not decoded at all.
+        """
+        input, input_lengths = y_tuple[0], y_tuple[1]
+        encoder_mask = x_tuple[2]
+
+        batch_size = input.shape[0]
+        seq_len_enc = x_tuple[0].size(1)
+        seq_len_dec = input.shape[1]
+
+        dec_states = (dec_states[0].contiguous(), dec_states[1].contiguous())
+
+        if teacher_forcing_ratio >= 1.:
+            return self._forward_teacher_forced(input, input_lengths, encoder_mask, enc_output, dec_states, ignore_index, output_type)
+
+        nll = None if ignore_index is None else 0
+
+        # sort the rows by target length, longest first, so the rows still active at step i are the first n_active[i]
+        length_order = None
+        if input_lengths is not None:
+            sorted_lengths, length_order = torch.sort(input_lengths.to(input.device), descending=True)
+            if bool((length_order == torch.arange(batch_size, device=length_order.device)).all()): # already sorted
+                length_order = None
+            else:
+                input, encoder_mask, enc_output = input[length_order], encoder_mask[length_order], enc_output[length_order]
+                dec_states = (dec_states[0][:, length_order].contiguous(), dec_states[1][:, length_order].contiguous())
+            n_active = (sorted_lengths.unsqueeze(0) - 1 > torch.arange(seq_len_dec-1, device=input.device).unsqueeze(1)).sum(1).tolist()
+        else:
+            n_active = [batch_size] * (seq_len_dec-1)
+
+        if output_type == "dense":
+            output = enc_output.new_zeros((batch_size,seq_len_dec-1,self.vocab_size), requires_grad = False)
+        elif output_type == "ids": # positions past the end of a target keep its padding
+            output = input[:, 1:].clone()
+        else:
+            output = None
+
+        attention_weights = enc_output.new_zeros((batch_size, seq_len_dec-1, seq_len_enc), requires_grad = False)
+
+        # project the encoder output once for the whole batch, the steps below only project the query
+        self.attention.precompute(enc_output, encoder_mask)
+        n = batch_size
+
+        # Loop over the rest of tokens in the input seq_len_dec.
+        for i in range(0, seq_len_dec-1):
+            if n_active[i] == 0:
+                break
+            if n_active[i] < n: # drop the rows whose target is over, they are last
+                n = n_active[i]
+                dec_states = (dec_states[0][:, :n].contiguous(), dec_states[1][:, :n].contiguous())
+
+            if np.random.uniform(0, 1) < teacher_forcing_ratio or i == 0:
+                prev_output_embeddings = self.dropout(self.embedding(input[:n, i:i+1])) # [n, 1, emb_dim]
+            else:
+                prev_output_embeddings = self.dropout(self.embedding(torch.argmax(logits[:n], dim=2))) # [n, 1, emb_dim]
+
+            # the i-th decoder output, then its attention. [n, 1, hidden_dim], [n, 1, encoder_size]
+            dec_output, dec_states = self.lstm(prev_output_embeddings, dec_states)
+            context, step_attention_weights = self._attend(dec_output, enc_output[:n], encoder_mask[:n])
+            attention_weights[:n, i, :] = step_attention_weights.squeeze(1)
+
+            logits = self._logits(dec_output, context, prev_output_embeddings) # [n, 1, vocab_size]
+            if output_type == "dense":
+                output[:n,i,:] = logits.squeeze(1)
+            elif output_type == "ids":
+                output[:n,i] = torch.argmax(logits.squeeze(1), dim=1)
+
+            if ignore_index is not None:
+                nll = nll + F.cross_entropy(logits.squeeze(1), input[:n, i+1], ignore_index=ignore_index, reduction='sum')
+
+        self.attention.clear()
+        if length_order is not None: # back to the order of the batch
+            inverse = torch.argsort(length_order)
+            attention_weights = attention_weights[inverse]
+            if output is not None:
+                output = output[inverse]
+        return {'output':output, 'attention_weights':attention_weights, 'nll':nll}
+
+    def _forward_teacher_forced(self, input, input_lengths, encoder_mask, enc_output, dec_states, ignore_index, output_type):
+        """
+            All steps at once: the LSTM runs on the embeddings of input[:, :-1], then every output attends on the encoder
+            output in one matmul. Positions past the end of a target are computed and then blanked.
+        """
+        self.attention.precompute(enc_output, encoder_mask)
+        prev_output_embeddings = self.dropout(self.embedding(input[:, :-1])) # [batch_size, seq_len_dec-1, emb_dim]
+        dec_output, dec_states = self.lstm(prev_output_embeddings, dec_states) # [batch_size, seq_len_dec-1, hidden_dim]
+        context, attention_weights = self._attend(dec_output, enc_output, encoder_mask) # [batch_size, seq_len_dec-1, ...]
+        logits = self._logits(dec_output, context, prev_output_embeddings) # [batch_size, seq_len_dec-1, vocab_size]
+        self.attention.clear()
+
+        nll = None
+        if ignore_index is not None:
+            nll = F.cross_entropy(logits.reshape(-1, self.vocab_size), input[:, 1:].reshape(-1), ignore_index=ignore_index, reduction='sum')
+
+        if input_lengths is not None: # [batch_size, seq_len_dec-1], 1 while the target is not over
+            active = torch.arange(input.size(1)-1, device=input.device).unsqueeze(0) < (input_lengths.to(input.device) - 1).unsqueeze(1)
+        else:
+            active = torch.ones_like(input[:, 1:], dtype=torch.bool)
+        attention_weights = attention_weights * active.unsqueeze(2).to(attention_weights.dtype)
+        if output_type == "dense":
+            output = logits * active.unsqueeze(2).to(logits.dtype)
+        elif output_type == "ids":
+            output = torch.where(active, torch.argmax(logits, dim=2), input[:, 1:])
+        else:
+            output = None
+        return {'output':output, 'attention_weights':attention_weights, 'nll':nll}
+
+    def init_state(self, x_tuple, enc_output, dec_states):
+        """
+            The state of step by step decoding (see step and EncoderDecoder.generate) of the batch x_tuple, whose encoder 
+            output is enc_output, starting from dec_states. Its tensors have one row per decoded sequence.
+        """
+        self.attention.precompute(enc_output, x_tuple[2])
+        return {"dec_states": (dec_states[0].contiguous(), dec_states[1].contiguous()), "enc_output": enc_output, "mask": x_tuple[2]}
+
+    def step(self, prev_tokens, state):
+        """
+            One decoding step from prev_tokens [n] (BOS at the first step). Returns the log-probabilities of the next 
+            token [n, vocab_size] and the next state.
+        """
+        prev_output_embeddings = self.dropout(self.embedding(prev_tokens.unsqueeze(1))) # [n, 1, emb_dim]
+        dec_output, dec_states = self.lstm(prev_output_embeddings, state["dec_states"])
+        context, _ = self._attend(dec_output, state["enc_output"], state["mask"])
+        logits = self._logits(dec_output, context, prev_output_embeddings).squeeze(1) # [n, vocab_size]
+        return torch.log_softmax(logits, dim=1), dict(state, dec_states=dec_states)
+
+    def reorder_state(self, state, index, same_inputs=False):
+        """
+            Keeps the rows index (int64, repeats allowed) of state. If same_inputs, index only moves rows between 
+            decodings of the same input (beam search), so the rows of the encoder output and its projections stay.
+        """
+        state = dict(state, dec_states=(state["dec_states"][0].index_select(1, index), state["dec_states"][1].index_select(1, index)))
+        state["enc_output"] = self.attention.select(index, cache=not same_inputs)
+        if not same_inputs:
+            state["mask"] = state["mask"].index_select(0, index)
+        return state
@@ -48,6 +48,11 @@ class Decoder(nn.Module):
         self.to(device)
 
     def forward(self, x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio):
+        """
+            Rows stop being decoded once their target (tgt_lengths, BOS and EOS included) is over: each step runs on the 
+            rows still active only, like packed sequences. Past the end of its target a row's output is log(1e-31) and 
+            its attention weights are 0.
+        """
         
         src, src_lengths, src_masks = x_tuple[0], x_tuple[1], x_tuple[2]
         tgt, tgt_lengths, tgt_masks = y_tuple[0], y_tuple[1], y_tuple[2]
@@ -55,23 +60,47 @@ class Decoder(nn.Module):
         batch_size = tgt.shape[0]
         src_seq_len = src.shape[1]
         seq_len_dec = tgt.shape[1]        
-        attention_weights = []
+        attention_weights = enc_output.new_zeros((batch_size, seq_len_dec-1, src_seq_len), requires_grad = False)
         
         dec_states = (dec_states[0].contiguous(), dec_states[1].contiguous())
+        
+        # sort the rows by target length, longest first, so the rows still active at step i are the first n_active[i]
+        length_order = None
+        if tgt_lengths is not None:
+            sorted_lengths, length_order = torch.sort(tgt_lengths.to(tgt.device), descending=True)
+            if bool((length_order == torch.arange(batch_size, device=length_order.device)).all()): # already sorted
+                length_order = None
+            else:
+                src, src_masks, tgt, enc_output = src[length_order], src_masks[length_order], tgt[length_order], enc_output[length_order]
+                dec_states = (dec_states[0][:, length_order].contiguous(), dec_states[1][:, length_order].contiguous())
+            n_active = (sorted_lengths.unsqueeze(0) - 1 > torch.arange(seq_len_dec-1, device=tgt.device).unsqueeze(1)).sum(1).tolist()
+        else:
+            n_active = [batch_size] * (seq_len_dec-1)
         output = torch.zeros(batch_size,seq_len_dec-1,self.vocab_size).to(self.device)
         #output.requires_grad=False
         coverage = torch.zeros(batch_size, self.vocab_size).to(self.device)
         coverage_loss = 0
         
+        # project the encoder output once for the whole batch, the steps below only project the query
+        self.attention.precompute(enc_output, src_masks)
+        n = batch_size
+
         # Loop over the rest of tokens in the tgt seq_len_dec.
         for i in range(0, seq_len_dec-1):
+            if n_active[i] == 0:
+                break
+            if n_active[i] < n: # drop the rows whose target is over, they are last
+                n = n_active[i]
+                src, src_masks, tgt, enc_output, coverage = src[:n], src_masks[:n], tgt[:n], enc_output[:n], coverage[:n]
+                dec_states = (dec_states[0][:, :n].contiguous(), dec_states[1][:, :n].contiguous())
+            
             # Calculate the context vector at step i.
             # context_vector is [batch_size, encoder_size], attention_weights is [batch_size, src_seq_len, 1], coverage is [batch_size, vocab_size]
             context_vector, step_attention_weights  = self.attention(state_h=dec_states[0], enc_output=enc_output, coverage=coverage, mask=src_masks)
             
             
-            # save attention weights incrementally
-            attention_weights.append(step_attention_weights.squeeze(2).cpu().tolist())
+            # save the tensor format [batch_size, dec_seq_len, enc_seq_len]
+            attention_weights[:n, i, :] = step_attention_weights.squeeze(2)
             
             if np.random.uniform(0, 1) < teacher_forcing_ratio or i is 0:
                 # Concatenates the i-th embedding of the tgt with the corresponding  context vector over the second
@@ -81,12 +110,12 @@ class Decoder(nn.Module):
             else:
                 # Calculates the embeddings of the previous output. Counts the argmax over the last third dimension and
                 # then squeezes the second dimension, the sequence length. [batch_size, emb_dim].
-                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(vocab_logits, dim=2), dim=1)))
+                prev_output_embeddings = self.dropout(self.embedding(torch.squeeze(torch.argmax(vocab_logits[:n], dim=2), dim=1)))
                 
             # Concatenates the (i-1)-th embedding of the previous output with the corresponding  context vector over the second
             # dimensions. Transforms the 2-D tensor to 3-D sequence tensor with length 1. [batch_size, emb_dim] +
             # [batch_size, hidden_dim * num_layers] -> [batch_size, 1, emb_dim + hidden_dim * num_layers].
-            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).reshape(batch_size, 1, -1)
+            lstm_input = torch.cat((prev_output_embeddings, context_vector), dim=1).reshape(n, 1, -1)
 
             # Calculates the i-th decoder output and state. We initialize the decoder state with (i-1)-th state.
             # [batch_size, 1, hidden_dim], [num_layers, batch_size, hidden_dim].
@@ -117,7 +146,7 @@ class Decoder(nn.Module):
             # Calculate final distribution, final_dist will be [batch_size, vocab_size]
             # vocab_dist is [batch_size, vocab_size], step_attention_weights is [batch_size, src_seq_len, 1], src is [batch_size, src_seq_len] and contains indices
             # first, we must use step_attention_weights to get attention_dist to be [batch_size, vocab_size]
-            attention_dist = torch.zeros(batch_size, self.vocab_size).to(self.device)
+            attention_dist = torch.zeros(n, self.vocab_size).to(self.device)
             attention_dist = attention_dist.scatter_add(1, src, step_attention_weights.squeeze(2))
             
             #print("Step {}, \tp_gen is {:.4f}\t, y is {}, generated: {}".format(i, p_gen[0].item(), tgt[0, i].item(), torch.argmax(vocab_logits, dim=2)[0].item()))
@@ -125,7 +154,7 @@ class Decoder(nn.Module):
             
             # Adds the current output to the final output. 
             #output = torch.cat((output, lin_output), dim=1)            
-            output[:,i,:] = final_dist #softmax_output.squeeze(1)
+            output[:n,i,:] = final_dist #softmax_output.squeeze(1)
             
                        
             # update coverage loss, both are [batch_size, vocab_size]
@@ -140,7 +169,12 @@ class Decoder(nn.Module):
             # calculate the next coverage by adding step_attention_weights where appropriate                        
             coverage = coverage.scatter_add(1, src, step_attention_weights.squeeze(2))
             
+        self.attention.clear()
+        if length_order is not None: # back to the order of the batch
+            inverse = torch.argsort(length_order)
+            attention_weights = attention_weights[inverse]
+            output = output[inverse]
         # output is a tensor [batch_size, seq_len_dec, vocab_size], log-ged to be prepared for NLLLoss 
-        # attention_weights is a list of [batch_size, seq_len] elements, where each element is the softmax distribution for a timestep
+        # attention_weights is a tensor [batch_size, seq_len_dec, enc_seq_len]
         # coverage_loss is a scalar tensor
         return {'output':torch.log(output + 1e-31), 'attention_weights':attention_weights, 'coverage_loss':coverage_loss}
@@ -0,0 +1,60 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+import time
+import torch
+
+from models.components.decoders.LSTMDecoder_Att import Decoder as AttDecoder
+from models.components.decoders.LSTMDecoder_LuongAtt import Decoder as LuongDecoder
+
+"""
+    Training throughput (forward + backward of the summed nll) of LSTMDecoder_Att, which feeds the context into the LSTM
+    and so decodes step by step, versus LSTMDecoder_LuongAtt with teacher forcing on every step (one LSTM call) and with
+    scheduled sampling (step by step).
+
+    python benchmark_luong_decoder.py [batch_size] [seq_len_enc] [seq_len_dec] [vocab_size]
+"""
+
+def tokens_per_second(decoder, batch, teacher_forcing_ratio, repeats = 3, calls = 3):
+    x_tuple, y_tuple, enc_output, dec_states = batch
+    tokens = int((y_tuple[1] - 1).sum())
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            decoder.zero_grad()
+            nll = decoder(x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=0, output_type=None)["nll"]
+            nll.backward()
+        if enc_output.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return tokens / best
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seq_len_enc = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    seq_len_dec = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    vocab_size = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    emb_dim, enc_size, hidden_dim, num_layers = 300, 512, 512, 2
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    torch.manual_seed(0)
+    src = torch.randint(4, vocab_size, (batch_size, seq_len_enc), device=device)
+    src_mask = torch.ones(batch_size, seq_len_enc, dtype=torch.long, device=device)
+    tgt_lengths = torch.randint(seq_len_dec//4, seq_len_dec+1, (batch_size,), device=device)
+    tgt_lengths[0] = seq_len_dec
+    tgt = torch.randint(4, vocab_size, (batch_size, seq_len_dec), device=device)
+    tgt[torch.arange(seq_len_dec, device=device).unsqueeze(0) >= tgt_lengths.unsqueeze(1)] = 0
+    enc_output = torch.randn(batch_size, seq_len_enc, enc_size, device=device)
+    dec_states = (torch.randn(num_layers, batch_size, hidden_dim, device=device), torch.randn(num_layers, batch_size, hidden_dim, device=device))
+    batch = ((src, None, src_mask), (tgt, tgt_lengths, None), enc_output, dec_states)
+
+    att = AttDecoder(emb_dim, enc_size, hidden_dim, num_layers, vocab_size, 0., 0., "dot", device)
+    luong = LuongDecoder(emb_dim, enc_size, hidden_dim, num_layers, vocab_size, 0., 0., "dot", device)
+
+    print("batch_size={}, seq_len_enc={}, seq_len_dec={}, vocab_size={}, {} target tokens, {}".format(
+        batch_size, seq_len_enc, seq_len_dec, vocab_size, int((tgt_lengths - 1).sum()), device))
+    print("\tLSTMDecoder_Att, tf=1.0       : {:10.1f} tokens/s".format(tokens_per_second(att, batch, 1.)))
+    print("\tLSTMDecoder_LuongAtt, tf=1.0  : {:10.1f} tokens/s".format(tokens_per_second(luong, batch, 1.)))
+    print("\tLSTMDecoder_LuongAtt, tf=0.5  : {:10.1f} tokens/s".format(tokens_per_second(luong, batch, .5)))
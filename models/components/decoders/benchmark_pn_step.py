@@ -0,0 +1,85 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+import time
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    Profile of a LSTMDecoder_Att_PN_SumCov training step (forward + backward of nll + coverage_loss) with the previous
+    per-step embedding of the teacher forced inputs versus the current one, once per batch: time, aten::cat /
+    aten::embedding calls and allocator events as counted by torch.profiler.
+
+    python benchmark_pn_step.py [batch_size] [seq_len_enc] [seq_len_dec] [vocab_size]
+"""
+
+class PerStepEmbeddings():
+    # the previous embedding of the decoder inputs, kept here as the reference: one lookup (and dropout) per step
+    def __init__(self, decoder, tgt):
+        self.decoder, self.tgt = decoder, tgt
+
+    def __getitem__(self, index): # [rows, step] -> [rows, emb_dim]
+        return self.decoder.dropout(self.decoder.embedding(self.tgt[index]))
+
+class PerStepDecoder(Decoder):
+    def _embed_target(self, tgt):
+        return PerStepEmbeddings(self, tgt)
+
+def train_step(decoder, batch):
+    decoder.zero_grad()
+    x_tuple, y_tuple, enc_output, dec_states = batch
+    decoder_dict = decoder(x_tuple, y_tuple, enc_output, dec_states, 1., ignore_index=0, output_type=None)
+    (decoder_dict["nll"] + decoder_dict["coverage_loss"]).backward()
+
+def time_per_step(decoders, batch, repeats = 5):
+    # the decoders take turns, so that both see the same machine load
+    best = [None] * len(decoders)
+    for _ in range(repeats):
+        for j, decoder in enumerate(decoders):
+            start = time.perf_counter()
+            train_step(decoder, batch)
+            if batch[2].is_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            best[j] = elapsed if best[j] is None else min(best[j], elapsed)
+    return best
+
+def profile_counts(decoder, batch):
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if batch[2].is_cuda else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        train_step(decoder, batch)
+    counts = {event.key: event.count for event in prof.key_averages()}
+    return counts.get("aten::cat", 0), counts.get("aten::embedding", 0), counts.get("[memory]", 0)
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seq_len_enc = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    seq_len_dec = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    vocab_size = int(sys.argv[4]) if len(sys.argv) > 4 else 5000
+    emb_dim, enc_size, hidden_dim, num_layers = 300, 512, 512, 2
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    torch.manual_seed(0)
+    src = torch.randint(4, vocab_size, (batch_size, seq_len_enc), device=device)
+    src_mask = torch.ones(batch_size, seq_len_enc, dtype=torch.long, device=device)
+    tgt_lengths = torch.full((batch_size,), seq_len_dec, dtype=torch.long, device=device)
+    tgt = torch.randint(4, vocab_size, (batch_size, seq_len_dec), device=device)
+    enc_output = torch.randn(batch_size, seq_len_enc, enc_size, device=device)
+    dec_states = (torch.randn(num_layers, batch_size, hidden_dim, device=device), torch.randn(num_layers, batch_size, hidden_dim, device=device))
+    batch = ((src, None, src_mask), (tgt, tgt_lengths, None), enc_output, dec_states)
+
+    current = Decoder(emb_dim, enc_size, hidden_dim, num_layers, vocab_size, 0., 0., device, coverage="source")
+    per_step = PerStepDecoder(emb_dim, enc_size, hidden_dim, num_layers, vocab_size, 0., 0., device, coverage="source")
+    per_step.load_state_dict(current.state_dict())
+
+    print("batch_size={}, seq_len_enc={}, seq_len_dec={}, vocab_size={}, {}".format(batch_size, seq_len_enc, seq_len_dec, vocab_size, device))
+    names, decoders = ["per-step embeddings", "batch embeddings   "], [per_step, current]
+    counts = []
+    for decoder in decoders:
+        train_step(decoder, batch) # warm up
+        counts.append(profile_counts(decoder, batch))
+    times = time_per_step(decoders, batch)
+    for name, elapsed, (cats, embeddings, memory_events) in zip(names, times, counts):
+        print("\t{}: {:8.2f} ms/batch, {:4d} aten::cat, {:4d} aten::embedding, {:6d} allocator events".format(name, 1000*elapsed, cats, embeddings, memory_events))
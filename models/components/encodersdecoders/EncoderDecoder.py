@@ -2,6 +2,7 @@ import os, sys
 
 sys.path.insert(0, '../..')
 
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -22,6 +23,7 @@ class EncoderDecoder(nn.Module):
         self.src_eos_token_id = src_lookup.convert_tokens_to_ids(src_lookup.eos_token)
         self.tgt_bos_token_id = src_lookup.convert_tokens_to_ids(tgt_lookup.bos_token)
         self.tgt_eos_token_id = src_lookup.convert_tokens_to_ids(tgt_lookup.eos_token)
+        self.tgt_pad_token_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.pad_token)
     
         self.encoder = encoder       
         self.decoder = decoder
@@ -35,6 +37,239 @@ class EncoderDecoder(nn.Module):
     def run_batch(self, X_tuple, y_tuple, criterion=None, tf_ratio=.0, aux_loss_weight = 0.5):
         raise Exception("run_batch() not implemented")
 
+    def encode(self, x_tuple):
+        """
+        Runs the encoder on x_tuple, returns its output [batch_size, seq_len_enc, encoder_size] and the initial decoder 
+        states ( h=[dec_num_layers, batch_size, dec_hidden_dim], c=[same-as-h] ).
+        """
+        raise Exception("encode() not implemented")
+
+    @torch.no_grad()
+    def generate(self, x_tuple, beam_size=4, max_len=100, length_penalty=1.):
+        """
+        Beam search, vectorized over the batch and the beams: the encoder runs once per input, then each step decodes 
+        the beam_size hypotheses of all the inputs still being searched in one decoder step (decoder.step). Each step 
+        keeps the 2*beam_size best extensions per input; those ending in EOS within its first beam_size are finished, 
+        the best beam_size others go on, and the decoder state (LSTM states, coverage, ...) follows them with 
+        decoder.reorder_state. An input is done when beam_size of its hypotheses are finished, and is then dropped 
+        from the batch. At max_len the hypotheses still going are finished as they are.
+        
+        Finished hypotheses are ranked by their summed log-probability divided by length**length_penalty (the number 
+        of generated tokens, EOS included): 0 ranks by log-probability, which favours short outputs, 1 by the mean 
+        log-probability per token. beam_size=1 is greedy decoding up to EOS.
+        
+        Call model.eval() first, the decoder's dropout is not switched off here.
+
+        Args:
+            x_tuple: (x, x_lengths, x_mask) as for run_batch.
+            beam_size (int): Hypotheses kept per input.
+            max_len (int): The longest output, BOS and EOS included.
+            length_penalty (float): The exponent of the length normalization.
+
+        Returns:
+            output (tensor): The best hypothesis of each input, starting with BOS and ending with EOS (unless cut at 
+                max_len), padded with the pad id. Shape: [batch_size, seq_len], seq_len <= max_len.
+            scores (tensor): Their normalized scores. Shape: [batch_size].
+        """
+        if not hasattr(self.decoder, "step"):
+            raise Exception("generate() needs a decoder with step(), {} has none".format(type(self.decoder).__name__))
+        x_tuple = tuple(x_tuple)
+        batch_size, k = x_tuple[0].size(0), beam_size
+        device = x_tuple[0].device
+        
+        enc_output, dec_states = self.encode(x_tuple)
+        state = self.decoder.init_state(x_tuple, enc_output, dec_states)
+        # every input gets beam_size rows, the hypotheses of input b are the rows b*k ... b*k+k-1
+        state = self.decoder.reorder_state(state, torch.arange(batch_size, device=device).repeat_interleave(k))
+        
+        # only the first hypothesis of each input is alive at the start, the others would repeat its extensions
+        beam_scores = enc_output.new_full((batch_size, k), -np.inf)
+        beam_scores[:, 0] = 0.
+        hypotheses = torch.full((batch_size*k, 1), self.tgt_bos_token_id, dtype=torch.long, device=device)
+        inputs = torch.arange(batch_size, device=device) # the input of each row of beam_scores
+        
+        output = torch.full((batch_size, max_len), self.tgt_pad_token_id, dtype=torch.long, device=device)
+        output[:, 0] = self.tgt_bos_token_id
+        output_lengths = torch.ones(batch_size, dtype=torch.long, device=device)
+        scores = enc_output.new_full((batch_size,), -np.inf)
+        n_finished = torch.zeros(batch_size, dtype=torch.long, device=device)
+        candidate_positions = torch.arange(2*k, device=device).unsqueeze(0) # [1, 2*k]
+        
+        for i in range(max_len-1):
+            n = beam_scores.size(0)
+            log_probs, state = self.decoder.step(hypotheses[:, -1], state) # [n*k, vocab_size]
+            log_probs[:, [self.tgt_pad_token_id, self.tgt_bos_token_id]] = -np.inf # never generated
+            vocab_size = log_probs.size(1)
+            
+            # the 2*k best extensions of each input, at least k of them do not end in EOS (one EOS per hypothesis)
+            candidate_scores = (beam_scores.view(n*k, 1) + log_probs).view(n, k*vocab_size)
+            candidate_scores, candidates = candidate_scores.topk(2*k, dim=1) # [n, 2*k]
+            candidate_beams, candidate_tokens = torch.div(candidates, vocab_size, rounding_mode="floor"), candidates % vocab_size
+            candidate_rows = candidate_beams + (torch.arange(n, device=device) * k).unsqueeze(1) # rows of hypotheses
+            ends = candidate_tokens == self.tgt_eos_token_id
+            
+            # finish the extensions ending in EOS among the k best, keep the best one per input
+            finishing = ends & (candidate_positions < k)
+            normalized = (candidate_scores / float(i+1)**length_penalty).masked_fill(~finishing, -np.inf)
+            best_normalized, best_position = normalized.max(dim=1)
+            self._keep_best(output, output_lengths, scores, inputs, best_normalized, 
+                hypotheses, candidate_rows.gather(1, best_position.unsqueeze(1)).squeeze(1), True)
+            n_finished[inputs] += finishing.sum(dim=1)
+            
+            # the k best extensions not ending in EOS go on
+            keep = (ends.long() * (2*k) + candidate_positions).argsort(dim=1)[:, :k] # [n, k]
+            beam_scores = candidate_scores.gather(1, keep)
+            rows = candidate_rows.gather(1, keep).view(-1)
+            hypotheses = torch.cat((hypotheses.index_select(0, rows), candidate_tokens.gather(1, keep).view(-1, 1)), dim=1)
+            state = self.decoder.reorder_state(state, rows, same_inputs=True)
+            
+            if i == max_len-2: # out of steps, the best hypothesis still going is finished as it is
+                best_scores, best_beams = beam_scores.max(dim=1)
+                self._keep_best(output, output_lengths, scores, inputs, best_scores / float(i+1)**length_penalty, 
+                    hypotheses, best_beams + torch.arange(n, device=device) * k, False)
+                break
+            
+            # drop the inputs that are done
+            searching = n_finished[inputs] < k
+            if not bool(searching.all()):
+                if not bool(searching.any()):
+                    break
+                remaining = searching.nonzero().squeeze(1)
+                inputs, beam_scores = inputs[remaining], beam_scores[remaining]
+                rows = (remaining.unsqueeze(1) * k + torch.arange(k, device=device).unsqueeze(0)).view(-1)
+                hypotheses = hypotheses.index_select(0, rows)
+                state = self.decoder.reorder_state(state, rows)
+        
+        self.decoder.attention.clear()
+        return output[:, :int(output_lengths.max())], scores
+
+    @torch.no_grad()
+    def greedy_decode(self, x_tuple, max_len=100):
+        """
+        Free-running greedy decoding: each row feeds back its most likely token until it outputs EOS or max_len is 
+        reached, whatever the length of a target. A done mask marks the rows that output EOS; they are dropped from 
+        the decoder state (decoder.reorder_state), so the next steps only compute the logits of the rows still going, 
+        and the loop stops as soon as all rows are done. The same output as generate with beam_size=1, without the 
+        bookkeeping of the beams.
+        
+        Call model.eval() first, the decoder's dropout is not switched off here.
+
+        Args:
+            x_tuple: (x, x_lengths, x_mask) as for run_batch.
+            max_len (int): The longest output, BOS and EOS included.
+
+        Returns:
+            The output ids, starting with BOS and ending with EOS (unless cut at max_len), padded with the pad id. 
+                Shape: [batch_size, seq_len], seq_len <= max_len.
+        """
+        if not hasattr(self.decoder, "step"):
+            raise Exception("greedy_decode() needs a decoder with step(), {} has none".format(type(self.decoder).__name__))
+        x_tuple = tuple(x_tuple)
+        batch_size, device = x_tuple[0].size(0), x_tuple[0].device
+        
+        enc_output, dec_states = self.encode(x_tuple)
+        state = self.decoder.init_state(x_tuple, enc_output, dec_states)
+        
+        output = torch.full((batch_size, max_len), self.tgt_pad_token_id, dtype=torch.long, device=device)
+        output[:, 0] = self.tgt_bos_token_id
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        rows = torch.arange(batch_size, device=device) # the row of output of each row of the decoder state
+        prev_tokens, length = output[:, 0], 1
+        
+        for i in range(1, max_len):
+            log_probs, state = self.decoder.step(prev_tokens, state) # [n, vocab_size]
+            log_probs[:, [self.tgt_pad_token_id, self.tgt_bos_token_id]] = -np.inf # never generated
+            prev_tokens = log_probs.argmax(dim=1)
+            output[rows, i] = prev_tokens
+            done[rows] = prev_tokens == self.tgt_eos_token_id
+            length = i+1
+            
+            going = ~done[rows]
+            if not bool(going.all()):
+                if not bool(going.any()):
+                    break
+                going = going.nonzero().squeeze(1)
+                rows, prev_tokens = rows[going], prev_tokens[going]
+                state = self.decoder.reorder_state(state, going)
+        
+        self.decoder.attention.clear()
+        return output[:, :length]
+
+    def _keep_best(self, output, output_lengths, scores, inputs, new_scores, hypotheses, rows, add_eos):
+        """
+        For generate: where new_scores [n] beats scores of inputs [n], the hypothesis in rows [n] of hypotheses (then 
+        EOS, if add_eos) becomes the output of that input.
+        """
+        better = new_scores > scores[inputs]
+        if not bool(better.any()):
+            return
+        better_inputs = inputs[better]
+        best = hypotheses[rows[better]] # [n_better, length]
+        length = best.size(1)
+        output[better_inputs, 1:] = self.tgt_pad_token_id
+        output[better_inputs, :length] = best
+        if add_eos:
+            output[better_inputs, length] = self.tgt_eos_token_id
+            length += 1
+        output_lengths[better_inputs] = length
+        scores[better_inputs] = new_scores[better]
+
+    def _gold_ignore_index(self, criterion):
+        """
+        Returns the ignore_index of criterion if its loss can be computed from the log-probabilities of the gold tokens 
+        alone (mean NLL / cross-entropy without weights or label smoothing), otherwise None. SmoothedCrossEntropyLoss 
+        without smoothing is a plain CrossEntropyLoss. NLLLoss only qualifies if the decoder outputs log-probabilities 
+        (decoder.output_log_probs), on logits it is not the cross-entropy the decoder computes.
+        """
+        if hasattr(criterion, "label_smoothing") and hasattr(criterion, "criterion"): # SmoothedCrossEntropyLoss
+            if criterion.label_smoothing < 1.:
+                return None
+            criterion = criterion.criterion
+        if not isinstance(criterion, (nn.NLLLoss, nn.CrossEntropyLoss)):
+            return None
+        if isinstance(criterion, nn.NLLLoss) and not getattr(self.decoder, "output_log_probs", False):
+            return None
+        if criterion.reduction != "mean" or criterion.weight is not None or getattr(criterion, "label_smoothing", 0.) > 0.:
+            return None
+        return criterion.ignore_index
+
+    def _loss_mode(self, criterion, tf_ratio=0.):
+        """
+        Chooses what the decoder computes in run_batch, returns (ignore_index, output_type). If the criterion only needs 
+        the gold tokens, the decoder computes the loss step by step (ignore_index is not None) and keeps no output in 
+        training and only the argmax ids otherwise (predictions). The argmax of a decoding teacher forced on every step 
+        (tf_ratio >= 1) is not a prediction, so then no output is kept either (the dev loss, see trainer.train). Other 
+        criteria (eg. label smoothing) get the dense output.
+        """
+        if criterion is None:
+            return None, "ids"
+        ignore_index = self._gold_ignore_index(criterion)
+        if ignore_index is None:
+            return None, "dense"
+        return ignore_index, None if self.training or tf_ratio >= 1. else "ids"
+
+    def _token_mean(self, nll, y, ignore_index):
+        """
+        Mean of the summed negative log-likelihood nll of y[:, 1:] over the tokens of y that are not ignore_index, the 
+        same value criterion gives for the dense output (whose BOS row, see _prepend_bos, adds nothing to the sum but is 
+        counted).
+        """
+        return nll / (y != ignore_index).sum()
+
+    def _prepend_bos(self, output):
+        """
+        Adds the BOS position in front of the decoder output. For dense outputs [batch_size, seq_len_dec-1, vocab_size] it 
+        is a row with 0 for BOS and log(1e-31) elsewhere (log-probabilities / logits of a certain BOS), for argmax ids 
+        [batch_size, seq_len_dec-1] it is the BOS id.
+        """
+        if output is None:
+            return None
+        if output.dim() == 2:
+            return torch.cat((output.new_full((output.size(0), 1), self.tgt_bos_token_id), output), dim=1)
+        bos_tensor = output.new_full((output.size(0), 1, output.size(2)), float(np.log(1e-31)))
+        bos_tensor[:, :, self.tgt_bos_token_id] = 0.
+        return torch.cat((bos_tensor, output), dim=1)
+
     def load_checkpoint(self, folder, extension):
         filename = os.path.join(folder, "checkpoint." + extension)
         print("Loading model {} ...".format(filename))
@@ -42,7 +277,7 @@ class EncoderDecoder(nn.Module):
             print("\tModel file not found, not loading anything!")
             return {}
 
-        checkpoint = torch.load(filename)
+        checkpoint = torch.load(filename, map_location=self.device) # also loads cuda checkpoints on the cpu
         self.encoder.load_state_dict(checkpoint["encoder_state_dict"])
         self.decoder.load_state_dict(checkpoint["decoder_state_dict"])
 
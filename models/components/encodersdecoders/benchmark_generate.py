@@ -0,0 +1,64 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+import time
+import torch
+
+from models.lstm_pn.model import MyEncoderDecoder
+from models.components.encoders.LSTMEncoder import Encoder
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    Throughput of EncoderDecoder.generate (beam search) on an untrained lstm_pn model: the whole batch at once, versus
+    one input at a time.
+
+    python benchmark_generate.py [batch_size] [seq_len_enc] [max_len] [vocab_size] [beam_size]
+"""
+
+class SpecialTokens():
+    # the part of a Lookup the EncoderDecoder reads: the ids of PAD, UNK, BOS and EOS
+    pad_token, unk_token, bos_token, eos_token = "<PAD>", "<UNK>", "<BOS>", "<EOS>"
+
+    def convert_tokens_to_ids(self, token):
+        return [self.pad_token, self.unk_token, self.bos_token, self.eos_token].index(token)
+
+def inputs_per_second(model, x_tuple, beam_size, max_len, one_at_a_time, repeats = 3):
+    batch_size = x_tuple[0].size(0)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        if one_at_a_time:
+            for b in range(batch_size):
+                length = int(x_tuple[1][b])
+                model.generate((x_tuple[0][b:b+1, :length], x_tuple[1][b:b+1], x_tuple[2][b:b+1, :length]), beam_size, max_len)
+        else:
+            model.generate(x_tuple, beam_size, max_len)
+        if x_tuple[0].is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return batch_size / best
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seq_len_enc = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    max_len = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    vocab_size = int(sys.argv[4]) if len(sys.argv) > 4 else 5000
+    beam_size = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    torch.manual_seed(0)
+    src_lengths = torch.randint(seq_len_enc//2, seq_len_enc+1, (batch_size,), device=device).sort(descending=True)[0]
+    src = torch.randint(4, vocab_size, (batch_size, seq_len_enc), device=device)
+    src_mask = torch.arange(seq_len_enc, device=device).unsqueeze(0) < src_lengths.unsqueeze(1)
+    src[~src_mask] = 0
+    x_tuple = (src, src_lengths, src_mask)
+
+    encoder = Encoder(vocab_size=vocab_size, emb_dim=300, hidden_dim=512, num_layers=2, lstm_dropout=0., dropout=0., device=device)
+    decoder = Decoder(emb_dim=300, input_size=512, hidden_dim=512, num_layers=2, vocab_size=vocab_size, lstm_dropout=0., dropout=0., device=device, coverage="source")
+    model = MyEncoderDecoder(SpecialTokens(), SpecialTokens(), encoder, decoder, True, 0., device)
+    model.eval()
+
+    print("batch_size={}, seq_len_enc={}, max_len={}, vocab_size={}, beam_size={}, {}".format(batch_size, seq_len_enc, max_len, vocab_size, beam_size, device))
+    print("\tone input at a time : {:8.2f} inputs/s".format(inputs_per_second(model, x_tuple, beam_size, max_len, True)))
+    print("\twhole batch         : {:8.2f} inputs/s".format(inputs_per_second(model, x_tuple, beam_size, max_len, False)))
@@ -16,11 +16,13 @@ class MyEncoderDecoder(EncoderDecoder):
         
         self.to(self.device)
 
-    def forward(self, x_tuple, y_tuple, teacher_forcing_ratio=0.):
+    def forward(self, x_tuple, y_tuple, teacher_forcing_ratio=0., ignore_index=None, output_type="dense"):
         """
         Args:
             x (tensor): The input of the decoder. Shape: [batch_size, seq_len_enc].
             y (tensor): The input of the decoder. Shape: [batch_size, seq_len_dec].
+            ignore_index (int): If not None, the decoder also returns the summed loss of y[:, 1:], see the decoder.
+            output_type (string): "dense", "ids" (argmax only, [batch_size, seq_len_dec]) or None, see the decoder.
 
         Returns:
             The output of the Encoder-Decoder with attention. Shape: [batch_size, seq_len_dec, n_class].
@@ -29,6 +31,27 @@ class MyEncoderDecoder(EncoderDecoder):
         y, y_lenghts, y_mask = y_tuple[0], y_tuple[1], y_tuple[2]
         batch_size = x.shape[0]
         
+        # Calculates the output of the encoder and the initial decoder states
+        enc_output, dec_states = self.encode(x_tuple)
+
+        # Calculates the output of the decoder.
+        encoder_dict = self.decoder.forward(x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=ignore_index, output_type=output_type)
+        output = encoder_dict["output"]
+        attention_weights = encoder_dict["attention_weights"]
+        coverage_loss = encoder_dict["coverage_loss"]
+        nll = encoder_dict["nll"]
+
+        # Adds the BOS position to the beginning of the output. [batch_size, dec_seq_len-1, ...] -> [batch_size, dec_seq_len, ...]
+        output = self._prepend_bos(output)
+
+        return output, attention_weights, coverage_loss, nll
+    
+    def encode(self, x_tuple):
+        """
+        Returns the output of the encoder for x_tuple and the initial decoder states, see EncoderDecoder.encode.
+        """
+        batch_size = x_tuple[0].shape[0]
+        
         # Calculates the output of the encoder
         encoder_dict = self.encoder.forward(x_tuple)
         enc_output = encoder_dict["output"]
@@ -37,22 +60,8 @@ class MyEncoderDecoder(EncoderDecoder):
         cell = Variable(next(self.parameters()).data.new(batch_size, self.decoder.num_layers, self.decoder.hidden_dim), requires_grad=False)
         dec_states = ( hidden.zero_().permute(1, 0, 2), cell.zero_().permute(1, 0, 2) )
 
-        # Calculates the output of the decoder.
-        encoder_dict = self.decoder.forward(x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio)
-        output = encoder_dict["output"]
-        attention_weights = encoder_dict["attention_weights"]
-        coverage_loss = encoder_dict["coverage_loss"]
-
-        # Creates a BOS tensor that must be added to the beginning of the output. [batch_size, 1, dec_vocab_size]
-        bos_tensor = torch.zeros(batch_size, 1, self.decoder.vocab_size).to(self.device)
-        # Marks the corresponding BOS position with a probability of 1.
-        bos_tensor[:, :, self.tgt_bos_token_id] = 1
-        # Concatenates the BOS tensor with the output. [batch_size, dec_seq_len-1, dec_vocab_size] -> [batch_size, dec_seq_len, dec_vocab_size]
-        
-        output = torch.cat((bos_tensor, output), dim=1)
+        return enc_output, dec_states
 
-        return output, attention_weights, coverage_loss
-    
     def run_batch(self, X_tuple, y_tuple, criterion=None, tf_ratio=.0):
         (x_batch, x_batch_lenghts, x_batch_mask) = X_tuple
         (y_batch, y_batch_lenghts, y_batch_mask) = y_tuple
@@ -60,10 +69,15 @@ class MyEncoderDecoder(EncoderDecoder):
         if hasattr(self.decoder.attention, 'init_batch'):
                 self.decoder.attention.init_batch(x_batch.size()[0], x_batch.size()[1])
         
-        output, attention_weights, aux_loss = self.forward((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), tf_ratio)
+        # the decoder computes the loss step by step and keeps only what is needed of its output (see _loss_mode)
+        ignore_index, output_type = self._loss_mode(criterion, tf_ratio)
+        output, attention_weights, aux_loss, nll = self.forward((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), tf_ratio, ignore_index=ignore_index, output_type=output_type)
         
         if criterion is not None:
-            loss = criterion(output.view(-1, self.decoder.vocab_size), y_batch.contiguous().flatten())        
+            if ignore_index is not None:
+                loss = self._token_mean(nll, y_batch, ignore_index)
+            else:
+                loss = criterion(output.view(-1, self.decoder.vocab_size), y_batch.contiguous().flatten())
             total_loss = loss + self.aux_loss_weight*aux_loss
         
             #print("\nloss {:.3f}, aux {:.3f}*{}={:.3f}, total {}\n".format( loss, aux_loss, aux_loss_weight, aux_loss_weight*aux_loss, total_loss))
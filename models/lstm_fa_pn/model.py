@@ -6,8 +6,8 @@ import torch
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
-import scipy.stats
 from models.components.encodersdecoders.EncoderDecoder import EncoderDecoder
+from models.components.criteria.GaussianAttentionTargets import GaussianAttentionTargets
 
 class MyEncoderDecoder(EncoderDecoder):
     def __init__(self, src_lookup, tgt_lookup, encoder, decoder, dec_transfer_hidden, coverage_loss_weight, attention_loss_weight, device):
@@ -25,14 +25,17 @@ class MyEncoderDecoder(EncoderDecoder):
         self.c_state_linear = nn.Linear(int(encoder.hidden_dim * encoder.num_layers/1), decoder.hidden_dim * decoder.num_layers * 1)
 
         self.attention_criterion = nn.KLDivLoss(reduction='batchmean')
+        self.attention_targets = GaussianAttentionTargets(sigma=2.) # target distributions, cached per (dec_len, enc_len)
     
         self.to(self.device)
 
-    def forward(self, x_tuple, y_tuple, teacher_forcing_ratio=0.):
+    def forward(self, x_tuple, y_tuple, teacher_forcing_ratio=0., ignore_index=None, output_type="dense"):
         """
         Args:
             x (tensor): The input of the decoder. Shape: [batch_size, seq_len_enc].
             y (tensor): The input of the decoder. Shape: [batch_size, seq_len_dec].
+            ignore_index (int): If not None, the decoder also returns the summed loss of y[:, 1:], see the decoder.
+            output_type (string): "dense", "ids" (argmax only, [batch_size, seq_len_dec]) or None, see the decoder.
 
         Returns:
             The output of the Encoder-Decoder with attention. Shape: [batch_size, seq_len_dec, n_class].
@@ -41,6 +44,27 @@ class MyEncoderDecoder(EncoderDecoder):
         y, y_lenghts, y_mask = y_tuple[0], y_tuple[1], y_tuple[2]
         batch_size = x.shape[0]
         
+        # Calculates the output of the encoder and the initial decoder states
+        enc_output, dec_states = self.encode(x_tuple)
+
+        # Calculates the output of the decoder.
+        decoder_dict = self.decoder.forward(x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio, ignore_index=ignore_index, output_type=output_type)
+        output = decoder_dict["output"]
+        attention_weights = decoder_dict["attention_weights"]
+        coverage_loss = decoder_dict["coverage_loss"]
+        nll = decoder_dict["nll"]
+
+        # Adds the BOS position to the beginning of the output. [batch_size, dec_seq_len-1, ...] -> [batch_size, dec_seq_len, ...]
+        output = self._prepend_bos(output)
+
+        return output, attention_weights, coverage_loss, nll
+    
+    def encode(self, x_tuple):
+        """
+        Returns the output of the encoder for x_tuple and the initial decoder states, see EncoderDecoder.encode.
+        """
+        batch_size = x_tuple[0].shape[0]
+        
         # Calculates the output of the encoder
         encoder_dict = self.encoder.forward(x_tuple)
         enc_output = encoder_dict["output"]
@@ -54,22 +78,8 @@ class MyEncoderDecoder(EncoderDecoder):
             cell = Variable(next(self.parameters()).data.new(batch_size, self.decoder.num_layers, self.decoder.hidden_dim), requires_grad=False)
             dec_states = ( hidden.zero_().permute(1, 0, 2), cell.zero_().permute(1, 0, 2) )
 
-        # Calculates the output of the decoder.
-        decoder_dict = self.decoder.forward(x_tuple, y_tuple, enc_output, dec_states, teacher_forcing_ratio)
-        output = decoder_dict["output"]
-        attention_weights = decoder_dict["attention_weights"]
-        coverage_loss = decoder_dict["coverage_loss"]
+        return enc_output, dec_states
 
-        # Creates a BOS tensor that must be added to the beginning of the output. [batch_size, 1, dec_vocab_size]
-        bos_tensor = torch.zeros(batch_size, 1, self.decoder.vocab_size).to(self.device)
-        # Marks the corresponding BOS position with a probability of 1.
-        bos_tensor[:, :, self.tgt_bos_token_id] = 1
-        # Concatenates the BOS tensor with the output. [batch_size, dec_seq_len-1, dec_vocab_size] -> [batch_size, dec_seq_len, dec_vocab_size]
-        
-        output = torch.cat((bos_tensor, output), dim=1)
-
-        return output, attention_weights, coverage_loss
-    
     def run_batch(self, X_tuple, y_tuple, criterion=None, tf_ratio=.0):
         (x_batch, x_batch_lenghts, x_batch_mask) = X_tuple
         (y_batch, y_batch_lenghts, y_batch_mask) = y_tuple
@@ -77,7 +87,9 @@ class MyEncoderDecoder(EncoderDecoder):
         if hasattr(self.decoder.attention, 'init_batch'):
                 self.decoder.attention.init_batch(x_batch.size()[0], x_batch.size()[1])
         
-        output, attention_weights, coverage_loss = self.forward((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), tf_ratio)
+        # the decoder computes the loss step by step and keeps only what is needed of its output (see _loss_mode)
+        ignore_index, output_type = self._loss_mode(criterion, tf_ratio)
+        output, attention_weights, coverage_loss, nll = self.forward((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), tf_ratio, ignore_index=ignore_index, output_type=output_type)
         
         display_variables = OrderedDict()
         
@@ -88,7 +100,10 @@ class MyEncoderDecoder(EncoderDecoder):
         disp_att_loss = 0        
         total_loss = 0
         if criterion is not None:            
-            gen_loss = criterion(output.view(-1, self.decoder.vocab_size), y_batch.contiguous().flatten())        
+            if ignore_index is not None:
+                gen_loss = self._token_mean(nll, y_batch, ignore_index)
+            else:
+                gen_loss = criterion(output.view(-1, self.decoder.vocab_size), y_batch.contiguous().flatten())
             disp_gen_loss = gen_loss.item()            
             total_loss = gen_loss + self.coverage_loss_weight*coverage_loss        
             disp_cov_loss = self.coverage_loss_weight*coverage_loss.item()
@@ -100,23 +115,15 @@ class MyEncoderDecoder(EncoderDecoder):
                 dec_seq_len = attention_weights.size(1)
                 enc_seq_len = attention_weights.size(2)
                 
-                x = np.linspace(0, enc_seq_len, enc_seq_len)
-                
-                # create target distribution
-                target_attention_distribution = attention_weights.new_full((batch_size, dec_seq_len, enc_seq_len), 1e-31)
-                for decoder_index in range(0, dec_seq_len):
-                    y = scipy.stats.norm.pdf(x, decoder_index, 2) # loc (mean) is decoder_step, scale (std dev) = 1.        
-                    y = y / np.sum(y) # rescale to make it a PDF
-                    gaussian_dist = torch.tensor(y, dtype = attention_weights.dtype, device = self.device) # make it a tensor, it's [seq_len]
-                    target_attention_distribution[:,decoder_index, :] = gaussian_dist.repeat(batch_size, 1) # same for all examples in batch, now it's [batch_size, seq_len]
+                # log of the target distribution, a Gaussian (std dev 2) around each decoder step, the same for all examples in batch
+                log_target_attention_distribution = self.attention_targets(batch_size, dec_seq_len, enc_seq_len, attention_weights.dtype, attention_weights.device, log=True)
                 
-                target_attention_distribution[target_attention_distribution<1e-31] = 1e-31
                 attention_weights[attention_weights<1e-31] = 1e-31
                 
                 #print(target_attention_distribution[0,0,:])                                
                 #print(attention_weights_tensor[0,0,:])                
                 
-                attention_loss = tf_ratio * self.attention_criterion(target_attention_distribution.log().permute(0,2,1), attention_weights.permute(0,2,1)) * self.attention_loss_weight
+                attention_loss = tf_ratio * self.attention_criterion(log_target_attention_distribution.permute(0,2,1), attention_weights.permute(0,2,1)) * self.attention_loss_weight
                 disp_att_loss = attention_loss.item()
                 total_loss += attention_loss     
         
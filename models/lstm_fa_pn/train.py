@@ -93,6 +93,7 @@ if __name__ == "__main__":
                 lstm_dropout=0.4,
                 dropout=0.4,
                 vocab_size=len(tgt_lookup),                
+                coverage="source", # coverage per source position, does not grow with the gpt2 vocab
                 device=device)
         
     model = MyEncoderDecoder(src_lookup = src_lookup, tgt_lookup = tgt_lookup, encoder = encoder, decoder = decoder, dec_transfer_hidden = True, coverage_loss_weight = coverage_loss_weight, attention_loss_weight = attention_loss_weight, device = device)
@@ -0,0 +1,67 @@
+# add package root
+import os, sys
+sys.path.insert(0, '../..')
+
+import torch
+
+from models.util.lookup import Lookup
+from models.util.loaders.standard import loader
+from models.util.export import export, check_parity
+
+from models.lstm_pn.model import MyEncoderDecoder
+from models.components.encoders.LSTMEncoder import Encoder
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    Exports the best lstm_pn checkpoint of train.py (same lookups and model sizes) to TorchScript and ONNX, see 
+    models/util/export.py, then checks the exported graphs against the eager model on the first dev batches:
+
+    python export.py [output_folder]        default ../../train/lstm_pn/export
+"""
+
+if __name__ == "__main__":
+    data_folder = os.path.join("..", "..", "data", "task2", "ready", "gpt2")
+    src_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","src")
+    tgt_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","tgt")
+    model_store_path = os.path.join("..", "..", "train", "lstm_pn")
+    export_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(model_store_path, "export")
+
+    src_lookup = Lookup(type="gpt2")
+    src_lookup.load(src_lookup_prefix)
+    tgt_lookup = Lookup(type="gpt2")
+    tgt_lookup.load(tgt_lookup_prefix)
+    _, valid_loader, _ = loader(data_folder, 4, src_lookup, tgt_lookup, 0, 1000, 0, 1000, custom_filename_prefix = "Business_Ethics_")
+
+    device = torch.device("cpu") # the exported graphs run on the device they were traced on
+    encoder = Encoder(
+                vocab_size=len(src_lookup),
+                emb_dim=300,
+                hidden_dim=512,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                device=device)
+    decoder = Decoder(
+                emb_dim=300,
+                input_size=512,
+                hidden_dim=256,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                vocab_size=len(tgt_lookup),
+                coverage="source",
+                device=device)
+    model = MyEncoderDecoder(src_lookup = src_lookup, tgt_lookup = tgt_lookup, encoder = encoder, decoder = decoder, dec_transfer_hidden = True, aux_loss_weight = 0.03, device = device)
+    model.load_checkpoint(model_store_path, "best")
+    model.eval()
+
+    batches = iter(valid_loader)
+    x_tuple, _ = next(batches)
+    print("Exporting to {} ...".format(export_path))
+    export(model, x_tuple, export_path)
+
+    for i, (x_tuple, _) in enumerate([(x_tuple, None)] + [next(batches) for _ in range(2)]):
+        for backend in ["torchscript", "onnx"]:
+            parity = check_parity(model, x_tuple, export_path, backend)
+            print("\tdev batch {} {:11}: encoder max abs diff {:.2e}, step max abs diff {:.2e}, same greedy output {}".format(
+                i, backend, parity["encoder_max_abs_diff"], parity["step_max_abs_diff"], parity["same_greedy_output"]))
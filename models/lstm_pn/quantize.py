@@ -0,0 +1,58 @@
+# add package root
+import os, sys
+sys.path.insert(0, '../..')
+
+import torch
+
+from models.util.lookup import Lookup
+from models.util.loaders.standard import loader
+from models.util.quantize import compare
+
+from models.lstm_pn.model import MyEncoderDecoder
+from models.components.encoders.LSTMEncoder import Encoder
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    Reports what dynamic int8 quantization (see models/util/quantize.py) of the best lstm_pn checkpoint of train.py 
+    (same lookups and model sizes) costs and saves: model size, CPU latency and the dev METEOR / ROUGE-L delta.
+
+    python quantize.py [max_batches]        default all the dev set
+"""
+
+if __name__ == "__main__":
+    max_batches = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    data_folder = os.path.join("..", "..", "data", "task2", "ready", "gpt2")
+    src_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","src")
+    tgt_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","tgt")
+    model_store_path = os.path.join("..", "..", "train", "lstm_pn")
+
+    src_lookup = Lookup(type="gpt2")
+    src_lookup.load(src_lookup_prefix)
+    tgt_lookup = Lookup(type="gpt2")
+    tgt_lookup.load(tgt_lookup_prefix)
+    _, valid_loader, _ = loader(data_folder, 4, src_lookup, tgt_lookup, 0, 1000, 0, 1000, custom_filename_prefix = "Business_Ethics_")
+
+    device = torch.device("cpu") # quantized layers run on CPU only
+    encoder = Encoder(
+                vocab_size=len(src_lookup),
+                emb_dim=300,
+                hidden_dim=512,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                device=device)
+    decoder = Decoder(
+                emb_dim=300,
+                input_size=512,
+                hidden_dim=256,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                vocab_size=len(tgt_lookup),
+                coverage="source",
+                device=device)
+    model = MyEncoderDecoder(src_lookup = src_lookup, tgt_lookup = tgt_lookup, encoder = encoder, decoder = decoder, dec_transfer_hidden = True, aux_loss_weight = 0.03, device = device)
+    model.load_checkpoint(model_store_path, "best")
+
+    compare(model, valid_loader, max_batches = max_batches)
@@ -0,0 +1,72 @@
+# add package root
+import os, sys
+sys.path.insert(0, '../..')
+
+import torch
+
+from models.util.lookup import Lookup
+from models.util.utils import select_processing_device
+from models.util.server import InferenceServer, serve_http, serve_stdio
+from models.util.quantize import quantize
+
+from models.lstm_pn.model import MyEncoderDecoder
+from models.components.encoders.LSTMEncoder import Encoder
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    Serves the best lstm_pn checkpoint of train.py (same lookups and model sizes), see models/util/server.py:
+
+    python serve.py http [port]         HTTP on 127.0.0.1, drive it with models/util/client.py
+    python serve.py stdio               JSON lines on stdin/stdout
+
+    with int8 as the last argument, the model is served with dynamic int8 quantization on CPU, see models/util/quantize.py
+"""
+
+if __name__ == "__main__":
+    int8 = sys.argv[-1] == "int8"
+    args = sys.argv[1:-1] if int8 else sys.argv[1:]
+    mode = args[0] if len(args) > 0 else "http"
+    port = int(args[1]) if len(args) > 1 else 8000
+    output = sys.stdout
+    if mode == "stdio": # stdout carries the outputs, the rest is printed on stderr
+        sys.stdout = sys.stderr
+
+    src_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","src")
+    tgt_lookup_prefix = os.path.join("..", "..", "data", "task2", "lookup", "gpt2","tgt")
+    model_store_path = os.path.join("..", "..", "train", "lstm_pn")
+
+    src_lookup = Lookup(type="gpt2")
+    src_lookup.load(src_lookup_prefix)
+    tgt_lookup = Lookup(type="gpt2")
+    tgt_lookup.load(tgt_lookup_prefix)
+
+    device = torch.device("cpu") if int8 else select_processing_device(verbose = True)
+
+    encoder = Encoder(
+                vocab_size=len(src_lookup),
+                emb_dim=300,
+                hidden_dim=512,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                device=device)
+    decoder = Decoder(
+                emb_dim=300,
+                input_size=512,
+                hidden_dim=256,
+                num_layers=2,
+                lstm_dropout=0.4,
+                dropout=0.4,
+                vocab_size=len(tgt_lookup),
+                coverage="source",
+                device=device)
+    model = MyEncoderDecoder(src_lookup = src_lookup, tgt_lookup = tgt_lookup, encoder = encoder, decoder = decoder, dec_transfer_hidden = True, aux_loss_weight = 0.03, device = device)
+    model.load_checkpoint(model_store_path, "best")
+    if int8:
+        model = quantize(model)
+
+    inference = InferenceServer(model, max_batch_size = 32, max_latency = 0.05, bucket_width = 16, beam_size = 4, max_len = 100)
+    if mode == "stdio":
+        serve_stdio(inference, output = output)
+    else:
+        serve_http(inference, port = port)
@@ -0,0 +1,76 @@
+import os, sys
+sys.path.insert(0, '../..')
+
+import time, tempfile
+import torch
+
+from models.util.export import export, check_parity, ExportedModel
+from models.lstm_pn.model import MyEncoderDecoder
+from models.components.encoders.LSTMEncoder import Encoder
+from models.components.decoders.LSTMDecoder_Att_PN_SumCov import Decoder
+
+"""
+    CPU latency of greedy decoding with an untrained lstm_pn model: eager (EncoderDecoder.greedy_decode) versus its 
+    export (see export.py) run with TorchScript and with onnxruntime, one input at a time and the whole batch at once.
+
+    python benchmark_export.py [batch_size] [seq_len_enc] [max_len] [vocab_size] [threads]
+"""
+
+class SpecialTokens():
+    # the part of a Lookup the EncoderDecoder reads: the ids of PAD, UNK, BOS and EOS
+    pad_token, unk_token, bos_token, eos_token = "<PAD>", "<UNK>", "<BOS>", "<EOS>"
+
+    def convert_tokens_to_ids(self, token):
+        return [self.pad_token, self.unk_token, self.bos_token, self.eos_token].index(token)
+
+def ms_per_input(decoders, x_tuple, max_len, one_at_a_time, repeats = 3):
+    # the decoders take turns, so that all see the same machine load
+    batch_size = x_tuple[0].size(0)
+    best = [None] * len(decoders)
+    for _ in range(repeats):
+        for j, decoder in enumerate(decoders):
+            start = time.perf_counter()
+            if one_at_a_time:
+                for b in range(batch_size):
+                    length = int(x_tuple[1][b])
+                    decoder.greedy_decode((x_tuple[0][b:b+1, :length], x_tuple[1][b:b+1], x_tuple[2][b:b+1, :length]), max_len)
+            else:
+                decoder.greedy_decode(x_tuple, max_len)
+            elapsed = time.perf_counter() - start
+            best[j] = elapsed if best[j] is None else min(best[j], elapsed)
+    return [1000 * elapsed / batch_size for elapsed in best]
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seq_len_enc = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    max_len = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    vocab_size = int(sys.argv[4]) if len(sys.argv) > 4 else 5000
+    if len(sys.argv) > 5:
+        torch.set_num_threads(int(sys.argv[5]))
+    device = torch.device("cpu")
+
+    torch.manual_seed(0)
+    src_lengths = torch.randint(seq_len_enc//2, seq_len_enc+1, (batch_size,)).sort(descending=True)[0]
+    src_lengths[0] = seq_len_enc
+    src = torch.randint(4, vocab_size, (batch_size, seq_len_enc))
+    src_mask = torch.arange(seq_len_enc).unsqueeze(0) < src_lengths.unsqueeze(1)
+    src[~src_mask] = 0
+    x_tuple = (src, src_lengths, src_mask)
+
+    encoder = Encoder(vocab_size=vocab_size, emb_dim=300, hidden_dim=512, num_layers=2, lstm_dropout=0., dropout=0., device=device)
+    decoder = Decoder(emb_dim=300, input_size=512, hidden_dim=512, num_layers=2, vocab_size=vocab_size, lstm_dropout=0., dropout=0., device=device, coverage="source")
+    model = MyEncoderDecoder(SpecialTokens(), SpecialTokens(), encoder, decoder, True, 0., device)
+    model.eval()
+
+    export_path = tempfile.mkdtemp()
+    export(model, x_tuple, export_path)
+    names, decoders = ["eager      ", "torchscript", "onnxruntime"], [model, ExportedModel(export_path, "torchscript"), ExportedModel(export_path, "onnx")]
+
+    print("batch_size={}, seq_len_enc={}, max_len={}, vocab_size={}, {} threads".format(batch_size, seq_len_enc, max_len, vocab_size, torch.get_num_threads()))
+    for backend in ["torchscript", "onnx"]:
+        print("\tparity {:11}: {}".format(backend, check_parity(model, x_tuple, export_path, backend, max_len)))
+    with torch.no_grad():
+        for one_at_a_time in [True, False]:
+            times = ms_per_input(decoders, x_tuple, max_len, one_at_a_time)
+            for name, elapsed in zip(names, times):
+                print("\t{} {}: {:8.2f} ms/input".format("one input at a time" if one_at_a_time else "whole batch        ", name, elapsed))
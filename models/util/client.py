@@ -0,0 +1,54 @@
+import os, sys
+sys.path.insert(0, '../..')
+
+import time, json
+import urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+    Client of the HTTP inference server (see models/util/server.py). Run as a script it sends the lines of a file as
+    concurrent requests and reports the throughput and latencies:
+
+    python client.py input.txt [url] [concurrency]
+"""
+
+class InferenceClient():
+    def __init__(self, url = "http://127.0.0.1:8000", timeout = 600):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, obj):
+        request = urllib.request.Request(self.url, data=json.dumps(obj).encode("utf8"), headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf8"))
+        except urllib.error.HTTPError as e:
+            raise Exception("Inference server error {}: {}".format(e.code, json.loads(e.read().decode("utf8")).get("error")))
+
+    def __call__(self, text):
+        """ Returns the result of text, a dict with "text" (the output) and "timing", see InferenceServer.submit. """
+        return self._post({"text": text})
+
+    def batch(self, texts):
+        """ The results of a list of texts, sent in one request. """
+        return self._post({"texts": texts})["results"]
+
+def run_load(client, texts, concurrency):
+    """ Sends texts, one request each, from concurrency threads. Returns the results and the seconds it took. """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(client, texts))
+    return results, time.perf_counter() - start
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "r", encoding="utf8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    url = sys.argv[2] if len(sys.argv) > 2 else "http://127.0.0.1:8000"
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+
+    results, elapsed = run_load(InferenceClient(url), texts, concurrency)
+    total_ms = sorted(result["timing"]["total_ms"] for result in results)
+    batch_sizes = [result["timing"]["batch_size"] for result in results]
+    print("{} requests, concurrency {}: {:.2f} requests/s".format(len(texts), concurrency, len(texts) / elapsed))
+    print("\tlatency p50 {:.1f} ms, p90 {:.1f} ms, max {:.1f} ms, mean batch size {:.1f}".format(
+        total_ms[len(total_ms)//2], total_ms[int(len(total_ms)*.9)], total_ms[-1], sum(batch_sizes) / len(batch_sizes)))
@@ -0,0 +1,225 @@
+import os, sys
+sys.path.insert(0, '../..')
+
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+
+"""
+    Export of a trained EncoderDecoder for serving without the training code: the encoder and a single decoder step
+    (attention and, for LSTMDecoder_Att_PN_SumCov, the pointer-generator mixture) are traced into TorchScript
+    (encoder.pt, decoder_step.pt) and ONNX (encoder.onnx, decoder_step.onnx), described by export.json.
+    ExportedModel runs them (TorchScript or onnxruntime) with the greedy loop of EncoderDecoder.greedy_decode,
+    check_parity compares them with the eager model. See models/lstm_pn/export.py and benchmark_export.py.
+
+    The decoder must have _step (LSTMDecoder_Att, LSTMDecoder_Att_PN_SumCov), the "coverage" attention type of
+    LSTMDecoder_Att is not supported (its C is kept in the attention, not passed as a tensor).
+"""
+
+class EncoderGraph(nn.Module):
+    # (x, x_lengths, x_mask) -> the initial decoder state and the projections of the encoder output the steps read
+    def __init__(self, model, coverage_size=None):
+        super().__init__()
+        self.model = model
+        self.coverage_size = coverage_size
+
+    def forward(self, x, x_lengths, x_mask):
+        enc_output, (h, c) = self.model.encode((x, x_lengths, x_mask))
+        _, V, energy_keys = self.model.decoder.attention.project(enc_output)
+        if self.coverage_size is None:
+            return h.contiguous(), c.contiguous(), V, energy_keys
+        coverage = enc_output.new_zeros((x.size(0), x.size(1) if self.coverage_size == "source" else self.coverage_size))
+        return h.contiguous(), c.contiguous(), coverage, V, energy_keys
+
+class AttStepGraph(nn.Module):
+    # LSTMDecoder_Att: (prev_tokens, h, c, V, energy_keys, mask) -> (log_probs, h, c)
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, prev_tokens, h, c, V, energy_keys, mask):
+        log_probs, (h, c), _ = self.decoder._step(prev_tokens, (h, c), V, energy_keys, mask)
+        return log_probs, h, c
+
+class PNStepGraph(nn.Module):
+    # LSTMDecoder_Att_PN_SumCov: (prev_tokens, h, c, coverage, V, energy_keys, mask, src) -> (log_probs, h, c, coverage)
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, prev_tokens, h, c, coverage, V, energy_keys, mask, src):
+        log_probs, (h, c), coverage = self.decoder._step(prev_tokens, (h, c), coverage, V, energy_keys, mask, src)
+        return log_probs, h, c, coverage
+
+def _graphs(model):
+    """ The encoder and decoder step modules of model and the names of the decoder state and of the step inputs. """
+    decoder = model.decoder
+    if not hasattr(decoder, "_step"):
+        raise Exception("export needs a decoder with _step(), {} has none".format(type(decoder).__name__))
+    if getattr(decoder.attention, "type", None) == "coverage":
+        raise Exception("export does not support the \"coverage\" attention type")
+    if hasattr(decoder.attention, "coverage"): # pointer-generator, with its coverage as part of the state
+        coverage_size = "source" if decoder.attention.coverage == "source" else decoder.vocab_size
+        return EncoderGraph(model, coverage_size), PNStepGraph(decoder), ["h", "c", "coverage"], ["V", "energy_keys", "mask", "src"]
+    return EncoderGraph(model), AttStepGraph(decoder), ["h", "c"], ["V", "energy_keys", "mask"]
+
+def export(model, x_tuple, path, onnx=True, opset_version=17):
+    """
+    Writes the TorchScript and (if onnx) ONNX graphs of model to the folder path, with export.json. The graphs are
+    traced on x_tuple = (x, x_lengths, x_mask), a batch of at least two inputs sorted by length (longest first, as the
+    encoder packs its input) and padded to the longest; any batch size and length work afterwards. The exported
+    graphs run on the device of model, on CPU for a CPU model.
+
+    Returns the meta data written to export.json.
+    """
+    model.eval()
+    encoder, step, state_names, memory_names = _graphs(model)
+    x, x_lengths, x_mask = x_tuple[0], x_tuple[1].cpu(), x_tuple[2]
+    encoder_inputs = (x, x_lengths, x_mask)
+
+    with torch.no_grad():
+        encoder_outputs = encoder(*encoder_inputs)
+        state, V, energy_keys = list(encoder_outputs[:-2]), encoder_outputs[-2], encoder_outputs[-1]
+        memory = {"V": V, "energy_keys": energy_keys, "mask": x_mask, "src": x}
+        prev_tokens = torch.full((x.size(0),), model.tgt_bos_token_id, dtype=torch.long, device=x.device)
+        step_inputs = tuple([prev_tokens] + state + [memory[name] for name in memory_names])
+
+        os.makedirs(path, exist_ok=True)
+        # check_trace reruns the graphs on the same inputs, and the encoder's packing makes a trace warn about its lengths
+        torch.jit.trace(encoder, encoder_inputs, check_trace=False).save(os.path.join(path, "encoder.pt"))
+        torch.jit.trace(step, step_inputs, check_trace=False).save(os.path.join(path, "decoder_step.pt"))
+
+    encoder_input_names, encoder_output_names = ["x", "x_lengths", "x_mask"], state_names + ["V", "energy_keys"]
+    step_input_names, step_output_names = ["prev_tokens"] + state_names + memory_names, ["log_probs"] + ["next_" + name for name in state_names]
+    meta = {"decoder": type(model.decoder).__name__, "vocab_size": model.decoder.vocab_size,
+        "bos_token_id": model.tgt_bos_token_id, "eos_token_id": model.tgt_eos_token_id, "pad_token_id": model.tgt_pad_token_id,
+        "encoder": {"inputs": encoder_input_names, "outputs": encoder_output_names},
+        "decoder_step": {"inputs": step_input_names, "outputs": step_output_names}, "state": state_names, "memory": memory_names}
+
+    if onnx:
+        # the batch dimension (rows) and the source length are dynamic, h and c are [num_layers, rows, hidden_dim]
+        axes = {"x": {0: "batch", 1: "src_len"}, "x_lengths": {0: "batch"}, "x_mask": {0: "batch", 1: "src_len"},
+            "h": {1: "batch"}, "c": {1: "batch"}, "V": {0: "batch", 1: "src_len"}, "energy_keys": {0: "batch", 1: "src_len"},
+            "mask": {0: "batch", 1: "src_len"}, "src": {0: "batch", 1: "src_len"}, "prev_tokens": {0: "batch"}, "log_probs": {0: "batch"},
+            "coverage": {0: "batch", 1: "src_len"} if encoder.coverage_size == "source" else {0: "batch"}}
+        axes.update({"next_" + name: axes[name] for name in state_names}) # ONNX names are unique, the outputs get their own
+        with torch.no_grad():
+            torch.onnx.export(encoder, encoder_inputs, os.path.join(path, "encoder.onnx"), input_names=encoder_input_names,
+                output_names=encoder_output_names, dynamic_axes={name: axes[name] for name in encoder_input_names + encoder_output_names},
+                opset_version=opset_version, dynamo=False)
+            torch.onnx.export(step, step_inputs, os.path.join(path, "decoder_step.onnx"), input_names=step_input_names,
+                output_names=step_output_names, dynamic_axes={name: axes[name] for name in step_input_names + step_output_names},
+                opset_version=opset_version, dynamo=False)
+
+    with open(os.path.join(path, "export.json"), "w", encoding="utf8") as f:
+        json.dump(meta, f, indent=4)
+    return meta
+
+class ExportedModel():
+    def __init__(self, path, backend="torchscript"):
+        """
+        Loads the graphs written by export from the folder path, to run them with backend "torchscript" (needs only
+        torch) or "onnx" (needs onnxruntime, on CPU). greedy_decode works as EncoderDecoder.greedy_decode.
+        """
+        with open(os.path.join(path, "export.json"), "r", encoding="utf8") as f:
+            self.meta = json.load(f)
+        self.backend = backend
+        if backend == "torchscript":
+            self.graphs = {graph: torch.jit.load(os.path.join(path, graph + ".pt")) for graph in ["encoder", "decoder_step"]}
+        elif backend == "onnx":
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            self.graphs = {graph: onnxruntime.InferenceSession(os.path.join(path, graph + ".onnx"), options, providers=["CPUExecutionProvider"]) 
+                for graph in ["encoder", "decoder_step"]}
+        else:
+            raise Exception("Unknown backend {}, use \"torchscript\" or \"onnx\"".format(backend))
+
+    def _run(self, graph, inputs):
+        # inputs and outputs are lists of tensors, in the order of export.json
+        if self.backend == "torchscript":
+            return list(self.graphs[graph](*inputs))
+        # the exporter drops the inputs a graph does not read (x_mask of the encoder)
+        session_inputs = [session_input.name for session_input in self.graphs[graph].get_inputs()]
+        feed = {name: tensor.cpu().numpy() for name, tensor in zip(self.meta[graph]["inputs"], inputs) if name in session_inputs}
+        return [torch.from_numpy(array) for array in self.graphs[graph].run(None, feed)]
+
+    def encode(self, x_tuple):
+        """ The initial decoder state (a list, see export.json) and the memory the steps read, for x_tuple. """
+        x, x_lengths, x_mask = x_tuple[0], x_tuple[1].cpu(), x_tuple[2]
+        outputs = self._run("encoder", [x, x_lengths, x_mask])
+        memory = {"V": outputs[-2], "energy_keys": outputs[-1], "mask": x_mask, "src": x}
+        return outputs[:-2], [memory[name] for name in self.meta["memory"]]
+
+    def decoder_step(self, prev_tokens, state, memory):
+        """ One decoding step: the log-probabilities of the next token [n, vocab_size] and the next state. """
+        outputs = self._run("decoder_step", [prev_tokens] + state + memory)
+        return outputs[0], outputs[1:]
+
+    def greedy_decode(self, x_tuple, max_len=100):
+        """ See EncoderDecoder.greedy_decode. """
+        with torch.no_grad():
+            return self._greedy_decode(x_tuple, max_len)
+
+    def _greedy_decode(self, x_tuple, max_len):
+        bos, eos, pad = self.meta["bos_token_id"], self.meta["eos_token_id"], self.meta["pad_token_id"]
+        batch_size, device = x_tuple[0].size(0), x_tuple[0].device
+        state, memory = self.encode(x_tuple)
+
+        output = torch.full((batch_size, max_len), pad, dtype=torch.long, device=device)
+        output[:, 0] = bos
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        rows = torch.arange(batch_size, device=device) # the row of output of each row of the decoder state
+        prev_tokens, length = output[:, 0], 1
+
+        for i in range(1, max_len):
+            log_probs, state = self.decoder_step(prev_tokens, state, memory) # [n, vocab_size]
+            log_probs[:, [pad, bos]] = -np.inf # never generated
+            prev_tokens = log_probs.argmax(dim=1).to(device)
+            output[rows, i] = prev_tokens
+            done[rows] = prev_tokens == eos
+            length = i+1
+
+            going = ~done[rows]
+            if not bool(going.all()):
+                if not bool(going.any()):
+                    break
+                going = going.nonzero().squeeze(1)
+                rows, prev_tokens = rows[going], prev_tokens[going]
+                # h and c have the rows in dimension 1, the coverage and the memory in dimension 0
+                state = [tensor.index_select(1 if name in ("h", "c") else 0, going.to(tensor.device)) for name, tensor in zip(self.meta["state"], state)]
+                memory = [tensor.index_select(0, going.to(tensor.device)) for tensor in memory]
+
+        return output[:, :length]
+
+def check_parity(model, x_tuple, path, backend="torchscript", max_len=100):
+    """
+    Compares the graphs of the folder path (see export) with the eager model on the batch x_tuple: the largest
+    absolute difference of the encoder outputs and of the next token probabilities of the first steps (teacher forced
+    on the eager greedy output), and whether the greedy outputs are the same. Returns them as a dict.
+    """
+    model.eval()
+    exported = ExportedModel(path, backend)
+    encoder, step, _, _ = _graphs(model)
+    x_tuple = (x_tuple[0], x_tuple[1].cpu(), x_tuple[2])
+    with torch.no_grad():
+        eager_outputs = encoder(*x_tuple)
+        state, memory = exported.encode(x_tuple)
+        encoder_diff = max(float((a - b.to(a.device)).abs().max()) for a, b in zip(eager_outputs, state + memory[:2]))
+
+        eager_output = model.greedy_decode(x_tuple, max_len)
+        eager_state = list(eager_outputs[:-2])
+        eager_memory = {"V": eager_outputs[-2], "energy_keys": eager_outputs[-1], "mask": x_tuple[2], "src": x_tuple[0]}
+        eager_memory = [eager_memory[name] for name in exported.meta["memory"]]
+        step_diff = 0.
+        for i in range(min(eager_output.size(1)-1, 5)):
+            prev_tokens = eager_output[:, i]
+            eager_step = step(prev_tokens, *eager_state, *eager_memory)
+            log_probs, state = exported.decoder_step(prev_tokens, state, memory)
+            eager_state = list(eager_step[1:])
+            # compared as probabilities: the log of the near-zero ones only shows float rounding
+            step_diff = max(step_diff, float((eager_step[0].exp() - log_probs.to(eager_step[0].device).exp()).abs().max()))
+
+        output = exported.greedy_decode(x_tuple, max_len)
+    same_output = output.shape == eager_output.shape and bool((output.to(eager_output.device) == eager_output).all())
+    return {"encoder_max_abs_diff": encoder_diff, "step_max_abs_diff": step_diff, "same_greedy_output": same_output}
@@ -1,172 +1,182 @@
-import os, sys, json
+import os, sys
+sys.path.append("../..")
+
 import numpy as np
 import torch
 import torch.utils.data
+from functools import partial
 from sklearn.linear_model import LogisticRegression
-from scipy import stats
-
-PAD = 0
-UNK = 1
-BOS = 2
-EOS = 3
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 
-PAD_WORD = '<PAD>'
-UNK_WORD = '<UNK>'
-BOS_WORD = '<BOS>'
-EOS_WORD = '<EOS>'
+from models.util.loaders.standard import BiDataset, paired_collate_fn
 
 class EstimatedDataLoader(): # full data loader (e.g. train_loader)
-    def __init__(self, dataset_object):
-        self.estimation_X = []        
-        self.estimation_y = []
-        self.estimator = LogisticRegression(solver='lbfgs', multi_class='multinomial')
+    def __init__(self, dataset, src_padding_idx, tgt_padding_idx, start_batch_size = 8, min_batch_size = 1, max_batch_size = 1024,
+                 time_budget = None, pool_size = 10000, shuffle = True, threshold = 0.8, max_growth = 2., min_samples = 20, refit_every = 10, seed = 0):
+        """
+        Loader that chooses the batch size itself: it learns, from the outcome of previous batches, which batches fit
+        in memory (and in the time budget), and for each next slice of length-sorted data it emits the largest batch
+        that is predicted to fit.
+
+        After each batch the training loop must call report(oom, elapsed). A batch that ran out of memory is split in
+        two halves that are emitted next, so no example is lost. Until both outcomes have been seen, the batch size
+        starts at start_batch_size, doubles after every success and halves after every failure.
+
+        Args:
+            dataset (BiDataset): Any dataset with lengths() and __getitem__ returning (x, y).
+            src_padding_idx, tgt_padding_idx (int): Passed to paired_collate_fn.
+            start_batch_size, min_batch_size, max_batch_size (int): Batch size bounds.
+            time_budget (float): Seconds; a successful step that takes longer is recorded as a failure. None to disable.
+            pool_size (int): Examples are shuffled, cut in pools of pool_size and each pool is sorted by length.
+            shuffle (bool): Shuffle examples and pools every epoch.
+            threshold (float): Minimum predicted probability of success for a batch size to be used.
+            max_growth (float): Never predict more than max_growth * the largest batch size that succeeded so far.
+            min_samples (int): Number of recorded batches before the estimator is first fit.
+            refit_every (int): Refit after this many new recorded batches.
+            seed (int): Seed for the shuffling.
+        """
+        self.dataset = dataset
+        self.collate_fn = partial(paired_collate_fn, src_padding_idx = src_padding_idx, tgt_padding_idx = tgt_padding_idx)
+        self.batch_size = start_batch_size # used until the estimator is trained
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.time_budget = time_budget
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.threshold = threshold
+        self.max_growth = max_growth
+        self.min_samples = min_samples
+        self.refit_every = refit_every
+        self.rng = np.random.RandomState(seed)
+
+        self.X_lengths, self.y_lengths = dataset.lengths()
+
+        self.estimation_X = [] # features of each recorded batch
+        self.estimation_y = [] # 1 = success, 0 = out of memory or over the time budget
+        self.estimator = make_pipeline(StandardScaler(), LogisticRegression(solver='lbfgs'))
         self.estimator_trained = False
-        self.X = dataset_object.X
-        self.y = dataset_object.y
-        self.offset = 0
-        self.len = len(X)
-        self.shuffle()
-        
-    
-    def shuffle(self):
-        c = list(zip(self.X, self.y))
-        random.shuffle(c)
-        self.X, self.y = zip(*c)
-        
-    def get_next_batch(self, batch_size, force=False):
-        if self.offset >= self.len:
-            raise Exception("Attempted to access instances with offset >= length")
-        if self.estimator_trained:
-            batch_size = self.estimator.predict 
-            pass
-
-        if 
-            
-        start = self.offset 
-        stop = min(self.offset+batch_size, self.len)
-        X = self.X[start:stop].copy()
-        y = self.y[start:stop].copy()
-        
-        X_tensor, y_tensor = self._pad(X, y)  
-        #estimated_batch_size = batch_size
-        return X_tensor, y_tensor, X, y#, estimated_batch_size
-
-    def set_estimation_data(self, X_list, y_list, success): # success is 0 or 1
-        self.estimation_X.append(self._get_stats_for_batch(X_list, y_list)) # array of features
-        self.estimation_y.append(success) # batch_size 
-
-    def fit_estimator (self):
-        print("Fitting estimator...")
-        estimator.fit(self.estimation_X, self.estimation_y)
-        print("Done fitting estimator.")
-
-    def _get_stats_for_batch(self, X_list, y_list): # X and y are lists not tensors.
-        # convert to a list of lenghts
-        X = [len(elem) for elem in X_list]
-        y = [len(elem) for elem in y_list]        
-        features = []
-        
-        # get features for X 
-        ds = stats.describe(X)        
-        cnt = ds[0]
-        min = ds[1][0]
-        max = ds[1][1]
-        mean = ds[2]
-        variance = ds[3]
-        skewness = ds[4]
-        kurtosis = ds[5]        
-        i_0 = vec[0]
-        i_25 = vec[int(cnt/4)]
-        i_50 = vec[int(cnt/2)]
-        i_75 = vec[int(3*cnt/4)]
-        i_100 = vec[-1]
-        features += [cnt, min, max, mean, variance, skewness, kurtosis, i_0, i_25, i_50, i_75, i_100]
-        
-        # get features for y 
-        ds = stats.describe(y)        
-        cnt = ds[0]
-        min = ds[1][0]
-        max = ds[1][1]
-        mean = ds[2]
-        variance = ds[3]
-        skewness = ds[4]
-        kurtosis = ds[5]        
-        i_0 = vec[0]
-        i_25 = vec[int(cnt/4)]
-        i_50 = vec[int(cnt/2)]
-        i_75 = vec[int(3*cnt/4)]
-        i_100 = vec[-1]
-        features += [cnt, min, max, mean, variance, skewness, kurtosis, i_0, i_25, i_50, i_75, i_100]
-
-        return features
-        
-pred = estimator.predict([[2,4.2]])
-print(pred[0])
-        self.estimator.fit(X, y)
-        
-    def _pad (self, X, y):
-        X_max_seq_len = max(len(inst) for inst in X) 
-        y_max_seq_len = max(len(inst) for inst in y) 
-        
-        X = torch.LongTensor(  [ inst + [0] * (X_max_seq_len - len(inst)) for inst in X ]  )
-        y = torch.LongTensor(  [ inst + [0] * (y_max_seq_len - len(inst)) for inst in y ]  )
-        
-        return X, y
-        
-
-class BiDataset(torch.utils.data.Dataset):
-    def __init__(self, root_dir, type = "train", max_seq_len = 100000, min_seq_len = 5):               
-        self.root_dir = root_dir
-
-        X = torch.load(os.path.join(root_dir,type+"_X.pt"))
-        y = torch.load(os.path.join(root_dir,type+"_y.pt"))
-        
-        self.X = []
-        self.y = []
-        cnt = 0
-        zero_size = 0
-        
-        # max len
-        for (sx, sy) in zip(X,y):
-            if len(sx) <= max_seq_len and len(sx) >= min_seq_len:                
-                self.X.append(sx)
-                self.y.append(sy)                    
-                cnt+=1            
-            else: #statistics
-                if len(sx) < min_seq_len+2:
-                    zero_size+=1
-                    
-        print("With max_seq_len = {} there are {} out of {} ({}%) sequences left in the {} dataset (skipped {} with min_seq_len = {}).".format(max_seq_len, len(self.X), len(X), float(100.*len(self.X)/len(X)), type, zero_size, min_seq_len))
-        
-        assert(len(self.X)==len(self.y))
-        
-        # sort descending
-        #self.X, self.y = ( list(t) for t in zip(*sorted(zip(self.X, self.y), key=lambda x: len(x[0]), reverse=True ) ) )
-        #print("Sorted {} set. Largest X sequence = {}, smallest = {}".format(type, len(self.X[0]), len(self.X[-1])))
-        
-        # sort ascending
-        #self.X, self.y = ( list(t) for t in zip(*sorted(zip(self.X, self.y), key=lambda x: len(x[0]) ) ) )
-        #print("\tSorted {} set. Largest X sequence = {}, smallest = {}".format(type, len(self.X[-1]), len(self.X[0])))
-        
-        self.conf = json.load(open(os.path.join(root_dir,"preprocess_settings.json")))
-        self.src_w2i = json.load(open(os.path.join(root_dir,"fr_word2index.json")))
-        self.src_i2w = json.load(open(os.path.join(root_dir,"fr_index2word.json")))
-        
-        self.tgt_w2i = json.load(open(os.path.join(root_dir,"en_word2index.json")))
-        self.tgt_i2w = json.load(open(os.path.join(root_dir,"en_index2word.json")))
-
-    def __len__(self):
-        return len(self.X)
-
-    def __getitem__(self, idx):        
-        return self.X[idx], self.y[idx]
-        
-
-def loader(data_folder, batch_size, max_seq_len = 100000, min_seq_len = 5):        
-    train_dataset = BiDataset(data_folder, "train", max_seq_len, min_seq_len)
-    dev_dataset = BiDataset(data_folder, "dev", max_seq_len, min_seq_len)
-    test_dataset = BiDataset(data_folder, "test", max_seq_len, min_seq_len)
-    
-    train_dataloader = EstimatedDataLoader(train_dataset)
-    return EstimatedDataLoader(train_dataset), EstimatedDataLoader(dev_dataset), EstimatedDataLoader(test_dataset), train_dataset.src_w2i, train_dataset.src_i2w, train_dataset.tgt_w2i, train_dataset.tgt_i2w
-     
\ No newline at end of file
+        self._last_fit_size = 0
+        self.largest_success = 0
+
+        self._pending = [] # batches (index arrays) waiting to be emitted, eg. the two halves of a failed batch
+        self._last_batch = None # index array of the last emitted batch, until report() is called
+
+    def _pools(self):
+        n = len(self.X_lengths)
+        indices = self.rng.permutation(n) if self.shuffle else np.arange(n)
+        pools = []
+        for start in range(0, n, self.pool_size):
+            pool = indices[start:start+self.pool_size]
+            # np.lexsort sorts by the last key first
+            pools.append(pool[np.lexsort((self.y_lengths[pool], self.X_lengths[pool]))])
+        return pools
+
+    def _get_stats_for_batch(self, X_lengths, y_lengths):
+        """
+            Features of every prefix of a length-sorted slice: row k describes the batch made of the first k+1 examples.
+            The memory of a step grows with the padded sizes, so these are the batch size, the max lengths, the padded
+            X and y token counts and the real X and y token counts.
+        """
+        count = np.arange(1, len(X_lengths)+1, dtype=np.float64)
+        max_X = np.maximum.accumulate(X_lengths).astype(np.float64)
+        max_y = np.maximum.accumulate(y_lengths).astype(np.float64)
+        return np.stack([count, max_X, max_y, count*max_X, count*max_y, np.cumsum(X_lengths), np.cumsum(y_lengths)], axis=1)
+
+    def _predict_batch_size(self, X_lengths, y_lengths):
+        if not self.estimator_trained:
+            return self.batch_size
+        features = self._get_stats_for_batch(X_lengths, y_lengths)
+        fits = np.flatnonzero(self.estimator.predict_proba(features)[:,1] >= self.threshold)
+        if len(fits) == 0:
+            return self.min_batch_size
+        return int(fits[-1]) + 1
+
+    def _next_batch(self, pool, offset):
+        # consider at most the batch sizes we could grow to
+        limit = min(self.max_batch_size, len(pool) - offset)
+        if self.largest_success > 0:
+            limit = min(limit, max(self.min_batch_size, int(self.max_growth * self.largest_success)))
+        candidates = pool[offset:offset+limit]
+        batch_size = self._predict_batch_size(self.X_lengths[candidates], self.y_lengths[candidates])
+        batch_size = max(self.min_batch_size, min(batch_size, limit))
+        return candidates[:batch_size]
+
+    def _emit(self, batch):
+        self._last_batch = batch
+        return self.collate_fn([self.dataset[i] for i in batch])
+
+    def __iter__(self):
+        for pool in self._pools():
+            offset = 0
+            while offset < len(pool) or len(self._pending) > 0:
+                if len(self._pending) > 0:
+                    yield self._emit(self._pending.pop())
+                    continue
+                batch = self._next_batch(pool, offset)
+                offset += len(batch)
+                yield self._emit(batch)
+        self._last_batch = None
+
+    def report(self, oom = False, elapsed = None):
+        """
+            Records the outcome of the last emitted batch. Call once per batch, after the step (or after catching the
+            out of memory error).
+
+            Args:
+                oom (bool): The step ran out of memory. The batch is split and its halves are emitted next.
+                elapsed (float): Seconds the step took, compared to time_budget.
+        """
+        batch = self._last_batch
+        if batch is None:
+            return
+        self._last_batch = None
+
+        success = not oom and (self.time_budget is None or elapsed is None or elapsed <= self.time_budget)
+        self.set_estimation_data(self.X_lengths[batch], self.y_lengths[batch], success)
+
+        if success:
+            self.largest_success = max(self.largest_success, len(batch))
+            if not self.estimator_trained:
+                self.batch_size = min(self.max_batch_size, 2 * len(batch))
+        else:
+            if not self.estimator_trained:
+                self.batch_size = max(self.min_batch_size, len(batch) // 2)
+            if oom:
+                if len(batch) == 1:
+                    print("\tEstimatedDataLoader: a single example (X_len={}, y_len={}) does not fit in memory, skipping it.".format(self.X_lengths[batch[0]], self.y_lengths[batch[0]]))
+                else: # _pending is a stack, the first half is emitted next
+                    self._pending.append(batch[len(batch)//2:])
+                    self._pending.append(batch[:len(batch)//2])
+
+        if len(self.estimation_y) >= self.min_samples and len(self.estimation_y) - self._last_fit_size >= self.refit_every:
+            self.fit_estimator()
+
+    def set_estimation_data(self, X_lengths, y_lengths, success):
+        self.estimation_X.append(self._get_stats_for_batch(X_lengths, y_lengths)[-1])
+        self.estimation_y.append(1 if success else 0)
+
+    def fit_estimator(self):
+        self._last_fit_size = len(self.estimation_y)
+        if len(set(self.estimation_y)) < 2: # needs both successes and failures
+            return
+        self.estimator.fit(np.array(self.estimation_X), np.array(self.estimation_y))
+        self.estimator_trained = True
+
+def loader(data_folder, batch_size, src_lookup, tgt_lookup, min_seq_len_X = 5, max_seq_len_X = 1000, min_seq_len_y = 5, max_seq_len_y = 1000, custom_filename_prefix = "", **kwargs):
+    """
+        Same as models.util.loaders.standard.loader, but the train loader is an EstimatedDataLoader (kwargs are passed to it).
+        Dev and test are regular DataLoaders with batch_size, they do not report outcomes to learn from.
+    """
+    src_pad_id = src_lookup.convert_tokens_to_ids(src_lookup.pad_token)
+    tgt_pad_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.pad_token)
+
+    loaders = []
+    for type in ["train", "dev", "test"]:
+        dataset = BiDataset(data_folder, type, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix)
+        if type == "train":
+            loaders.append(EstimatedDataLoader(dataset, src_pad_id, tgt_pad_id, **kwargs))
+        else:
+            loaders.append(torch.utils.data.DataLoader(dataset, num_workers=torch.get_num_threads(), batch_size=batch_size, shuffle=False, 
+                collate_fn=partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id)))
+    return loaders[0], loaders[1], loaders[2]
@@ -0,0 +1,82 @@
+import os, sys
+sys.path.insert(0, '../../..')
+
+import time
+import numpy as np
+import torch
+
+from models.util.loaders.standard import paired_collate_fn
+from models.util.loaders.packed import PackedSequences
+
+"""
+    Micro-benchmark of paired_collate_fn: per-batch cost of the previous list-concatenation implementation versus the
+    current one, on lists of ints and on packed (np.ndarray) examples.
+
+    python benchmark_collate.py [batch_size] [max_X_len] [max_y_len]
+"""
+
+def list_concat_collate_fn(insts, src_padding_idx, tgt_padding_idx):
+    # the previous implementation, kept here as the reference
+    src_insts, tgt_insts = list(zip(*insts))
+
+    src_max_len = max(len(inst) for inst in src_insts)
+    src_seq_lengths = torch.tensor(list(map(len, src_insts)), dtype=torch.long)
+    src_seq_tensor = torch.tensor(np.array( [ list(inst) + [src_padding_idx] * (src_max_len - len(inst)) for inst in src_insts ] ), dtype=torch.long)
+    src_seq_mask = torch.tensor(np.array( [ [1] * len(inst) + [0] * (src_max_len - len(inst)) for inst in src_insts ] ), dtype=torch.long)
+
+    src_seq_lengths, perm_idx = src_seq_lengths.sort(0, descending=True)
+    src_seq_tensor = src_seq_tensor[perm_idx]
+    src_seq_mask = src_seq_mask[perm_idx]
+
+    tgt_max_len = max(len(inst) for inst in tgt_insts)
+    tgt_seq_lengths = torch.tensor(list(map(len, tgt_insts)), dtype=torch.long)
+    tgt_seq_tensor = torch.tensor(np.array( [ list(inst) + [tgt_padding_idx] * (tgt_max_len - len(inst)) for inst in tgt_insts ] ), dtype=torch.long)
+    tgt_seq_mask = torch.tensor(np.array( [ [1] * len(inst) + [0] * (tgt_max_len - len(inst)) for inst in tgt_insts ] ), dtype=torch.long)
+
+    tgt_seq_lengths = tgt_seq_lengths[perm_idx]
+    tgt_seq_tensor = tgt_seq_tensor[perm_idx]
+    tgt_seq_mask = tgt_seq_mask[perm_idx]
+    return ((src_seq_tensor, src_seq_lengths, src_seq_mask), (tgt_seq_tensor, tgt_seq_lengths, tgt_seq_mask))
+
+def time_per_batch(collate_fn, batches, repeats = 3):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for batch in batches:
+            collate_fn(batch, 0, 0)
+        elapsed = (time.perf_counter() - start) / len(batches)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    max_X_len = int(sys.argv[2]) if len(sys.argv) > 2 else 800
+    max_y_len = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    n_batches = 50
+
+    rng = np.random.RandomState(0)
+    X = [rng.randint(1, 50000, size=rng.randint(max_X_len//4, max_X_len)).tolist() for _ in range(batch_size*n_batches)]
+    y = [rng.randint(1, 50000, size=rng.randint(max_y_len//4, max_y_len)).tolist() for _ in range(batch_size*n_batches)]
+    list_batches = [list(zip(X[i:i+batch_size], y[i:i+batch_size])) for i in range(0, len(X), batch_size)]
+
+    # same data as a packed store
+    def pack(sequences):
+        lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        offsets = np.zeros(len(sequences)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return PackedSequences(np.concatenate([np.array(s, dtype=np.int32) for s in sequences]), offsets)
+    X_packed, y_packed = pack(X), pack(y)
+    packed_batches = [[(X_packed[j], y_packed[j]) for j in range(i, i+batch_size)] for i in range(0, len(X), batch_size)]
+
+    # check both implementations produce the same tensors (rows with equal src lengths may come in a different order)
+    old, new = list_concat_collate_fn(list_batches[0], 0, 0), paired_collate_fn(list_batches[0], 0, 0)
+    for old_side, new_side in zip(old, new):
+        assert torch.equal(old_side[1].sort()[0], new_side[1].sort()[0])
+        assert sorted(old_side[0].tolist()) == sorted(new_side[0].tolist())
+        assert sorted(old_side[2].bool().tolist()) == sorted(new_side[2].tolist())
+
+    print("batch_size={}, X_len<{}, y_len<{}, {} batches".format(batch_size, max_X_len, max_y_len, n_batches))
+    print("\tlist concat collate, lists        : {:8.3f} ms/batch".format(1000*time_per_batch(list_concat_collate_fn, list_batches)))
+    print("\tlist concat collate, packed arrays: {:8.3f} ms/batch".format(1000*time_per_batch(list_concat_collate_fn, packed_batches)))
+    print("\tpaired_collate_fn, lists          : {:8.3f} ms/batch".format(1000*time_per_batch(paired_collate_fn, list_batches)))
+    print("\tpaired_collate_fn, packed arrays  : {:8.3f} ms/batch".format(1000*time_per_batch(paired_collate_fn, packed_batches)))
@@ -0,0 +1,148 @@
+import os, sys
+sys.path.append("../../..")
+
+import itertools
+import numpy as np
+
+"""
+    Packed token store: a list of variable length int sequences saved as two .npy files:
+        <file_prefix>.tokens.npy  : one flat int32 array with all the sequences concatenated
+        <file_prefix>.offsets.npy : int64 array of len(sequences)+1, sequence i is tokens[offsets[i]:offsets[i+1]]
+
+    Create from the existing torch.save-d list-of-lists files:
+        python packed.py <data_folder> [custom_filename_prefix]
+    this writes train_X.tokens.npy, train_X.offsets.npy, etc. next to train_X.pt, train_y.pt, etc.
+"""
+
+def packed_exists(file_prefix):
+    return os.path.exists(file_prefix+".tokens.npy") and os.path.exists(file_prefix+".offsets.npy")
+
+def _pack(sequences):
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int32, count=int(offsets[-1]))
+    return tokens, offsets
+
+def save_packed(sequences, file_prefix):
+    """
+        Saves a list of int lists in the packed format.
+
+        Args:
+            sequences (list): A list of lists of ints.
+            file_prefix (string): Path without extension, eg. "ready/bpe/train_X".
+    """
+    tokens, offsets = _pack(sequences)
+    np.save(file_prefix+".tokens.npy", tokens)
+    np.save(file_prefix+".offsets.npy", offsets)
+
+class PackedSequences():
+    def __init__(self, tokens, offsets, indices = None):
+        """
+        Read-only list of sequences backed by a flat token array. Indexing returns a numpy view (no copy) into tokens.
+
+        Args:
+            tokens (np.ndarray): Flat int32 array (usually a np.memmap).
+            offsets (np.ndarray): int64 array of size n+1.
+            indices (np.ndarray): Optional int64 array selecting (and ordering) sequences from the store. None means all, in order.
+        """
+        self.tokens = tokens
+        self.offsets = offsets
+        self.indices = indices
+        self.file_prefix = None # set for memory-mapped stores
+        self._shared_tensors = None # set for in-memory stores, see from_sequences
+
+    @classmethod
+    def open(cls, file_prefix):
+        # mmap_mode returns np.memmap objects, pages are loaded lazily and are shared between processes by the OS
+        tokens = np.load(file_prefix+".tokens.npy", mmap_mode="r")
+        offsets = np.load(file_prefix+".offsets.npy", mmap_mode="r")
+        packed = cls(tokens, offsets)
+        packed.file_prefix = file_prefix
+        return packed
+
+    @classmethod
+    def from_sequences(cls, sequences):
+        """
+        Packs a list of int lists in memory. The two arrays live in torch shared memory, so DataLoader workers read the
+        same pages: forked workers never write to them (no copy-on-write, unlike refcounts on Python lists) and spawned 
+        workers receive a shared memory handle instead of a pickled copy.
+        """
+        import torch
+        tokens, offsets = _pack(sequences)
+        shared_tensors = (torch.from_numpy(tokens).share_memory_(), torch.from_numpy(offsets).share_memory_())
+        packed = cls(shared_tensors[0].numpy(), shared_tensors[1].numpy())
+        packed._shared_tensors = shared_tensors
+        return packed
+
+    def lengths(self):
+        """
+        Returns:
+            An int64 array with the length of each sequence, in the current (indexed) order.
+        """
+        lengths = np.diff(self.offsets)
+        if self.indices is not None:
+            lengths = lengths[self.indices]
+        return lengths
+
+    def subset(self, indices):
+        """
+        Returns a new PackedSequences that shares the same token storage, containing only (and ordered by) indices.
+            indices are relative to the current object, not to the underlying store.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        packed = PackedSequences(self.tokens, self.offsets, indices)
+        packed.file_prefix = self.file_prefix
+        packed._shared_tensors = self._shared_tensors
+        return packed
+
+    def __getstate__(self):
+        # avoid pickling the token arrays when the object is sent to a spawned worker process
+        # (memory-mapped stores are re-opened from file_prefix, shared tensors are pickled by torch as shared memory handles)
+        state = self.__dict__.copy()
+        if self.file_prefix is not None or self._shared_tensors is not None:
+            state["tokens"], state["offsets"] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.file_prefix is not None:
+            self.tokens = np.load(self.file_prefix+".tokens.npy", mmap_mode="r")
+            self.offsets = np.load(self.file_prefix+".offsets.npy", mmap_mode="r")
+        elif self._shared_tensors is not None:
+            self.tokens, self.offsets = self._shared_tensors[0].numpy(), self._shared_tensors[1].numpy()
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self.indices is not None:
+            idx = self.indices[idx]
+        return self.tokens[self.offsets[idx]:self.offsets[idx+1]]
+
+def convert_pt_to_packed(root_dir, custom_filename_prefix = "", types = ("train", "dev", "test")):
+    """
+        Converts existing <prefix><type>_X.pt / <prefix><type>_y.pt files (torch.save-d lists of int lists) to the packed format.
+    """
+    import torch
+    for type in types:
+        for side in ["X", "y"]:
+            file_prefix = os.path.join(root_dir, custom_filename_prefix+type+"_"+side)
+            if not os.path.exists(file_prefix+".pt"):
+                print("\t{}.pt not found, skipping.".format(file_prefix))
+                continue
+            print("Packing {}.pt ...".format(file_prefix))
+            sequences = torch.load(file_prefix+".pt")
+            save_packed(sequences, file_prefix)
+            print("\t{} sequences, {} tokens.".format(len(sequences), sum(len(seq) for seq in sequences)))
+            del sequences
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("params: data_folder [custom_filename_prefix]")
+        sys.exit(0)
+    convert_pt_to_packed(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "")
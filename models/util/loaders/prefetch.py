@@ -0,0 +1,127 @@
+import os, sys
+sys.path.append("../../..")
+
+import time, threading, queue
+import torch
+
+def _map_tensors(fn, obj):
+    # applies fn to every tensor in a (nested) tuple/list batch, eg. ((x, x_len, x_mask), (y, y_len, y_mask))
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_map_tensors(fn, o) for o in obj)
+    return obj
+
+class PrefetchLoader():
+    def __init__(self, loader, device = None, num_prefetch = 2):
+        """
+        Wraps a DataLoader so that the next num_prefetch batches are fetched (and moved to the device) by a background
+        thread while the current batch is being used.
+
+        On a CUDA device each batch is pinned and copied with non_blocking=True on a side stream; the consuming stream
+        waits on an event recorded after the copy, so the transfer overlaps with the forward/backward of the previous
+        step. On the cpu the batches are only fetched ahead in the thread.
+
+        After each batch, last_wait holds the seconds the consumer waited for it (0 if it was already staged),
+        total_wait and steps accumulate over the current iteration.
+
+        Args:
+            loader (DataLoader): Any iterable of batches of tensors.
+            device (torch.device): Where to move the batches; None or cpu leaves them where they are.
+            num_prefetch (int): How many batches are staged ahead. 0 fetches each batch only when it is requested, in the
+                consumer thread (for loaders whose next batch depends on the current step, eg. EstimatedDataLoader).
+        """
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else None
+        self.num_prefetch = num_prefetch
+        self.last_wait = 0.
+        self.total_wait = 0.
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name): # dataset, batch_size, sampler, etc.
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def average_wait(self):
+        return self.total_wait / self.steps if self.steps > 0 else 0.
+
+    def _put(self, batch_queue, stop, item):
+        # waits for room in the queue unless the consumer stopped, returns False then
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer(self, batch_queue, stop, stream):
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = _map_tensors(lambda t: t.pin_memory().to(self.device, non_blocking=True), batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                elif self.device is not None:
+                    batch = _map_tensors(lambda t: t.to(self.device), batch)
+                if not self._put(batch_queue, stop, (batch, event, None)):
+                    return
+        except Exception as e: # re-raised in the consumer
+            self._put(batch_queue, stop, (None, None, e))
+            return
+        self._put(batch_queue, stop, (None, None, StopIteration()))
+
+    def _iter_synchronous(self):
+        self.total_wait, self.steps = 0., 0
+        iterator = iter(self.loader)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            if self.device is not None:
+                batch = _map_tensors(lambda t: t.to(self.device), batch)
+            self.last_wait = time.perf_counter() - time_start
+            self.total_wait += self.last_wait
+            self.steps += 1
+            yield batch
+
+    def __iter__(self):
+        if self.num_prefetch <= 0:
+            yield from self._iter_synchronous()
+            return
+        stream = None
+        if self.device is not None and self.device.type == "cuda":
+            stream = torch.cuda.Stream(device=self.device)
+        batch_queue = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._producer, args=(batch_queue, stop, stream), daemon=True)
+        thread.start()
+
+        self.total_wait, self.steps = 0., 0
+        try:
+            while True:
+                time_start = time.perf_counter()
+                batch, event, error = batch_queue.get()
+                self.last_wait = time.perf_counter() - time_start
+                if isinstance(error, StopIteration):
+                    return
+                if error is not None:
+                    raise error
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # the tensors were allocated on the side stream, tell the caching allocator they are used here
+                    _map_tensors(lambda t: t.record_stream(current_stream), batch)
+                self.total_wait += self.last_wait
+                self.steps += 1
+                yield batch
+        finally: # also when the consumer stops early, eg. _print_examples takes only the first batch
+            stop.set()
@@ -0,0 +1,163 @@
+import os, sys
+sys.path.append("../../..")
+
+import math
+import numpy as np
+import torch
+import torch.utils.data
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, X_lengths, y_lengths, batch_size, bucket_size = 100, shuffle = True, seed = 0):
+        """
+        Batch sampler that groups examples of similar X and y lengths in the same batch, to minimize padding.
+
+        Each epoch the examples are shuffled and split into buckets of bucket_size*batch_size examples. Each bucket is
+        sorted by length (X first, y second) and cut into batches, and then the order of all the batches is shuffled.
+
+        Args:
+            X_lengths (np.ndarray): Length of each source sequence in the dataset.
+            y_lengths (np.ndarray): Length of each target sequence in the dataset.
+            batch_size (int): Number of examples in a batch.
+            bucket_size (int): How many batches are in a bucket. Larger means less padding but less randomness.
+            shuffle (bool): If False, the examples are not shuffled and the batches keep their order (for dev/test).
+            seed (int): The permutation for epoch e is determined by seed+e.
+
+        The batches of an epoch depend only on (seed, epoch), so an interrupted epoch can be resumed with
+        set_epoch(epoch, start_batch): iteration then starts directly at batch start_batch, nothing is replayed.
+        """
+        self.X_lengths = np.asarray(X_lengths)
+        self.y_lengths = np.asarray(y_lengths)
+        self.batch_size = batch_size
+        self.bucket_examples = bucket_size * batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+        self._iter_state = (0, 0) # (epoch, start_batch) of the last started iteration
+
+    def set_epoch(self, epoch, start_batch = 0):
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def state_dict(self, consumed_batches):
+        """
+            State to resume the last started iteration after consumed_batches of its batches were used.
+            The sampler runs ahead of the training loop (DataLoader workers, prefetching), so the caller counts them.
+        """
+        return {"seed": self.seed, "epoch": self._iter_state[0], "start_batch": self._iter_state[1] + consumed_batches}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.set_epoch(state["epoch"], state["start_batch"])
+
+    def _cut(self, bucket):
+        """
+            Cuts a length-sorted bucket (array of dataset indices) into a list of batches.
+        """
+        return [bucket[start:start+self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+
+    def _batches(self, epoch):
+        rng = np.random.RandomState(self.seed + epoch)
+        n = len(self.X_lengths)
+        if self.shuffle:
+            indices = rng.permutation(n)
+        else:
+            indices = np.arange(n)
+
+        batches = []
+        for start in range(0, n, self.bucket_examples):
+            bucket = indices[start:start+self.bucket_examples]
+            # np.lexsort sorts by the last key first
+            bucket = bucket[np.lexsort((self.y_lengths[bucket], self.X_lengths[bucket]))]
+            batches += self._cut(bucket)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches(self.epoch)
+        start_batch = self.start_batch
+        self._iter_state = (self.epoch, start_batch)
+        self.epoch += 1
+        self.start_batch = 0
+        for batch in batches[start_batch:]:
+            yield batch.tolist()
+
+    def __len__(self):
+        n = len(self.X_lengths)
+        full_buckets = n // self.bucket_examples
+        return full_buckets * (self.bucket_examples // self.batch_size) + int(math.ceil((n - full_buckets * self.bucket_examples) / self.batch_size)) - self.start_batch
+
+class RandomBatchSampler(BucketBatchSampler):
+    def __init__(self, n, batch_size, shuffle = True, seed = 0):
+        """
+        Batch sampler equivalent to DataLoader(shuffle=True, batch_size=batch_size), but resumable: the permutation of
+        epoch e is determined by seed+e, see BucketBatchSampler.set_epoch and state_dict.
+
+        Args:
+            n (int): Number of examples in the dataset.
+        """
+        super().__init__(np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64), batch_size, bucket_size = 1, shuffle = shuffle, seed = seed)
+
+    def _batches(self, epoch):
+        n = len(self.X_lengths)
+        if self.shuffle:
+            indices = np.random.RandomState(self.seed + epoch).permutation(n)
+        else:
+            indices = np.arange(n)
+        return self._cut(indices)
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    def __init__(self, X_lengths, y_lengths, max_tokens, bucket_size = 10000, shuffle = True, seed = 0):
+        """
+        Batch sampler that emits variable size batches, each as large as possible while the padded batch stays under a
+        token budget: batch_size * (max_X_len + max_y_len) <= max_tokens. 
+        
+        Bucketing and shuffling are the same as for BucketBatchSampler. An example that alone exceeds max_tokens is 
+        emitted as a batch of size 1.
+
+        Args:
+            max_tokens (int): Token budget per batch, counted on padded X + padded y.
+            bucket_size (int): Number of examples (not batches) in a bucket.
+            see BucketBatchSampler for the other args
+        """
+        super().__init__(X_lengths, y_lengths, batch_size = 1, bucket_size = bucket_size, shuffle = shuffle, seed = seed)
+        self.max_tokens = max_tokens
+        self._epoch_batches = (None, None) # (epoch, batches) of the last computed epoch
+
+    def set_epoch(self, epoch, start_batch = 0):
+        super().set_epoch(epoch, start_batch)
+        self._batches(epoch) # computed once here, then reused by __len__ and __iter__
+
+    def _cut(self, bucket):
+        batches = []
+        start, max_X, max_y = 0, 0, 0
+        for i, index in enumerate(bucket):
+            new_max_X = max(max_X, self.X_lengths[index])
+            new_max_y = max(max_y, self.y_lengths[index])
+            if i > start and (i - start + 1) * (new_max_X + new_max_y) > self.max_tokens:
+                batches.append(bucket[start:i])
+                start, new_max_X, new_max_y = i, self.X_lengths[index], self.y_lengths[index]
+            max_X, max_y = new_max_X, new_max_y
+        if start < len(bucket):
+            batches.append(bucket[start:])
+        return batches
+
+    def _batches(self, epoch):
+        # the number of batches depends on the epoch's permutation, so the batches are cut once per epoch and cached 
+        # (without shuffling every epoch has the same batches)
+        key = epoch if self.shuffle else None
+        if self._epoch_batches[0] != key or self._epoch_batches[1] is None:
+            self._epoch_batches = (key, super()._batches(epoch))
+        return self._epoch_batches[1]
+
+    def __len__(self):
+        return len(self._batches(self.epoch)) - self.start_batch
+
+def padding_ratio(X_mask, y_mask):
+    """
+        Fraction of PAD positions in a batch, over both the padded X and y tensors.
+    """
+    total = X_mask.numel() + y_mask.numel()
+    return 1. - float(X_mask.sum().item() + y_mask.sum().item()) / total
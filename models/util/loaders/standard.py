@@ -1,113 +1,204 @@
-import os, sys, json, random
+import os, sys, json
 sys.path.append("../../..")
 
 from models.util.lookup import Lookup
+from models.util.utils import memory_report
+from models.util.loaders.packed import PackedSequences, packed_exists
+from models.util.loaders.samplers import BucketBatchSampler, TokenBudgetBatchSampler, RandomBatchSampler
 import numpy as np
 import torch
 import torch.utils.data
 from functools import partial
 
-def loader(data_folder, batch_size, src_lookup, tgt_lookup, min_seq_len_X = 5, max_seq_len_X = 1000, min_seq_len_y = 5, max_seq_len_y = 1000, custom_filename_prefix = ""):
+def loader(data_folder, batch_size, src_lookup, tgt_lookup, min_seq_len_X = 5, max_seq_len_X = 1000, min_seq_len_y = 5, max_seq_len_y = 1000, custom_filename_prefix = "", bucketed = False, bucket_size = 100, max_tokens = None, report_memory_every = 0):
+    """
+        Creates the train, dev and test DataLoaders.
+        
+        If bucketed is True, batches are built from examples of similar X and y lengths (see BucketBatchSampler) to 
+        reduce padding; the train batches are still shuffled each epoch, dev and test batches keep a fixed order.
+        
+        If max_tokens is set, batches have a variable number of examples so that batch_size * (max_X_len + max_y_len) 
+        stays under max_tokens (see TokenBudgetBatchSampler). Bucketing is implied, the buckets still have 
+        bucket_size * batch_size examples; batch_size is not used otherwise.
+        
+        If report_memory_every > 0, each worker prints its memory usage (see memory_report) every that many examples;
+        RssAnon should stay flat as the number of workers grows, the data itself is counted in RssFile/RssShmem.
+    """
     src_pad_id = src_lookup.convert_tokens_to_ids(src_lookup.pad_token)
     tgt_pad_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.pad_token)
+    collate_fn = partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id)
     
-    train_loader = torch.utils.data.DataLoader(
-        BiDataset(data_folder, "train", min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix),
-        num_workers=torch.get_num_threads(),
-        batch_size=batch_size,
-        collate_fn=partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id),
-        shuffle=True)
-
-    valid_loader = torch.utils.data.DataLoader(
-        BiDataset(data_folder, "dev", min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix),
-        num_workers=torch.get_num_threads(),
-        batch_size=batch_size,
-        collate_fn=partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id))
+    loaders = []
+    for type in ["train", "dev", "test"]:
+        dataset = BiDataset(data_folder, type, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix, report_memory_every)
+        if max_tokens is not None or bucketed:
+            X_lengths, y_lengths = dataset.lengths()
+            if max_tokens is not None:
+                # bucket_size counts batches of batch_size examples, as for BucketBatchSampler
+                batch_sampler = TokenBudgetBatchSampler(X_lengths, y_lengths, max_tokens, bucket_size = bucket_size * batch_size, shuffle = (type == "train"))
+            else:
+                batch_sampler = BucketBatchSampler(X_lengths, y_lengths, batch_size, bucket_size = bucket_size, shuffle = (type == "train"))
+            data_loader = torch.utils.data.DataLoader(dataset,
+                num_workers=torch.get_num_threads(),
+                batch_sampler=batch_sampler,
+                collate_fn=collate_fn)
+        elif type == "train": # resumable mid-epoch, see RandomBatchSampler
+            data_loader = torch.utils.data.DataLoader(dataset,
+                num_workers=torch.get_num_threads(),
+                batch_sampler=RandomBatchSampler(len(dataset), batch_size),
+                collate_fn=collate_fn)
+        else:
+            data_loader = torch.utils.data.DataLoader(dataset,
+                num_workers=torch.get_num_threads(),
+                batch_size=batch_size,
+                collate_fn=collate_fn,
+                shuffle=False)
+        loaders.append(data_loader)
     
-    test_loader = torch.utils.data.DataLoader(
-        BiDataset(data_folder, "test", min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix),
-        num_workers=torch.get_num_threads(),
-        batch_size=batch_size,
-        collate_fn=partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id))
-            
+    train_loader, valid_loader, test_loader = loaders
     return train_loader, valid_loader, test_loader    
 
 def paired_collate_fn(insts, src_padding_idx, tgt_padding_idx):
-    # insts contains a batch_size number of (x, y) elements    
+    # insts contains a batch_size number of (x, y) elements, where x and y are lists of ints or np.ndarray slices of a packed store
     src_insts, tgt_insts = list(zip(*insts))
     # now src is a batch_size(=64) array of x0 .. x63, and tgt is y0 .. x63 ; xi is variable length
     # ex: if a = [(1,2), (3,4), (5,6)]
     # then b, c = list(zip(*a)) => b = (1,3,5) and b = (2,4,6)
     
-    # src_insts is now a tuple of batch_size Xes (x0, x63) where xi is an instance
-    #src_insts, src_lenghts, tgt_insts, tgt_lenghts = length_collate_fn(src_insts, tgt_insts)       
-    
-    src_max_len = max(len(inst) for inst in src_insts) # determines max size for all examples
-    
-    src_seq_lengths = torch.tensor(list(map(len, src_insts)), dtype=torch.long)    
-    src_seq_tensor = torch.tensor(np.array( [ inst + [src_padding_idx] * (src_max_len - len(inst)) for inst in src_insts ] ), dtype=torch.long)
-    src_seq_mask = torch.tensor(np.array( [ [1] * len(inst) + [0] * (src_max_len - len(inst)) for inst in src_insts ] ), dtype=torch.long)
+    # sort the batch by src length (descending, as needed by pack_padded_sequence) before building any tensor
+    src_lengths = np.array([len(inst) for inst in src_insts], dtype=np.int64)
+    tgt_lengths = np.array([len(inst) for inst in tgt_insts], dtype=np.int64)
+    perm_idx = np.argsort(-src_lengths, kind="stable")
     
-    src_seq_lengths, perm_idx = src_seq_lengths.sort(0, descending=True)
-    src_seq_tensor = src_seq_tensor[perm_idx]   
-    src_seq_mask = src_seq_mask[perm_idx]   
+    src_seq_tensor, src_seq_lengths, src_seq_mask = _pad_sequences([src_insts[i] for i in perm_idx], src_lengths[perm_idx], src_padding_idx)
+    tgt_seq_tensor, tgt_seq_lengths, tgt_seq_mask = _pad_sequences([tgt_insts[i] for i in perm_idx], tgt_lengths[perm_idx], tgt_padding_idx)
+      
+    return ((src_seq_tensor, src_seq_lengths, src_seq_mask), (tgt_seq_tensor, tgt_seq_lengths, tgt_seq_mask))    
+
+def _pad_sequences(insts, lengths, padding_idx):
+    """
+        Builds the padded [batch_size, max_len] int64 tensor, the lengths tensor and the bool mask for a list of sequences.
+        All tokens are written in one indexed assignment into a preallocated array, the mask is a single comparison.
+    """
+    batch_size = len(insts)
+    max_len = int(lengths.max())
     
-    tgt_max_len = max(len(inst) for inst in tgt_insts)
+    seq_array = np.full((batch_size, max_len), padding_idx, dtype=np.int64)
+    rows = np.repeat(np.arange(batch_size), lengths)
+    cols = np.arange(rows.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    seq_array[rows, cols] = np.concatenate([np.asarray(inst) for inst in insts])
     
-    tgt_seq_lengths = torch.tensor(list(map(len, tgt_insts)), dtype=torch.long)    
-    tgt_seq_tensor = torch.tensor(np.array( [ inst + [tgt_padding_idx] * (tgt_max_len - len(inst)) for inst in tgt_insts ] ), dtype=torch.long)
-    tgt_seq_mask = torch.tensor(np.array( [ [1] * len(inst) + [0] * (tgt_max_len - len(inst)) for inst in tgt_insts ] ), dtype=torch.long)
+    seq_lengths = torch.from_numpy(lengths)
+    seq_tensor = torch.from_numpy(seq_array)
+    seq_mask = torch.arange(max_len).unsqueeze(0) < seq_lengths.unsqueeze(1) # [batch_size, max_len], True for tokens, False for padding
+    return seq_tensor, seq_lengths, seq_mask
+
+def _filter_by_length(len_X, len_y, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y):
+    """
+        Returns the (sorted) indices of the examples that pass the length filter, and the 4 cut counts 
+        (over X, under X, over y, under y). An example is counted only for its first failed condition.
+    """
+    over_X = len_X > max_seq_len_X
+    under_X = ~over_X & (len_X < min_seq_len_X+2)
+    over_y = ~over_X & ~under_X & (len_y > max_seq_len_y)
+    under_y = ~over_X & ~under_X & ~over_y & (len_y < min_seq_len_y+2)
     
-    tgt_seq_lengths = tgt_seq_lengths[perm_idx]
-    tgt_seq_tensor = tgt_seq_tensor[perm_idx]      
-    tgt_seq_mask = tgt_seq_mask[perm_idx]   
-      
-    return ((src_seq_tensor, src_seq_lengths, src_seq_mask), (tgt_seq_tensor, tgt_seq_lengths, tgt_seq_mask))    
+    indices = np.flatnonzero(~(over_X | under_X | over_y | under_y))
+    cuts = np.array([over_X.sum(), under_X.sum(), over_y.sum(), under_y.sum()], dtype=np.int64)
+    return indices, cuts
+
+def _data_signature(data_files):
+    # mtime and size of each data file; a cached filter is used only if these did not change
+    return np.array([[int(os.stat(f).st_mtime_ns), os.stat(f).st_size] for f in data_files], dtype=np.int64)
+
+def _load_filter_cache(cache_file, signature):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            if cache["signature"].shape != signature.shape or not (cache["signature"] == signature).all():
+                return None
+            return cache["indices"], cache["cuts"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+def _save_filter_cache(cache_file, signature, indices, cuts):
+    # written to a temp file first so that concurrent runs (eg. a sweep) never read a partial cache
+    tmp_file = cache_file+".{}.tmp".format(os.getpid())
+    try:
+        with open(tmp_file, "wb") as f:
+            np.savez(f, signature=signature, indices=indices, cuts=cuts)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        print("\tCould not write filter cache {}, continuing without it.".format(cache_file))
 
 class BiDataset(torch.utils.data.Dataset):
-    def __init__(self, root_dir, type, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix):  
+    def __init__(self, root_dir, type, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y, custom_filename_prefix, report_memory_every = 0):  
         self.root_dir = root_dir
+        self.type = type
+        self.report_memory_every = report_memory_every
+        self._served = 0
+        self.max_seq_len_y = max_seq_len_y # the longest target, BOS and EOS included; caps the greedy dev predictions
 
-        self.X = []
-        self.y = []
+        X_file_prefix = os.path.join(root_dir,custom_filename_prefix+type+"_X")
+        y_file_prefix = os.path.join(root_dir,custom_filename_prefix+type+"_y")
         
-        if os.path.exists(os.path.join(root_dir,custom_filename_prefix+type+"_X.pt")):
-            X = torch.load(os.path.join(root_dir,custom_filename_prefix+type+"_X.pt"))
-            y = torch.load(os.path.join(root_dir,custom_filename_prefix+type+"_y.pt"))
-            
-            cut_over_X = 0
-            cut_under_X = 0
-            cut_over_y = 0
-            cut_under_y = 0
-            
-            # max len
-            for (sx, sy) in zip(X,y):
-                if len(sx) > max_seq_len_X:
-                    cut_over_X += 1
-                elif len(sx) < min_seq_len_X+2:                
-                    cut_under_X += 1
-                elif len(sy) > max_seq_len_y:
-                    cut_over_y += 1
-                elif len(sy) < min_seq_len_y+2:                
-                    cut_under_y += 1
-                else:
-                    self.X.append(sx)
-                    self.y.append(sy)                    
-
-            c = list(zip(self.X, self.y))
-            random.shuffle(c)
-            self.X, self.y = zip(*c)
-            self.X = list(self.X)
-            self.y = list(self.y)
-                        
-            print("Dataset [{}] loaded with {} out of {} ({}%) sequences.".format(type, len(self.X), len(X), float(100.*len(self.X)/len(X)) ) )
-            print("\t\t For X, {} are over max_len {} and {} are under min_len {}.".format(cut_over_X, max_seq_len_X, cut_under_X, min_seq_len_X))
-            print("\t\t For y, {} are over max_len {} and {} are under min_len {}.".format(cut_over_y, max_seq_len_y, cut_under_y, min_seq_len_y))
-            
-            assert(len(self.X)==len(self.y))
+        # X and y are always PackedSequences: one flat token buffer + offsets, that DataLoader workers read without copying 
+        if packed_exists(X_file_prefix) and packed_exists(y_file_prefix):
+            # packed format, see models/util/loaders/packed.py; nothing is read here except the offsets
+            backend = "packed"
+            data_files = [X_file_prefix+".offsets.npy", y_file_prefix+".offsets.npy"]
+            X = PackedSequences.open(X_file_prefix)
+            y = PackedSequences.open(y_file_prefix)
+        elif os.path.exists(X_file_prefix+".pt"):
+            backend = "pt"
+            data_files = [X_file_prefix+".pt", y_file_prefix+".pt"]
+            X = PackedSequences.from_sequences(torch.load(X_file_prefix+".pt"))
+            y = PackedSequences.from_sequences(torch.load(y_file_prefix+".pt"))
+        else: # no such split (eg. no test set): an empty dataset, that still has lengths()
+            self.X = PackedSequences(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+            self.y = PackedSequences(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+            return
+        
+        # one cache per backend: the .pt and the packed files of a split are different files, with their own signature
+        cache_file = os.path.join(root_dir, "{}{}.filter_{}_{}_{}_{}_{}.npz".format(custom_filename_prefix, type, backend, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y))
+        signature = _data_signature(data_files)
+        cached = _load_filter_cache(cache_file, signature)
+        if cached is not None:
+            indices, cuts = cached
+            print("Dataset [{}] length filter loaded from {}".format(type, cache_file))
+        else:
+            indices, cuts = _filter_by_length(X.lengths(), y.lengths(), min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y)
+            _save_filter_cache(cache_file, signature, indices, cuts)
+        
+        # shuffle only the index array, the data stays where it is
+        indices = np.random.permutation(indices)
+        self.X = X.subset(indices)
+        self.y = y.subset(indices)
+        
+        self._print_stats(type, len(X), *cuts.tolist(), min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y)
+        
+        assert(len(self.X)==len(self.y))
+    
+    def _print_stats(self, type, total, cut_over_X, cut_under_X, cut_over_y, cut_under_y, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y):
+        print("Dataset [{}] loaded with {} out of {} ({}%) sequences.".format(type, len(self.X), total, float(100.*len(self.X)/total) ) )
+        print("\t\t For X, {} are over max_len {} and {} are under min_len {}.".format(cut_over_X, max_seq_len_X, cut_under_X, min_seq_len_X))
+        print("\t\t For y, {} are over max_len {} and {} are under min_len {}.".format(cut_over_y, max_seq_len_y, cut_under_y, min_seq_len_y))
+        
+    def lengths(self):
+        """
+        Returns:
+            Two int64 arrays with the lengths of each X and y sequence, in dataset order.
+        """
+        return self.X.lengths(), self.y.lengths()
         
     def __len__(self):
         return len(self.X)
 
     def __getitem__(self, idx):        
+        if self.report_memory_every > 0:
+            self._served += 1 # counted per worker process
+            if self._served % self.report_memory_every == 0:
+                worker_info = torch.utils.data.get_worker_info()
+                print("\nDataset [{}] worker {} after {} examples: {}".format(self.type, worker_info.id if worker_info is not None else "main", self._served, memory_report()))
         return self.X[idx], self.y[idx]
\ No newline at end of file
@@ -0,0 +1,150 @@
+import os, sys, json, glob, zlib
+sys.path.append("../../..")
+
+from models.util.lookup import Lookup
+from models.util.loaders.standard import paired_collate_fn
+import numpy as np
+import torch
+import torch.utils.data
+from functools import partial
+
+"""
+    Streaming loader that reads the numbered JSON shards written by data/cnndm/1_bpe_process_cnn_dailymail.py directly,
+    instead of the train/dev/test .pt files built by 2_bpe_to_traindevtest.py. Only one shard per worker (plus the
+    shuffle buffer) is in memory at any time, so full_data_fraction=1.0 does not need the whole dataset in RAM.
+
+    Each shard goes (whole) to train, dev or test based on a hash of its file name, so the split is the same in every
+    run, for every worker and for every full_data_fraction, and a dev or test epoch reads only its own shards.
+"""
+
+def streaming_loader(input_folder, batch_size, src_lookup, tgt_lookup, min_seq_len_X = 5, max_seq_len_X = 1000, min_seq_len_y = 5, max_seq_len_y = 1000,
+                     validation_fraction = 0.02, test_fraction = 0.02, full_data_fraction = 1.0, shuffle_buffer = 10000, keep_max_y = 1, reverse_x = False, seed = 0):
+    """
+        Creates the train, dev and test DataLoaders over the JSON shards in input_folder.
+
+        The train loader shuffles the shard order every epoch and then shuffles articles through a buffer of
+        shuffle_buffer examples; dev and test are read in shard order. Shards are split between the DataLoader workers.
+        These loaders have no len(); the number of batches is only known after an epoch.
+    """
+    src_pad_id = src_lookup.convert_tokens_to_ids(src_lookup.pad_token)
+    tgt_pad_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.pad_token)
+
+    loaders = []
+    for type in ["train", "dev", "test"]:
+        dataset = StreamingBiDataset(input_folder, type,
+                                     src_bos_id = src_lookup.convert_tokens_to_ids(src_lookup.bos_token), src_eos_id = src_lookup.convert_tokens_to_ids(src_lookup.eos_token),
+                                     tgt_bos_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.bos_token), tgt_eos_id = tgt_lookup.convert_tokens_to_ids(tgt_lookup.eos_token),
+                                     min_seq_len_X = min_seq_len_X, max_seq_len_X = max_seq_len_X, min_seq_len_y = min_seq_len_y, max_seq_len_y = max_seq_len_y,
+                                     validation_fraction = validation_fraction, test_fraction = test_fraction, full_data_fraction = full_data_fraction,
+                                     shuffle = (type == "train"), shuffle_buffer = shuffle_buffer, keep_max_y = keep_max_y, reverse_x = reverse_x, seed = seed)
+        loaders.append(torch.utils.data.DataLoader(dataset, num_workers=torch.get_num_threads(), batch_size=batch_size, collate_fn=partial(paired_collate_fn, src_padding_idx = src_pad_id, tgt_padding_idx = tgt_pad_id)))
+    return loaders[0], loaders[1], loaders[2]
+
+class StreamingBiDataset(torch.utils.data.IterableDataset):
+    def __init__(self, input_folder, type, src_bos_id, src_eos_id, tgt_bos_id, tgt_eos_id, min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y,
+                 validation_fraction = 0.02, test_fraction = 0.02, full_data_fraction = 1.0, shuffle = True, shuffle_buffer = 10000,
+                 keep_max_y = 1, reverse_x = False, x_field = "x", y_field = "y", seed = 0):
+        """
+        Iterable dataset over JSON shards, each a list of {"file":..., "x":[[ids of sentence 1], ...], "y":[[...], ...]}.
+
+        Args:
+            input_folder (string): Folder with the *.json shards.
+            type (string): "train", "dev" or "test".
+            src_bos_id, src_eos_id, tgt_bos_id, tgt_eos_id (int): Ids added at the start and end of X and y.
+            min_seq_len_X, max_seq_len_X, min_seq_len_y, max_seq_len_y (int): Same length filter as BiDataset.
+            validation_fraction, test_fraction (float): Expected fraction of shards that go to dev and to test.
+            full_data_fraction (float): Fraction of the shards to use. The subset is fixed by seed.
+            shuffle (bool): Shuffle shards every epoch and articles through the shuffle buffer.
+            shuffle_buffer (int): Number of examples held for shuffling (per worker).
+            keep_max_y (int): How many sentences to keep from y.
+            reverse_x (bool): Reverse each sentence of x.
+            seed (int): Shard order and buffer sampling for epoch e depend only on seed, e and the worker id.
+        """
+        self.type = type
+        self.src_bos_id, self.src_eos_id = src_bos_id, src_eos_id
+        self.tgt_bos_id, self.tgt_eos_id = tgt_bos_id, tgt_eos_id
+        self.min_seq_len_X, self.max_seq_len_X = min_seq_len_X, max_seq_len_X
+        self.min_seq_len_y, self.max_seq_len_y = min_seq_len_y, max_seq_len_y
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.keep_max_y = keep_max_y
+        self.reverse_x = reverse_x
+        self.x_field, self.y_field = x_field, y_field
+        self.seed = seed
+        self.epoch = 0
+
+        # [low, high) interval of the shard name hash that belongs to this type
+        train_fraction = 1.0 - validation_fraction - test_fraction
+        self.split_interval = {"train": (0., train_fraction), "dev": (train_fraction, 1.0 - test_fraction), "test": (1.0 - test_fraction, 1.0)}[type]
+
+        all_shards = sorted(glob.glob(os.path.join(input_folder, "*.json")))
+        if full_data_fraction < 1.0:
+            shards = [all_shards[i] for i in np.random.RandomState(seed).permutation(len(all_shards))] # same subset for train, dev and test
+            all_shards = sorted(shards[:int(len(shards)*full_data_fraction)])
+        self.shards = [shard for shard in all_shards if self._in_split(shard)]
+        print("Dataset [{}] streaming from {} out of {} json shards in {}".format(type, len(self.shards), len(all_shards), input_folder))
+        if len(self.shards) == 0 and self.split_interval[0] < self.split_interval[1]:
+            print("\tNo shard falls in [{}], use more (smaller) shards or a larger fraction for it.".format(type))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _in_split(self, shard):
+        h = zlib.crc32(os.path.basename(shard).encode("utf8")) / float(2**32)
+        return self.split_interval[0] <= h < self.split_interval[1]
+
+    def _make_example(self, article):
+        x = [self.src_bos_id]
+        for sentence in article[self.x_field]:
+            x += sentence[::-1] if self.reverse_x else sentence
+        x += [self.src_eos_id]
+
+        y = [self.tgt_bos_id]
+        for sentence in article[self.y_field][:self.keep_max_y]:
+            y += sentence
+        y += [self.tgt_eos_id]
+
+        # same conditions as BiDataset
+        if len(x) > self.max_seq_len_X or len(x) < self.min_seq_len_X+2 or len(y) > self.max_seq_len_y or len(y) < self.min_seq_len_y+2:
+            return None
+        return x, y
+
+    def _worker_shards(self):
+        shards = self.shards
+        if self.shuffle:
+            shards = [shards[i] for i in np.random.RandomState(self.seed + self.epoch).permutation(len(shards))]
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return shards, 0
+        # every worker sees the same shard order and takes every num_workers-th shard
+        return shards[worker_info.id::worker_info.num_workers], worker_info.id
+
+    def _examples(self, shards):
+        for shard in shards:
+            with open(shard, "r", encoding="utf8") as f:
+                articles = json.load(f)
+            for article in articles:
+                example = self._make_example(article)
+                if example is not None:
+                    yield example
+            del articles
+
+    def __iter__(self):
+        shards, worker_id = self._worker_shards()
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            for example in self._examples(shards):
+                yield example
+            return
+
+        rng = np.random.RandomState([self.seed, self.epoch, worker_id])
+        buffer = []
+        for example in self._examples(shards):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            # emit a random example from the buffer and put the new one in its place
+            index = rng.randint(len(buffer))
+            yield buffer[index]
+            buffer[index] = example
+        for index in rng.permutation(len(buffer)):
+            yield buffer[index]
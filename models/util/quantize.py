@@ -0,0 +1,88 @@
+import os, sys
+sys.path.insert(0, '../..')
+
+import io, copy, time
+import torch
+import torch.nn as nn
+
+from models.util.validation_metrics import evaluate
+
+"""
+    Dynamic int8 quantization of a trained EncoderDecoder for CPU inference: the weights of its nn.LSTM and nn.Linear
+    layers are stored as int8 and their activations are quantized on the fly, the attention (and so its softmax) and
+    the output softmax stay in fp32, see quantize. compare reports what it costs and saves on the dev set: model size,
+    decoding latency and the METEOR / ROUGE-L delta of validation_metrics.evaluate. See models/lstm_pn/quantize.py.
+"""
+
+def quantize(model, dtype=torch.qint8):
+    """
+    Returns a quantized copy of model (a CPU model, in eval mode), model is left as it is. All nn.LSTM and nn.Linear
+    layers are quantized except those of the decoder's attention.
+    """
+    if next(model.parameters()).is_cuda:
+        raise Exception("dynamic quantization runs on CPU only, load the model on the CPU")
+    model.eval()
+    if hasattr(model.decoder, "attention") and hasattr(model.decoder.attention, "clear"):
+        model.decoder.attention.clear() # no cached batch in the copy
+    layers = {name for name, module in model.named_modules()
+        if isinstance(module, (nn.LSTM, nn.Linear)) and not name.startswith("decoder.attention.")}
+    quantized = torch.quantization.quantize_dynamic(copy.deepcopy(model), layers, dtype=dtype)
+    quantized.eval()
+    return quantized
+
+def model_size(model):
+    """ The size in bytes of the saved state_dict of model. """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def decode_dev(model, loader, max_len=None, max_batches=None):
+    """
+    Predicts the batches of loader as the dev loop of trainer.train does (greedy_decode up to max_len, None = the
+    dataset's max_seq_len_y; decoders without step() with run_batch). Returns the gold and predicted ids and the
+    decoding time in seconds.
+    """
+    model.eval()
+    greedy = hasattr(model.decoder, "step")
+    max_len = max_len or getattr(loader.dataset, "max_seq_len_y", None)
+    y_gold, y_predicted, elapsed = [], [], 0.
+    with torch.no_grad():
+        for batch_index, ((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask)) in enumerate(loader):
+            if max_batches is not None and batch_index >= max_batches:
+                break
+            start = time.perf_counter()
+            if greedy:
+                y_predicted_batch = model.greedy_decode((x_batch, x_batch_lenghts, x_batch_mask), max_len or 2*y_batch.size(1))
+            else:
+                output, _, _, _ = model.run_batch((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask))
+                y_predicted_batch = output.argmax(dim=2) if output.dim() == 3 else output
+            elapsed += time.perf_counter() - start
+            y_gold += y_batch.tolist()
+            y_predicted += y_predicted_batch.tolist()
+    return y_gold, y_predicted, elapsed
+
+def compare(model, loader, quantized=None, max_len=None, max_batches=None):
+    """
+    Compares model with its quantized copy (made by quantize if not given) on the batches of loader (a dev loader):
+    size, decoding time per input and the scores of validation_metrics.evaluate (as in trainer.train: METEOR, ROUGE-L
+    and their average). Prints and returns the report, a dict of {"fp32": {...}, "int8": {...}, "delta": {...}}.
+    """
+    if quantized is None:
+        quantized = quantize(model)
+    report = {}
+    for name, m in [("fp32", model), ("int8", quantized)]:
+        y_gold, y_predicted, elapsed = decode_dev(m, loader, max_len, max_batches)
+        score, eval = evaluate(y_gold, y_predicted, m.tgt_lookup, cut_at_eos=True, use_accuracy=False, use_bleu=False)
+        report[name] = {"size_mb": model_size(m) / 2**20, "ms_per_input": 1000 * elapsed / len(y_gold),
+            "meteor": eval["meteor"], "rouge_l_f": eval["rouge_l_f"], "score": score}
+    report["delta"] = {key: report["int8"][key] - report["fp32"][key] for key in report["fp32"]}
+
+    print("{} dev inputs, {} threads".format(len(y_gold), torch.get_num_threads()))
+    for name in ["fp32", "int8", "delta"]:
+        if name == "delta":
+            line = "\t{:5}: size {:+8.2f} MB, {:+8.2f} ms/input, METEOR {:+.4f}, ROUGE-L(F) {:+.4f}, average {:+.4f}"
+        else:
+            line = "\t{:5}: size {:8.2f} MB, {:8.2f} ms/input, METEOR {:.4f}, ROUGE-L(F) {:.4f}, average {:.4f}"
+        print(line.format(name, report[name]["size_mb"], report[name]["ms_per_input"], report[name]["meteor"],
+            report[name]["rouge_l_f"], report[name]["score"]))
+    return report
@@ -0,0 +1,242 @@
+import os, sys
+sys.path.insert(0, '../..')
+
+import time, json, threading, queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+
+from models.util.utils import clean_sequences
+
+"""
+    Local inference server for trained EncoderDecoder models: requests are collected into micro-batches of inputs of
+    similar length and decoded together (EncoderDecoder.greedy_decode or generate), see InferenceServer. serve_http
+    and serve_stdio expose it as a HTTP endpoint or as a JSON lines process, models/util/client.py talks to the first.
+    See models/lstm_pn/serve.py for an example.
+"""
+
+class _Request():
+    def __init__(self, text, ids, callback, id):
+        self.text, self.ids, self.callback, self.id = text, ids, callback, id
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result, self.error = None, None
+
+    def wait(self, timeout = None):
+        """ Blocks until the request is decoded, returns its result (see InferenceServer.submit) or raises its error. """
+        if not self.done.wait(timeout):
+            raise TimeoutError("request not decoded in {}s".format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class InferenceServer():
+    def __init__(self, model, max_batch_size = 32, max_latency = 0.05, bucket_width = 16, beam_size = 1, max_len = 100,
+                 length_penalty = 1., max_src_len = 1000):
+        """
+        Batches the requests of any number of threads for a model. A worker thread puts each request in the bucket of
+        inputs of its length (bucket_width tokens per bucket, so a batch holds little padding) and decodes a bucket as
+        soon as it holds max_batch_size requests, or when its oldest request has waited max_latency seconds.
+
+        Args:
+            model (EncoderDecoder): A trained model (see EncoderDecoder.load_checkpoint), with its src_lookup and
+                tgt_lookup. Its decoder must have step(), see EncoderDecoder.generate.
+            max_batch_size (int): Requests decoded together at most.
+            max_latency (float): Seconds a request waits for its batch to fill up at most.
+            bucket_width (int): Range of input lengths (in tokens) batched together.
+            beam_size (int): 1 decodes greedily (EncoderDecoder.greedy_decode), more with beam search (generate).
+            max_len (int): The longest output in tokens, BOS and EOS included.
+            length_penalty (float): See EncoderDecoder.generate.
+            max_src_len (int): Longer inputs are cut to their first max_src_len tokens (BOS and EOS included).
+        """
+        self.model = model
+        self.model.eval()
+        self.src_lookup, self.tgt_lookup = model.src_lookup, model.tgt_lookup
+        self.device = next(model.parameters()).device
+        self.src_pad_token_id = self.src_lookup.convert_tokens_to_ids(self.src_lookup.pad_token)
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.bucket_width = bucket_width
+        self.beam_size = beam_size
+        self.max_len = max_len
+        self.length_penalty = length_penalty
+        self.max_src_len = max_src_len
+
+        self.batches, self.requests = 0, 0 # served so far
+        self._queue = queue.Queue()
+        self._buckets = {} # bucket -> requests, oldest first
+        self._stopped = False
+        self._lock = threading.Lock() # a request is queued before stop() or not at all
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def submit(self, text, callback = None, id = None):
+        """
+        Queues text for decoding and returns at once. The returned request's wait() gives the result, a dict with
+        "text" (the detokenized output) and "timing": queue_ms (waiting for the batch), decode_ms (decoding the batch),
+        total_ms and batch_size. If given, callback(request) is called from the worker thread when it is done. id is
+        kept as request.id. Raises an Exception once the server is stopped.
+        """
+        if not isinstance(text, str):
+            raise ValueError("text must be a string, got {}".format(type(text).__name__))
+        ids = self.src_lookup.encode(text, add_bos_eos_tokens=True)
+        if len(ids) > self.max_src_len:
+            ids = ids[:self.max_src_len-1] + ids[-1:]
+        request = _Request(text, ids, callback, id)
+        with self._lock:
+            if self._stopped:
+                raise Exception("InferenceServer is stopped, it takes no more requests")
+            self._queue.put(request)
+        return request
+
+    def __call__(self, texts):
+        """ Decodes a list of texts (batched with any other requests), returns their results, see submit. """
+        return [request.wait() for request in [self.submit(text) for text in texts]]
+
+    def stop(self):
+        """ Decodes the requests still queued, then stops the worker. """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+        self._worker.join()
+
+    def _work(self):
+        while True:
+            # wait for a request, at most until the oldest request of a bucket is due
+            oldest = [bucket[0].arrival for bucket in self._buckets.values()]
+            timeout = max(0., min(oldest) + self.max_latency - time.perf_counter()) if oldest else None
+            try:
+                request = self._queue.get(timeout=timeout)
+                while request is not None: # take all the requests that arrived meanwhile
+                    self._buckets.setdefault((len(request.ids)-1) // self.bucket_width, []).append(request)
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            now = time.perf_counter()
+            for key in sorted(self._buckets): # full buckets and due buckets (all of them once stopped) are decoded
+                bucket = self._buckets[key]
+                while len(bucket) >= self.max_batch_size:
+                    self._run(bucket[:self.max_batch_size])
+                    del bucket[:self.max_batch_size]
+                if bucket and (self._stopped or bucket[0].arrival + self.max_latency <= now):
+                    self._run(bucket)
+                    bucket.clear()
+                if not bucket:
+                    del self._buckets[key]
+            if self._stopped and not self._buckets and self._queue.empty():
+                return
+
+    def _run(self, requests):
+        start = time.perf_counter()
+        try:
+            outputs = self._decode([request.ids for request in requests])
+        except Exception as e:
+            outputs, error = None, e
+        end = time.perf_counter()
+
+        self.batches += 1
+        self.requests += len(requests)
+        for i, request in enumerate(requests):
+            if outputs is None:
+                request.error = error
+            else:
+                request.result = {"text": outputs[i], "timing": {"queue_ms": 1000*(start - request.arrival),
+                    "decode_ms": 1000*(end - start), "total_ms": 1000*(end - request.arrival), "batch_size": len(requests)}}
+            request.done.set()
+            if request.callback is not None:
+                try:
+                    request.callback(request)
+                except Exception as e: # the worker goes on with the other requests
+                    print("InferenceServer: callback of request {} failed: {}: {}".format(request.id, type(e).__name__, e), file=sys.stderr)
+
+    def _decode(self, inputs):
+        """ Decodes a list of lists of source ids, returns the detokenized outputs in the same order. """
+        # the encoder packs its input, so the rows go longest first
+        order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]), reverse=True)
+        lengths = torch.tensor([len(inputs[i]) for i in order], dtype=torch.long)
+        x = torch.full((len(inputs), int(lengths[0])), self.src_pad_token_id, dtype=torch.long)
+        for row, i in enumerate(order):
+            x[row, :len(inputs[i])] = torch.tensor(inputs[i], dtype=torch.long)
+        x_mask = torch.arange(x.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+        x_tuple = (x.to(self.device), lengths, x_mask.to(self.device))
+
+        if self.beam_size == 1:
+            output = self.model.greedy_decode(x_tuple, self.max_len)
+        else:
+            output, _ = self.model.generate(x_tuple, self.beam_size, self.max_len, self.length_penalty)
+
+        texts = [None] * len(inputs)
+        for row, ids in enumerate(clean_sequences(output.tolist(), self.tgt_lookup)):
+            texts[order[row]] = self.tgt_lookup.decode(ids)
+        return texts
+
+class _Handler(BaseHTTPRequestHandler):
+    # POST {"text": "..."} -> {"text": "...", "timing": {...}}, or {"texts": [...]} -> {"results": [{...}, ...]}
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf8"))
+            if "texts" in body:
+                response = {"results": self.server.inference(body["texts"])}
+            else:
+                response = self.server.inference.submit(body["text"]).wait()
+            code = 200
+        except Exception as e:
+            response, code = {"error": "{}: {}".format(type(e).__name__, e)}, 400 if isinstance(e, (ValueError, KeyError)) else 500
+        data = json.dumps(response).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # no line per request
+        pass
+
+def serve_http(inference, host = "127.0.0.1", port = 8000):
+    """
+    Serves inference (an InferenceServer) over HTTP until interrupted. Each connection has its own thread, so
+    concurrent requests are batched together.
+    """
+    httpd = ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    httpd.inference = inference
+    print("Serving on http://{}:{}".format(host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        inference.stop()
+
+def serve_stdio(inference, input = sys.stdin, output = sys.stdout):
+    """
+    Serves inference (an InferenceServer) as a JSON lines process: each input line {"id": ..., "text": "..."} gets an
+    output line {"id": ..., "text": "...", "timing": {...}} (or {"id": ..., "error": "..."}) when it is decoded, so
+    the outputs may come in another order than the inputs. Lines are read without waiting for their outputs, so they
+    are batched together. Returns at the end of the input, after the last output.
+    """
+    lock = threading.Lock()
+    def write(obj):
+        with lock:
+            output.write(json.dumps(obj) + "\n")
+            output.flush()
+    def done(request):
+        if request.error is not None:
+            write({"id": request.id, "error": "{}: {}".format(type(request.error).__name__, request.error)})
+        else:
+            write(dict(request.result, id=request.id))
+
+    for line in input:
+        if not line.strip():
+            continue
+        obj = None
+        try:
+            obj = json.loads(line)
+            inference.submit(obj["text"], callback=done, id=obj.get("id"))
+        except Exception as e:
+            write({"id": obj.get("id") if isinstance(obj, dict) else None, "error": "{}: {}".format(type(e).__name__, e)})
+    inference.stop()
@@ -9,8 +9,10 @@ from models.util.log import Log
 from tqdm import tqdm
 import numpy as np
 from models.util.validation_metrics import evaluate
-from models.util.utils import pretty_time, clean_sequences
+from models.util.utils import pretty_time, clean_sequences, get_rng_states, set_rng_states
 from models.util.lookup import Lookup
+from models.util.loaders.samplers import padding_ratio
+from models.util.loaders.prefetch import PrefetchLoader
 
 def _plot_attention_weights(X, y, src_lookup, tgt_lookup, attention_weights, epoch, log_object):
     # plot attention weights for the first example of the batch; USE ONLY FOR DEV where len(predicted_y)=len(gold_y)
@@ -38,8 +40,13 @@ def _plot_attention_weights(X, y, src_lookup, tgt_lookup, attention_weights, epo
     #    data[:,i] = attention_over_inputs_at_timestep_i
     log_object.plot_heatmap(data, input_labels=input_labels, output_labels=output_labels, epoch=epoch)
 
-def _print_examples(model, loader, seq_len, src_lookup, tgt_lookup, skip_bos_eos_tokens = True):
-    (X_sample, X_sample_lenghts, X_sample_mask), (y_sample, y_sample_lenghts, y_sample_mask) = iter(loader).next()
+def _dev_max_len(loader, max_len, y_batch):
+    # the longest greedy prediction: max_len if given, else the dataset's max_seq_len_y (see BiDataset), a fixed cap that 
+    # does not depend on the gold targets; datasets without it fall back to twice the longest target of the batch
+    return max_len or getattr(loader.dataset, "max_seq_len_y", None) or 2*y_batch.size(1)
+
+def _print_examples(model, loader, seq_len, src_lookup, tgt_lookup, skip_bos_eos_tokens = True, max_len = None):
+    (X_sample, X_sample_lenghts, X_sample_mask), (y_sample, y_sample_lenghts, y_sample_mask) = next(iter(PrefetchLoader(loader, model.device if model.cuda else None, num_prefetch=1)))
     seq_len = min(seq_len,len(X_sample))
     print("Printing {} examples (batch_size={}):".format(seq_len, len(X_sample)))
     X_sample = X_sample[0:seq_len]
@@ -49,18 +56,14 @@ def _print_examples(model, loader, seq_len, src_lookup, tgt_lookup, skip_bos_eos
     y_sample = y_sample[0:seq_len]
     y_sample_lenghts = y_sample_lenghts[0:seq_len]
     y_sample_mask = y_sample_mask[0:seq_len]
-    
-    if model.cuda:
-        X_sample = X_sample.cuda()
-        X_sample_lenghts = X_sample_lenghts.cuda()
-        X_sample_mask = X_sample_mask.cuda()
-        y_sample = y_sample.cuda()
-        y_sample_lenghts = y_sample_lenghts.cuda()
-        y_sample_mask = y_sample_mask.cuda()
            
     model.eval()   
-    y_pred_sample, _, _, _ = model.run_batch((X_sample, X_sample_lenghts, X_sample_mask), (y_sample, y_sample_lenghts, y_sample_mask))
-    y_pred_sample = torch.argmax(y_pred_sample, dim=2)
+    if hasattr(model.decoder, "step"): # free running, as the dev predictions
+        y_pred_sample = model.greedy_decode((X_sample, X_sample_lenghts, X_sample_mask), _dev_max_len(loader, max_len, y_sample))
+    else:
+        y_pred_sample, _, _, _ = model.run_batch((X_sample, X_sample_lenghts, X_sample_mask), (y_sample, y_sample_lenghts, y_sample_mask))
+    if y_pred_sample.dim() == 3: # models that return argmax ids (see EncoderDecoder._loss_mode) are already [batch_size, seq_len]
+        y_pred_sample = torch.argmax(y_pred_sample, dim=2)
     
     # print examples    
     for i in range(seq_len):        
@@ -96,7 +99,11 @@ def _print_examples(model, loader, seq_len, src_lookup, tgt_lookup, skip_bos_eos
 
 def train(model, train_loader, valid_loader=None, test_loader=None, model_store_path=None,
           resume=False, max_epochs=100000, patience=10, optimizer=None, criterion=None, lr_scheduler=None,
-          tf_start_ratio=0., tf_end_ratio=0., tf_epochs_decay=0): # teacher forcing parameters
+          tf_start_ratio=0., tf_end_ratio=0., tf_epochs_decay=0, # teacher forcing parameters
+          num_prefetch=2, # batches staged ahead on the device, see PrefetchLoader
+          checkpoint_every=0, # also save checkpoint.last every this many training steps, 0 = only at the end of the epoch
+          dev_max_len=None, # longest greedy dev prediction (BOS and EOS included), None = the dev dataset's max_seq_len_y
+          dev_loss_every=0): # teacher forced dev loss every this many epochs, 0 = never (decoders without step() always get it)
     if model_store_path is None: # saves model in the same folder as this script
         model_store_path = os.path.dirname(os.path.realpath(__file__))
     if not os.path.exists(model_store_path):
@@ -105,7 +112,7 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
     log_path = os.path.join(model_store_path,"log")
     log_object = Log(log_path, clear=True)
     log_object.text("Training model: "+model.__class__.__name__)
-    log_object.text("\tresume={}, patience={}, teacher_forcing={}->{} in {} epochs".format(resume, patience, tf_start_ratio, tf_end_ratio, tf_epochs_decay), display = False)
+    log_object.text("\tresume={}, patience={}, teacher_forcing={}->{} in {} epochs, checkpoint_every={}".format(resume, patience, tf_start_ratio, tf_end_ratio, tf_epochs_decay, checkpoint_every), display = False)
     total_params = sum(p.numel() for p in model.parameters())/1000
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)/1000
     log_object.text("\ttotal_parameters={}K, trainable_parameters={}K".format(total_params, trainable_params))
@@ -118,7 +125,8 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
         criterion = nn.CrossEntropyLoss(ignore_index=model.tgt_lookup.convert_tokens_to_ids(model.tgt_lookup.pad_token))
     
     n_class = len(model.tgt_lookup)
-    batch_size = len(train_loader.dataset.X[0])
+    data_device = model.device if model.cuda else None
+    batch_size = getattr(train_loader, "batch_size", None) or 8 # number of examples printed, batch samplers have no fixed size
     current_epoch = 0
     current_patience = patience
     current_epoch_time = "?"
@@ -131,12 +139,22 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
     if tf_epochs_decay > 0:
         epoch_decay = np.linspace(tf_start_ratio, tf_end_ratio, tf_epochs_decay)
 
+    start_batch = 0 # first batch of the first epoch, >0 when resuming mid-epoch
     if resume: # load checkpoint         
         extra_variables = model.load_checkpoint(model_store_path, extension="last")                
         load_optimizer_checkpoint(optimizer, model.cuda, model_store_path, extension="last")
         if "epoch" in extra_variables:
             current_epoch = extra_variables["epoch"]                        
-        log_object.text("Resuming training from epoch {}".format(current_epoch))        
+        if "best_accuracy" in extra_variables:
+            best_accuracy = extra_variables["best_accuracy"]
+            current_patience = extra_variables["patience"]
+        if extra_variables.get("epoch_done", False): # saved at the end of the epoch
+            current_epoch += 1
+        elif "sampler" in extra_variables: # saved mid-epoch, continue with the next unseen batch
+            start_batch = extra_variables["sampler"]["start_batch"]
+        if "rng" in extra_variables:
+            set_rng_states(extra_variables["rng"])
+        log_object.text("Resuming training from epoch {}, batch {}".format(current_epoch, start_batch))        
     
     while current_patience > 0 and current_epoch < max_epochs:        
         #mem_report()
@@ -158,29 +176,61 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
         time_start = time.time()
         model.train()
         total_loss, log_average_loss, total_coverage_loss, log_total_coverage_loss, total_generator_loss, log_total_generator_loss = 0, 0, 0, 0, 0, 0
-        t = tqdm(train_loader, mininterval=0.5, desc="Epoch " + str(current_epoch)+" [train]", unit="b") #ncols=120,
+        total_padding_ratio, log_average_padding_ratio = 0, 0
+        if hasattr(train_loader.dataset, "set_epoch"): # streaming datasets shuffle their shards by epoch
+            train_loader.dataset.set_epoch(current_epoch)
+        # resumable batch samplers (see models/util/loaders/samplers.py) give the same batches for the same epoch
+        train_sampler = getattr(train_loader, "batch_sampler", None)
+        if not hasattr(train_sampler, "state_dict"):
+            train_sampler = None
+        if train_sampler is not None:
+            train_sampler.set_epoch(current_epoch, start_batch)
+        elif start_batch > 0:
+            log_object.text("\tThe train loader cannot skip batches, restarting epoch {} from the first batch".format(current_epoch))
+        start_batch = 0
+        # loaders that choose the next batch from the outcome of this one (EstimatedDataLoader) cannot be read ahead
+        adaptive_loader = hasattr(train_loader, "report")
+        train_prefetcher = PrefetchLoader(train_loader, data_device, 0 if adaptive_loader else num_prefetch)
+        t = tqdm(train_prefetcher, mininterval=0.5, desc="Epoch " + str(current_epoch)+" [train]", unit="b") #ncols=120,
         for batch_index, ((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask)) in enumerate(t):        
             #t.set_postfix(loss=log_average_loss, x_len=len(x_batch[0]), y_len=len(y_batch[0]))                        
-            if model.cuda:
-                x_batch = x_batch.cuda()
-                x_batch_lenghts = x_batch_lenghts.cuda()
-                x_batch_mask = x_batch_mask.cuda()
-                y_batch = y_batch.cuda()
-                y_batch_lenghts = y_batch_lenghts.cuda()
-                y_batch_mask = y_batch_mask.cuda()
+            # the batch is already on the device, moved by train_prefetcher while the previous step was running
+            total_padding_ratio += padding_ratio(x_batch_mask, y_batch_mask)
+            log_average_padding_ratio = total_padding_ratio / (batch_index+1)
                                     
             optimizer.zero_grad()
+            step_start = time.time()
             
-            output, loss, attention_weights, display_variables = model.run_batch((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), criterion, tf_ratio)
+            try:
+                output, loss, attention_weights, display_variables = model.run_batch((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), criterion, tf_ratio)
+                loss.backward()
+            except RuntimeError as e:
+                if not adaptive_loader or "out of memory" not in str(e):
+                    raise
+                # the loader splits this batch and learns from the failure, the gradients of the partial step are dropped
+                output, loss, attention_weights = None, None, None
+                optimizer.zero_grad()
+                if model.cuda:
+                    torch.cuda.empty_cache()
+                train_loader.report(oom=True)
+                continue
             
-            loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.)            
             if lr_scheduler is not None:
                 lr_scheduler.step()
             optimizer.step()
+            
+            if checkpoint_every > 0 and (batch_index+1) % checkpoint_every == 0:
+                extra = {"epoch":current_epoch, "rng":get_rng_states(), "best_accuracy":best_accuracy, "patience":current_patience}
+                if train_sampler is not None:
+                    extra["sampler"] = train_sampler.state_dict(batch_index+1)
+                model.save_checkpoint(model_store_path, "last", extra=extra)
+                save_optimizer_checkpoint (optimizer, model_store_path, extension="last")
              
             total_loss += loss.item()
             log_average_loss = total_loss / (batch_index+1)
+            if adaptive_loader: # loss.item() waited for the step to finish
+                train_loader.report(oom=False, elapsed=time.time() - step_start)
             #for key in display_variables:
             #    if "loss" in key:                    
             if "coverage_loss" in display_variables:
@@ -201,6 +251,9 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
             t_display_dict["cur_loss"] = loss.item()
             t_display_dict["loss"] = log_average_loss            
             t_display_dict["x_y_len"] = str(len(x_batch[0]))+"/"+str(len(y_batch[0]))
+            t_display_dict["pad"] = "{:.3f}".format(log_average_padding_ratio)
+            t_display_dict["bs"] = x_batch.size(0) # variable when batching by token budget
+            t_display_dict["wait"] = "{:.1f}ms".format(1000*train_prefetcher.last_wait) # time this step waited for data
             t.set_postfix(ordered_dict = t_display_dict)
            
             del output, x_batch, y_batch, loss 
@@ -212,7 +265,8 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
         if model.cuda:
             torch.cuda.empty_cache()
         
-        log_object.text("\ttraining_loss={}".format(log_average_loss), display = False)
+        log_object.text("\ttraining_loss={}, padding_ratio={:.4f}, data_wait={:.1f}ms/step ({:.1f}s total)".format(log_average_loss, log_average_padding_ratio, 1000*train_prefetcher.average_wait(), train_prefetcher.total_wait), display = False)
+        log_object.var("Padding ratio|Train", current_epoch, log_average_padding_ratio, y_index=0)
         log_object.var("Loss|Train loss|Validation loss", current_epoch, log_average_loss, y_index=0)
         log_object.var("Train Loss and Aux Loss|Total loss|Generator loss|Aux loss", current_epoch, log_average_loss, y_index=0)
         log_object.var("Train Loss and Aux Loss|Total loss|Generator loss|Aux loss", current_epoch, log_total_generator_loss, y_index=1)
@@ -226,47 +280,51 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
             model.eval()
             with torch.no_grad():
                 total_loss = 0
-                _print_examples(model, valid_loader, batch_size, model.src_lookup, model.tgt_lookup)
+                _print_examples(model, valid_loader, batch_size, model.src_lookup, model.tgt_lookup, max_len=dev_max_len)
+                # the predictions are decoded free running up to EOS (see EncoderDecoder.greedy_decode), not for the length 
+                # of the gold targets; the teacher forced loss is a second decoder pass, run only every dev_loss_every epochs.
+                # Decoders without step() predict as before, with tf_ratio=0, and get the loss from the same pass
+                greedy = hasattr(model.decoder, "step")
+                dev_loss = not greedy or (dev_loss_every > 0 and current_epoch % dev_loss_every == 0)
+                log_average_loss = None
 
-                t = tqdm(valid_loader, mininterval=0.5, desc="Epoch " + str(current_epoch)+" [valid]", unit="b")
+                t = tqdm(PrefetchLoader(valid_loader, data_device, num_prefetch), mininterval=0.5, desc="Epoch " + str(current_epoch)+" [valid]", unit="b")
                 y_gold = list()
                 y_predicted = list()
                 
                 for batch_index, ((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask)) in enumerate(t):
-                    if model.cuda:
-                        x_batch = x_batch.cuda()
-                        x_batch_lenghts = x_batch_lenghts.cuda()
-                        x_batch_mask = x_batch_mask.cuda()
-                        y_batch = y_batch.cuda()
-                        y_batch_lenghts = y_batch_lenghts.cuda()
-                        y_batch_mask = y_batch_mask.cuda()
+                    if dev_loss:
+                        output, loss, batch_attention_weights, display_variables = model.run_batch((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), criterion, tf_ratio=1. if greedy else 0.)
                     
-                    output, loss, batch_attention_weights, display_variables = model.run_batch((x_batch, x_batch_lenghts, x_batch_mask), (y_batch, y_batch_lenghts, y_batch_mask), criterion, tf_ratio=0.)
-            
-                    y_predicted_batch = output.argmax(dim=2)
+                    if greedy:
+                        y_predicted_batch = model.greedy_decode((x_batch, x_batch_lenghts, x_batch_mask), _dev_max_len(valid_loader, dev_max_len, y_batch))
+                    else:
+                        y_predicted_batch = output.argmax(dim=2) if output.dim() == 3 else output
                     y_gold += y_batch.tolist()
                     y_predicted += y_predicted_batch.tolist()                
                     
-                    total_loss += loss.data.item()
-                    log_average_loss = total_loss / (batch_index+1)
-                    
-                    # update progress bar
-                    t_display_dict = OrderedDict()
-                    t_display_dict["loss"] = log_average_loss
-                    if isinstance(display_variables, dict):
-                        for key in display_variables:
-                            t_display_dict[key] = display_variables[key]                     
-                    t.set_postfix(ordered_dict = t_display_dict)
-                    
-                    del output, loss
+                    if dev_loss:
+                        total_loss += loss.data.item()
+                        log_average_loss = total_loss / (batch_index+1)
+                        
+                        # update progress bar
+                        t_display_dict = OrderedDict()
+                        t_display_dict["loss"] = log_average_loss
+                        if isinstance(display_variables, dict):
+                            for key in display_variables:
+                                t_display_dict[key] = display_variables[key]                     
+                        t.set_postfix(ordered_dict = t_display_dict)
+                        
+                        del output, loss
                     
                     
                 if model.cuda:
                     torch.cuda.empty_cache()
                     torch.cuda.synchronize()
                         
-            log_object.text("\tvalidation_loss={}".format(log_average_loss), display = False)
-            log_object.var("Loss|Train loss|Validation loss", current_epoch, log_average_loss, y_index=1)
+            if dev_loss:
+                log_object.text("\tvalidation_loss={}".format(log_average_loss), display = False)
+                log_object.var("Loss|Train loss|Validation loss", current_epoch, log_average_loss, y_index=1)
             
             score = 0.
             if True: #current_epoch%5==0:
@@ -289,7 +347,8 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
                 current_patience = patience
             
             # batch_attention_weights is a list of [batch_size, dec_seq_len, enc_seq_len] elements, where dim=2 is the softmax distribution for that decoder timestep            
-            _plot_attention_weights(x_batch, y_batch, model.src_lookup, model.tgt_lookup, batch_attention_weights, current_epoch, log_object)
+            if dev_loss: # teacher forced, so aligned with the gold y
+                _plot_attention_weights(x_batch, y_batch, model.src_lookup, model.tgt_lookup, batch_attention_weights, current_epoch, log_object)
             
             # dev cleanup
             del t, y_predicted_batch, y_gold, y_predicted
@@ -309,7 +368,7 @@ def train(model, train_loader, valid_loader=None, test_loader=None, model_store_
         log_object.draw()
         #log_object.draw(last_quarter=True) # draw a second graph with last 25% of results
         
-        model.save_checkpoint(model_store_path, "last", extra={"epoch":current_epoch})
+        model.save_checkpoint(model_store_path, "last", extra={"epoch":current_epoch, "epoch_done":True, "rng":get_rng_states(), "best_accuracy":best_accuracy, "patience":current_patience-1})
         save_optimizer_checkpoint (optimizer, model_store_path, extension="last")
 
         current_epoch += 1
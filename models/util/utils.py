@@ -14,24 +14,71 @@ def pretty_time(seconds, granularity=2):
 
 def clean_sequences(sequences, lookup):
     """
-        Cleans BOS and EOS from sequences.
+        Cleans BOS and EOS from sequences. Sequences also end at the first PAD, as the decoders pad predictions
+        past the end of their target.
         sequences (list): is a list of lists containing ints corresponding to the lookup
     """
     bos_id = lookup.convert_tokens_to_ids(lookup.bos_token)
     eos_id = lookup.convert_tokens_to_ids(lookup.eos_token)
+    pad_id = lookup.convert_tokens_to_ids(lookup.pad_token) if getattr(lookup, "pad_token", None) else None
     cleaned_sequences = []        
     for seq in sequences:
         lst = []
         for i, value in enumerate(seq):                                
             if i == 0 and value == bos_id: # skip bos
                 continue
-            if i>0 and value == eos_id: # stop before first eos       
+            if i>0 and (value == eos_id or value == pad_id): # stop before first eos (or pad)
                 break
             lst.append(value)
         cleaned_sequences.append(lst)
     
     return cleaned_sequences
     
+def get_rng_states():
+    """
+        States of the torch, cuda, numpy and random generators, to be saved in a checkpoint. 
+        numpy's key array is stored as a tensor so the checkpoint holds only tensors and python primitives.
+    """
+    import random
+    import numpy as np
+    import torch
+    np_state = np.random.get_state()
+    states = {}
+    states["torch"] = torch.get_rng_state()
+    states["cuda"] = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    states["numpy"] = (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), np_state[2], np_state[3], np_state[4])
+    states["random"] = random.getstate()
+    return states
+
+def set_rng_states(states):
+    import random
+    import numpy as np
+    import torch
+    torch.set_rng_state(states["torch"])
+    if torch.cuda.is_available() and len(states["cuda"]) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(states["cuda"])
+    np_state = states["numpy"]
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), np_state[2], np_state[3], np_state[4]))
+    random.setstate(states["random"])
+    
+def memory_report():
+    """
+        Memory of the current process, from /proc/self/status (Linux). RssAnon is private memory, RssFile and RssShmem 
+        are pages that can be shared with other processes (memory-mapped files and shared memory).
+    """
+    fields = ["VmRSS", "RssAnon", "RssFile", "RssShmem"]
+    values = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                key = line.split(":")[0]
+                if key in fields:
+                    values[key] = int(line.split()[1])//1024
+    except IOError:
+        import resource
+        values["MaxRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024
+    return ", ".join("{}={}MB".format(key, values[key]) for key in fields+["MaxRSS"] if key in values)
+    
 def select_processing_device(gpu_id = None, verbose = False):
     def _get_freer_gpu():
         try:    